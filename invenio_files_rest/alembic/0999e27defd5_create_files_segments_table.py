@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Create files_files_segments table."""
+
+import sqlalchemy as sa
+import sqlalchemy_utils
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0999e27defd5'
+down_revision = 'a29271fd78f8'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_table(
+        'files_files_segments',
+        sa.Column(
+            'file_id',
+            sqlalchemy_utils.types.uuid.UUIDType(),
+            nullable=False),
+        sa.Column('number', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('checksum', sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint('file_id', 'number'),
+        sa.ForeignKeyConstraint(
+            ['file_id'],
+            [u'files_files.id'],
+            ondelete='CASCADE'),
+    )
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_table('files_files_segments')
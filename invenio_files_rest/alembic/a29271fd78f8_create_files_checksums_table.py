@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Create files_files_checksums table."""
+
+import sqlalchemy as sa
+import sqlalchemy_utils
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a29271fd78f8'
+down_revision = '8ae99b034410'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_table(
+        'files_files_checksums',
+        sa.Column(
+            'file_id',
+            sqlalchemy_utils.types.uuid.UUIDType(),
+            nullable=False),
+        sa.Column('algorithm', sa.String(length=20), nullable=False),
+        sa.Column('checksum', sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint('file_id', 'algorithm'),
+        sa.ForeignKeyConstraint(
+            ['file_id'],
+            [u'files_files.id'],
+            ondelete='CASCADE'),
+    )
+    op.create_index(
+        op.f('ix_files_files_checksums_checksum'),
+        'files_files_checksums',
+        ['checksum'],
+        unique=False)
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index(
+        op.f('ix_files_files_checksums_checksum'),
+        table_name='files_files_checksums')
+    op.drop_table('files_files_checksums')
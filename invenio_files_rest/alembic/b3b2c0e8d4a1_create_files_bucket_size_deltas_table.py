@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Create files_bucket_size_deltas table."""
+
+import sqlalchemy as sa
+import sqlalchemy_utils
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b3b2c0e8d4a1'
+down_revision = '0999e27defd5'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_table(
+        'files_bucket_size_deltas',
+        sa.Column(
+            'id',
+            sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+            nullable=False),
+        sa.Column(
+            'bucket_id',
+            sqlalchemy_utils.types.uuid.UUIDType(),
+            nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.ForeignKeyConstraint(
+            ['bucket_id'],
+            [u'files_bucket.id'],
+            ondelete='CASCADE'),
+    )
+    op.create_index(
+        op.f('ix_files_bucket_size_deltas_bucket_id'),
+        'files_bucket_size_deltas',
+        ['bucket_id'],
+        unique=False)
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index(
+        op.f('ix_files_bucket_size_deltas_bucket_id'),
+        table_name='files_bucket_size_deltas')
+    op.drop_table('files_bucket_size_deltas')
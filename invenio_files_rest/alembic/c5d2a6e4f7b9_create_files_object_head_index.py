@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Create files_object head index."""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c5d2a6e4f7b9'
+down_revision = 'b3b2c0e8d4a1'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    # Keep only the newest head of each object, as concurrent updates could
+    # leave several heads.
+    files_object = sa.table(
+        'files_object',
+        sa.column('version_id'),
+        sa.column('bucket_id'),
+        sa.column('key'),
+        sa.column('created'),
+        sa.column('is_head', sa.Boolean),
+    )
+    conn = op.get_bind()
+    objects = conn.execute(
+        sa.select([files_object.c.bucket_id, files_object.c.key])
+        .where(files_object.c.is_head.is_(True))
+        .group_by(files_object.c.bucket_id, files_object.c.key)
+        .having(sa.func.count() > 1)
+    ).fetchall()
+    for bucket_id, key in objects:
+        heads = conn.execute(
+            sa.select([files_object.c.version_id])
+            .where(sa.and_(
+                files_object.c.bucket_id == bucket_id,
+                files_object.c.key == key,
+                files_object.c.is_head.is_(True)))
+            .order_by(files_object.c.created.desc(),
+                      files_object.c.version_id.desc())
+        ).fetchall()
+        conn.execute(
+            files_object.update()
+            .where(files_object.c.version_id.in_(
+                [version_id for version_id, in heads[1:]]))
+            .values(is_head=False))
+
+    # MySQL does not support partial indexes.
+    is_mysql = op.get_context().dialect.name == 'mysql'
+    op.create_index(
+        'uidx_files_object_bucket_id_key_head',
+        'files_object',
+        ['bucket_id', 'key'],
+        unique=not is_mysql,
+        postgresql_where=sa.column('is_head').is_(True),
+        sqlite_where=sa.column('is_head').is_(True))
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index(
+        'uidx_files_object_bucket_id_key_head', table_name='files_object')
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Create indexes on file references, checksums and fixity checks."""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd8e1f3a7b2c6'
+down_revision = 'c5d2a6e4f7b9'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_index(
+        op.f('ix_files_object_file_id'),
+        'files_object',
+        ['file_id'],
+        unique=False)
+    op.create_index(
+        op.f('ix_files_multipartobject_file_id'),
+        'files_multipartobject',
+        ['file_id'],
+        unique=False)
+    op.create_index(
+        'ix_files_files_checksum_size',
+        'files_files',
+        ['checksum', 'size'],
+        unique=False)
+    op.create_index(
+        op.f('ix_files_files_last_check_at'),
+        'files_files',
+        ['last_check_at'],
+        unique=False)
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index(
+        op.f('ix_files_files_last_check_at'), table_name='files_files')
+    op.drop_index('ix_files_files_checksum_size', table_name='files_files')
+    op.drop_index(
+        op.f('ix_files_multipartobject_file_id'),
+        table_name='files_multipartobject')
+    op.drop_index(
+        op.f('ix_files_object_file_id'), table_name='files_object')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Create files_object listing index."""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import mysql
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7c9d2a5f1'
+down_revision = 'd8e1f3a7b2c6'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    # Keys are listed by code point (see ``BinaryCollate``).
+    dialect = op.get_context().dialect.name
+    if dialect == 'mysql':
+        op.alter_column(
+            'files_object', 'key',
+            existing_type=mysql.VARCHAR(255),
+            type_=mysql.VARCHAR(255, binary=True),
+            existing_nullable=False)
+    if dialect == 'postgresql':
+        key = sa.text('key COLLATE "C"')
+    else:
+        key = 'key'
+    op.create_index(
+        'ix_files_object_bucket_id_key_created_version_id',
+        'files_object',
+        ['bucket_id', key, sa.text('created DESC'),
+         sa.text('version_id DESC')],
+        unique=False)
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index(
+        'ix_files_object_bucket_id_key_created_version_id',
+        table_name='files_object')
+    if op.get_context().dialect.name == 'mysql':
+        op.alter_column(
+            'files_object', 'key',
+            existing_type=mysql.VARCHAR(255, binary=True),
+            type_=mysql.VARCHAR(255),
+            existing_nullable=False)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Reusable memory buffers for reading and writing files.
+
+Transfers read their data with ``readinto()`` into buffers taken from a
+:class:`BufferPool` instead of allocating a new ``bytes`` object for every
+chunk. The pool is shared by all transfers of an application and bounds the
+total memory used by their buffers.
+"""
+
+from __future__ import absolute_import, print_function
+
+import io
+import threading
+from contextlib import contextmanager
+
+
+def read_into(stream, buf):
+    """Read from a stream into a buffer.
+
+    :param stream: File-like object.
+    :param buf: A writable buffer (e.g. ``bytearray`` or ``memoryview``).
+    :returns: The number of bytes read (``0`` at the end of the stream).
+    """
+    try:
+        readinto = stream.readinto
+    except AttributeError:
+        readinto = None
+
+    if readinto is not None:
+        try:
+            return readinto(buf) or 0
+        except io.UnsupportedOperation:
+            pass
+
+    data = stream.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+class BufferPool(object):
+    """Pool of reusable buffers with a bounded total size.
+
+    Released buffers are kept for reuse. When the memory budget is exhausted,
+    the pool hands out smaller buffers (down to ``min_chunk_size``) and
+    otherwise blocks until another transfer releases its buffer.
+    """
+
+    def __init__(self, max_size, min_chunk_size=64 * 1024):
+        """Initialize the pool.
+
+        :param max_size: Maximum total size in bytes of all buffers.
+        :param min_chunk_size: Smallest buffer handed out when the memory
+            budget is exhausted.
+        """
+        self.max_size = max_size
+        self.min_chunk_size = min(min_chunk_size, max_size)
+        self.allocated = 0
+        self._free = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        """Get a buffer.
+
+        :param size: Requested buffer size.
+        :returns: A ``bytearray`` of at most ``size`` bytes.
+        """
+        size = min(size, self.max_size)
+        with self._cond:
+            while 1:
+                chunk_size = size
+                while 1:
+                    buf = self._take(chunk_size)
+                    if buf is not None:
+                        return buf
+                    if chunk_size <= self.min_chunk_size:
+                        break
+                    chunk_size = max(chunk_size // 2, self.min_chunk_size)
+                self._cond.wait()
+
+    def release(self, buf):
+        """Give a buffer back to the pool.
+
+        :param buf: A buffer returned by :meth:`acquire`.
+        """
+        with self._cond:
+            self._free.setdefault(len(buf), []).append(buf)
+            self._cond.notify_all()
+
+    @contextmanager
+    def buffer(self, size):
+        """Get a buffer for the duration of a ``with`` block."""
+        buf = self.acquire(size)
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def _take(self, size):
+        """Reuse or allocate a buffer if it fits in the budget."""
+        free = self._free.get(size)
+        if free:
+            return free.pop()
+
+        # Make room by dropping unused buffers of other sizes.
+        while self.allocated + size > self.max_size and self._evict():
+            pass
+
+        if self.allocated + size <= self.max_size:
+            self.allocated += size
+            return bytearray(size)
+        return None
+
+    def _evict(self):
+        """Drop one unused buffer."""
+        for size, free in self._free.items():
+            if free:
+                free.pop()
+                self.allocated -= size
+                return True
+        return False
@@ -29,6 +29,7 @@ your nodes.
 FILES_REST_STORAGE_CLASS_LIST = {
     'S': 'Standard',
     'A': 'Archive',
+    'C': 'Compressed',
 }
 """Storage class list defines the systems storage classes.
 
@@ -53,7 +54,239 @@ FILES_REST_SIZE_LIMITERS = 'invenio_files_rest.limiters.file_size_limiters'
 """Import path of file size limiters factory."""
 
 FILES_REST_STORAGE_FACTORY = 'invenio_files_rest.storage.pyfs_storage_factory'
-"""Import path of factory used to create a storage instance."""
+"""Import path of factory used to create a storage instance.
+
+Files on local (or network mounted) file systems can be accessed without
+the PyFilesystem layer with
+:func:`invenio_files_rest.storage.local_storage_factory`, or be stored as
+segment files with
+:func:`invenio_files_rest.storage.segmented_storage_factory`. Files of
+locations with an ``s3://<bucket>/<prefix>`` URI can be stored in an S3
+compatible object store with
+:func:`invenio_files_rest.storage.s3_storage_factory` (see
+:data:`FILES_REST_S3_CLIENT_KWARGS`).
+"""
+
+FILES_REST_STORAGE_SEGMENT_SIZE = 64 * 1024 * 1024
+"""Segment size of files stored by the segmented storage.
+
+Multipart uploads use their chunk size instead, so that each part is stored
+in its own segment (see
+:class:`invenio_files_rest.storage.SegmentedFileStorage`).
+"""
+
+FILES_REST_STORAGE_PIPELINE_DEPTH = 0
+"""Number of chunks buffered between reading, hashing and writing uploads.
+
+If set to a positive value, the storage reads the incoming stream in the
+request thread, while the checksums and the disk writes are computed in
+separate threads. This allows uploads to run at the speed of the slowest of
+network, hashing and disk instead of their sum. Each stage buffers at most
+this number of chunks. ``0`` disables the pipelining.
+"""
+
+FILES_REST_STORAGE_FS_CACHE_SIZE = 0
+"""Number of storage locations whose opened file system is cached.
+
+If set, the PyFilesystem storage keeps the file systems of the storage
+locations open (per process) and accesses the files relative to them, instead
+of opening the directory of every file from its URL. This reduces the latency
+of small file downloads. ``0`` disables the cache.
+"""
+
+FILES_REST_STORAGE_COPY_METHODS = []
+"""Methods used to copy local files without reading them.
+
+When a file is copied (e.g. migrated to another location) and both files
+are on the local file system, the listed methods are tried in order:
+``'reflink'`` (clone the data blocks on e.g. Btrfs or XFS),
+``'copy_file_range'`` (copy in the kernel or on the NFS server) or ``'link'``
+(hard link, only safe if the source file is not modified afterwards), e.g.
+``['reflink', 'copy_file_range']``. If none works, the file is streamed as
+usual (see :func:`invenio_files_rest.storage.base.fast_copy`).
+
+.. note::
+
+   Copied data is not read, so the copy gets the checksums of the source
+   file instead of verifying them. By default files are streamed.
+"""
+
+FILES_REST_STORAGE_SCAN_ADVICE = False
+"""Keep checksums and copies of files from evicting the page cache.
+
+Files read in whole by checksum verifications and migrations are read ahead
+sequentially, and dropped from the page cache once read
+(``posix_fadvise()``), so that they do not evict the files being downloaded
+(see :class:`invenio_files_rest.storage.base.ScanFile`). Downloads are not
+affected.
+"""
+
+FILES_REST_STORAGE_SCAN_DIRECT_IO = False
+"""Read files with direct I/O (``O_DIRECT``) in checksums and copies.
+
+Bypasses the page cache entirely for files of
+:class:`invenio_files_rest.storage.LocalFileStorage`, if the file system
+supports it. Other storages ignore it.
+"""
+
+FILES_REST_STORAGE_PREALLOCATE = False
+"""Allocate the disk space of multipart uploads when they are created.
+
+If enabled, files initialized with a given size (i.e. multipart uploads) are
+allocated with ``posix_fallocate()`` on local file systems instead of being
+created as sparse files. This avoids fragmentation when the parts are written
+in parallel, and makes the creation of the upload fail right away (with a 507
+error) if there is not enough disk space. On file systems without support for
+it, only the free disk space is checked.
+
+Files saved with a known size by
+:class:`invenio_files_rest.storage.LocalFileStorage` are allocated as well.
+"""
+
+FILES_REST_CHECKSUM_ALGORITHMS = {
+    'md5': 'hashlib:md5',
+    'sha1': 'hashlib:sha1',
+    'sha256': 'hashlib:sha256',
+    'sha512': 'hashlib:sha512',
+    'blake2b': 'hashlib:blake2b',
+    'blake2s': 'hashlib:blake2s',
+}
+"""Registry of checksum algorithms.
+
+Mapping of algorithm names to import paths (or callables) of functions
+returning a new message digest object, i.e. an object with the ``update()``
+and ``hexdigest()`` methods. Checksums are stored as ``<name>:<hexdigest>``.
+Faster non-cryptographic algorithms can be registered as well, e.g.
+``'xxh64': 'xxhash:xxh64'`` if the ``xxhash`` package is installed. Tree
+checksums of the registered algorithms are named
+``<name>-tree-<segment size>`` (see :mod:`invenio_files_rest.treehash`).
+"""
+
+FILES_REST_CHECKSUM_ALGORITHM = 'md5'
+"""Checksum algorithm of new files.
+
+Existing files are always verified with the algorithm of their stored
+checksum.
+"""
+
+FILES_REST_LOCATION_CHECKSUM_ALGORITHMS = {}
+"""Checksum algorithm of new files for each location.
+
+Mapping of location URIs to checksum algorithms, e.g.
+``{'/data/archive': 'blake2b'}``. Files of other locations use
+:data:`FILES_REST_CHECKSUM_ALGORITHM`.
+"""
+
+FILES_REST_STORAGE_EXTRA_CHECKSUMS = {}
+"""Additional checksum algorithms computed for each storage class.
+
+Mapping of storage class to a list of algorithm names (see
+:data:`FILES_REST_CHECKSUM_ALGORITHMS`), e.g. ``{'A': ['sha256']}``. The
+additional checksums are computed in the same pass over the data as the main
+checksum, and are stored with the file instance (see
+:class:`invenio_files_rest.models.FileInstanceChecksum`). Fixity checks verify
+them as well.
+"""
+
+FILES_REST_STORAGE_COMPRESSION = {
+    'C': 1,
+}
+"""Compression level of the files saved with each storage class.
+
+Mapping of storage class to a gzip compression level (``0`` to ``9``). Files
+saved in one pass are stored compressed (as ``data.gz``), and decompressed
+when read, while the size and checksums of the file instance describe the
+uncompressed contents. Files written in parts (e.g. multipart uploads) are
+stored uncompressed.
+
+Existing compressed files are recognized by their name, so they are still
+decompressed after their storage class is removed from the mapping.
+"""
+
+FILES_REST_STORAGE_CACHE_URI = None
+"""Directory of the read-through cache of slow storage classes.
+
+If set, files of the storage classes in
+:data:`FILES_REST_STORAGE_CACHE_CLASSES` are copied to this directory (which
+should be on a fast local disk) the first time they are read, and are
+then served from there (see
+:class:`invenio_files_rest.storage.cache.StorageCache`). Copies are verified
+against the checksum of the file instance.
+"""
+
+FILES_REST_STORAGE_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+"""Maximum size of the read-through cache in bytes.
+
+The least recently downloaded files are removed by the
+:func:`invenio_files_rest.tasks.evict_storage_cache` task, which should be
+scheduled periodically. The cache may exceed this size between two runs.
+"""
+
+FILES_REST_STORAGE_CACHE_CLASSES = ['A']
+"""Storage classes of the files kept in the read-through cache."""
+
+FILES_REST_S3_CLIENT_KWARGS = {}
+"""Keyword arguments of the S3 clients.
+
+Used by :func:`invenio_files_rest.storage.s3_storage_factory`, e.g.
+``dict(endpoint_url='https://s3.example.org', region_name='eu-west-1')``.
+Credentials are looked up like any ``boto3`` credentials unless given here.
+"""
+
+FILES_REST_S3_MAX_POOL_CONNECTIONS = 10
+"""Maximum number of keep-alive HTTP connections kept open per S3 bucket.
+
+Each bucket (i.e. location) gets its own client, whose connections are reused
+by all requests of the process. It should be at least the number of threads
+using the bucket at the same time.
+"""
+
+FILES_REST_S3_PART_SIZE = 8 * 1024 * 1024
+"""Part size of the multipart uploads of files saved in S3 (5 MiB minimum).
+
+Each part is spooled in memory before being uploaded.
+"""
+
+FILES_REST_CHECKSUM_WORKERS = 4
+"""Number of threads computing the tree checksum of an existing file.
+
+Tree checksum algorithms (e.g. ``sha256-tree-64M``, see
+:mod:`invenio_files_rest.treehash`) hash fixed size segments of a file
+independently, so verifying a large file can use several cores and parallel
+reads. ``1`` disables the parallel computation.
+"""
+
+FILES_REST_BUFFER_POOL_SIZE = None
+"""Total size in bytes of the buffers shared by all file transfers.
+
+If set, uploads and checksum computations read their chunks into reusable
+buffers taken from a pool of at most this size (per process), instead of
+allocating new memory for every chunk. When the pool is exhausted, transfers
+use smaller chunks and eventually wait for a buffer to be released. ``None``
+disables the pool, in which case each transfer allocates its own buffer.
+"""
+
+FILES_REST_BUFFER_POOL_MIN_CHUNK_SIZE = 64 * 1024
+"""Smallest chunk size used by transfers when the buffer pool is exhausted."""
+
+FILES_REST_DOWNLOAD_OFFLOAD_HEADER = None
+"""Header used to offload file downloads to the front-end web server.
+
+Set it to ``'X-Accel-Redirect'`` for nginx or ``'X-Sendfile'`` for Apache
+(mod_xsendfile). The application still performs the permission checks and
+sends all the other headers, but the file itself is sent by the web server.
+Only files with a URI matching :data:`FILES_REST_DOWNLOAD_OFFLOAD_PATHS` are
+offloaded.
+"""
+
+FILES_REST_DOWNLOAD_OFFLOAD_PATHS = {}
+"""Mapping of file URI prefixes to paths understood by the web server.
+
+For instance ``{'/data/files': '/protected-files'}`` sends the file
+``/data/files/12/34/5678/data`` as ``/protected-files/12/34/5678/data``. With
+nginx the path is an ``internal`` location, while with Apache it is a path on
+the file system (i.e. usually the prefix maps to itself).
+"""
 
 FILES_REST_PERMISSION_FACTORY = \
     'invenio_files_rest.permissions.permission_factory'
@@ -75,6 +308,17 @@ FILES_REST_FILE_URI_MAX_LEN = 255
    with PostgreSQL database.
 """
 
+FILES_REST_CONTENT_ADDRESSED_STORAGE = False
+"""Store the contents of objects once per checksum.
+
+If enabled, once the contents of an object have been saved (and hashed), the
+object is linked to an existing readable file instance with the same checksum,
+size and storage class in the same location, and the uploaded data is
+removed. Otherwise the data is moved to a path derived from its checksum, if
+the storage supports it (see
+:meth:`invenio_files_rest.storage.FileStorage.move`).
+"""
+
 FILES_REST_STORAGE_PATH_SPLIT_LENGTH = 2
 """Length of the filename that should be taken to create its root dir."""
 
@@ -111,6 +355,24 @@ FILES_REST_MULTIPART_CHUNKSIZE_MAX = 5 * 1024 * 1024 * 1024  # 5 GiB
 FILES_REST_MULTIPART_EXPIRES = timedelta(days=4)
 """Time delta after which a multipart upload is considered expired."""
 
+FILES_REST_MULTIPART_COMPOSITE_CHECKSUM = False
+"""Combine the checksums of the parts when merging a multipart upload.
+
+If enabled, the checksum of the merged file is computed from the checksums of
+its parts, so merging takes time proportional to the number of parts instead
+of the file size. The checksum is a tree checksum with the chunk size as
+segment size, e.g. ``md5-tree-5242880:<digest of the part digests>`` (see
+:mod:`invenio_files_rest.treehash`), and is verified like any other checksum.
+If disabled, the merged file is read again to compute its checksum.
+"""
+
+FILES_REST_MAX_LIST_KEYS = 1000
+"""Maximum number of objects and common prefixes in a page of a listing.
+
+Clients can request smaller pages with the ``max-keys`` query argument, and
+fetch the next page with the ``continuation-token`` query argument.
+"""
+
 FILES_REST_TASK_WAIT_INTERVAL = 2
 """Interval in seconds between sending a whitespace to not close connection."""
 
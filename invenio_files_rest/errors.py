@@ -23,6 +23,13 @@ class StorageError(FilesException):
     """Exception raised when a storage operation fails."""
 
 
+class InsufficientStorageError(StorageError):
+    """Exception raised when there is not enough space for a file."""
+
+    code = 507
+    description = "Not enough storage space for the file."
+
+
 class UnexpectedFileSizeError(StorageError):
     """Exception raised when a file does not match its expected size."""
 
@@ -30,6 +37,12 @@ class UnexpectedFileSizeError(StorageError):
     description = "Content-Length does not match file size."
 
 
+class ChecksumMismatchError(StorageError):
+    """Exception raised when copied data does not match its checksum."""
+
+    description = "Copied data does not match the checksum of the file."
+
+
 class InvalidOperationError(FilesException):
     """Exception raised when an invalid operation is performed."""
 
@@ -52,6 +65,13 @@ class MissingQueryParameter(FilesException):
         return self.description.format(arg_name=self.arg_name)
 
 
+class InvalidContinuationTokenError(FilesException):
+    """Exception raised when a listing continuation token is invalid."""
+
+    code = 400
+    description = "Invalid continuation token."
+
+
 class FileInstanceAlreadySetError(InvalidOperationError):
     """Exception raised when file instance already set on object."""
 
@@ -15,8 +15,12 @@ from werkzeug.exceptions import UnprocessableEntity
 from werkzeug.utils import cached_property
 
 from . import config
+from .buffers import BufferPool
 from .cli import files as files_cmd
 from .errors import MultipartNoPart
+from .storage.cache import StorageCache
+from .storage.pyfs import PyFSCache
+from .storage.s3 import S3ClientPool
 from .utils import load_or_import_from_config, obj_or_import_string
 
 
@@ -34,6 +38,48 @@ class _FilesRESTState(object):
             'FILES_REST_STORAGE_FACTORY', app=self.app
         )
 
+    @cached_property
+    def buffer_pool(self):
+        """Load the buffer pool shared by the file transfers."""
+        size = self.app.config.get('FILES_REST_BUFFER_POOL_SIZE')
+        if not size:
+            return None
+        return BufferPool(
+            size,
+            min_chunk_size=self.app.config[
+                'FILES_REST_BUFFER_POOL_MIN_CHUNK_SIZE'],
+        )
+
+    @cached_property
+    def fs_cache(self):
+        """Load the cache of opened PyFilesystem file systems."""
+        size = self.app.config.get('FILES_REST_STORAGE_FS_CACHE_SIZE')
+        if not size:
+            return None
+        return PyFSCache(size)
+
+    @cached_property
+    def s3_clients(self):
+        """Load the pool of S3 clients shared by the S3 storages."""
+        return S3ClientPool(
+            client_kwargs=self.app.config['FILES_REST_S3_CLIENT_KWARGS'],
+            max_pool_connections=self.app.config[
+                'FILES_REST_S3_MAX_POOL_CONNECTIONS'],
+        )
+
+    @cached_property
+    def storage_cache(self):
+        """Load the read-through cache of slow storage classes."""
+        uri = self.app.config.get('FILES_REST_STORAGE_CACHE_URI')
+        if not uri:
+            return None
+        return StorageCache(
+            uri,
+            self.app.config['FILES_REST_STORAGE_CACHE_SIZE'],
+            storage_classes=self.app.config[
+                'FILES_REST_STORAGE_CACHE_CLASSES'],
+        )
+
     @cached_property
     def permission_factory(self):
         """Load default permission factory for Buckets collections."""
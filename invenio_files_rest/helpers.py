@@ -14,12 +14,19 @@ import hashlib
 import mimetypes
 import os
 import unicodedata
+import uuid
+from calendar import timegm
+from functools import partial
 from time import time
 
-from flask import current_app, request
+from flask import current_app, has_app_context, request
 from werkzeug.datastructures import Headers
 from werkzeug.urls import url_quote
-from werkzeug.wsgi import FileWrapper
+from werkzeug.wsgi import FileWrapper, wrap_file
+
+from .buffers import read_into
+from .treehash import TreeHash, parse_tree_algorithm
+from .utils import obj_or_import_string
 
 MIMETYPE_TEXTFILES = {
     'readme'
@@ -61,9 +68,198 @@ def chunk_size_or_default(chunk_size):
     return chunk_size or 5 * 1024 * 1024  # 5MiB
 
 
+def has_fileno(stream):
+    """Check if a stream is backed by an operating system file descriptor.
+
+    :param stream: File-like object.
+    :returns: ``True`` if ``stream.fileno()`` returns a file descriptor.
+    """
+    try:
+        stream.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        # io.UnsupportedOperation is a subclass of both OSError and ValueError.
+        return False
+    return True
+
+
+def is_seekable(stream):
+    """Check if a stream supports random access.
+
+    :param stream: File-like object.
+    :returns: ``True`` if the stream can be seeked.
+    """
+    try:
+        return stream.seekable()
+    except AttributeError:
+        return hasattr(stream, 'seek')
+    except ValueError:
+        # Closed file.
+        return False
+
+
+def get_byte_ranges(size, etag=None, mtime=None):
+    """Get the byte ranges requested by the client (RFC 7233).
+
+    The ``Range`` header is ignored if it is malformed, if it is not a ``GET``
+    request, or if the ``If-Range`` precondition does not match the current
+    ``etag``/``mtime`` of the file.
+
+    :param size: The file size.
+    :param etag: The entity tag of the file.
+    :param mtime: A Unix timestamp that represents last modified time (UTC).
+    :returns: ``None`` if the full file should be sent, otherwise a list of
+        ``(start, stop)`` tuples (``stop`` is exclusive). An empty list means
+        that none of the requested ranges can be satisfied.
+    """
+    if request.method != 'GET' or size is None:
+        return None
+
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes':
+        return None
+
+    if 'If-Range' in request.headers:
+        if_range = request.if_range
+        if if_range.etag:
+            # Only strong validators may be used.
+            if request.headers['If-Range'].startswith('W/') or \
+                    if_range.etag != etag:
+                return None
+        elif if_range.date is None or mtime is None or \
+                timegm(if_range.date.utctimetuple()) != int(mtime):
+            return None
+
+    ranges = []
+    for begin, end in byte_range.ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size
+        else:
+            start, stop = begin, size if end is None else min(end, size)
+        if start < stop:
+            ranges.append((start, stop))
+
+    if ranges == [(0, size)]:
+        return None
+    return ranges
+
+
+def iter_byte_ranges(stream, ranges, chunk_size=None, preambles=None,
+                     epilogue=None):
+    """Iterate over the given byte ranges of a stream.
+
+    Only the requested bytes are read from the stream. The stream is closed
+    once the iterator is exhausted or closed.
+
+    :param stream: A seekable file-like object.
+    :param ranges: List of ``(start, stop)`` tuples.
+    :param chunk_size: Read at most size bytes from the file at a time.
+    :param preambles: Optional list of byte strings, sent before each range.
+    :param epilogue: Optional byte string, sent after the last range.
+    """
+    chunk_size = chunk_size_or_default(chunk_size)
+    try:
+        for i, (start, stop) in enumerate(ranges):
+            if preambles:
+                yield preambles[i]
+            stream.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        if epilogue:
+            yield epilogue
+    finally:
+        stream.close()
+
+
+def make_range_response(response, stream, size, ranges, chunk_size=None):
+    """Turn a full response into a partial (``206``/``416``) response.
+
+    :param response: The Flask response for the full file.
+    :param stream: The seekable file stream.
+    :param size: The file size.
+    :param ranges: List of ``(start, stop)`` tuples as returned by
+        :func:`get_byte_ranges`.
+    :param chunk_size: The chunk size.
+    :returns: The modified response.
+    """
+    # The Content-MD5 header always refers to the full file.
+    response.headers.pop('Content-MD5', None)
+
+    if not ranges:
+        stream.close()
+        response.response = []
+        response.status_code = 416
+        response.headers['Content-Range'] = 'bytes */{0}'.format(size)
+        response.headers['Content-Length'] = 0
+        return response
+
+    content_range = 'bytes {0}-{1}/{2}'
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response.response = iter_byte_ranges(
+            stream, ranges, chunk_size=chunk_size)
+        response.headers['Content-Range'] = content_range.format(
+            start, stop - 1, size)
+        response.headers['Content-Length'] = stop - start
+    else:
+        boundary = uuid.uuid4().hex
+        content_type = response.headers['Content-Type']
+        preambles = [
+            '--{0}\r\nContent-Type: {1}\r\nContent-Range: {2}\r\n\r\n'.format(
+                boundary, content_type,
+                content_range.format(start, stop - 1, size),
+            ).encode('latin-1') for start, stop in ranges
+        ]
+        # Each part but the first one is preceded by a CRLF.
+        preambles[1:] = [b'\r\n' + p for p in preambles[1:]]
+        epilogue = '\r\n--{0}--\r\n'.format(boundary).encode('latin-1')
+
+        response.response = iter_byte_ranges(
+            stream, ranges, chunk_size=chunk_size, preambles=preambles,
+            epilogue=epilogue)
+        response.headers['Content-Type'] = \
+            'multipart/byteranges; boundary={0}'.format(boundary)
+        response.headers['Content-Length'] = \
+            sum(len(p) for p in preambles) + len(epilogue) + \
+            sum(stop - start for start, stop in ranges)
+
+    response.status_code = 206
+    return response
+
+
+def get_offload_path(uri):
+    """Get the path used to offload the download of a file to the web server.
+
+    :param uri: The file URI.
+    :returns: The path as configured in
+        :data:`invenio_files_rest.config.FILES_REST_DOWNLOAD_OFFLOAD_PATHS` or
+        ``None`` if downloads of this file cannot be offloaded.
+    """
+    header = current_app.config['FILES_REST_DOWNLOAD_OFFLOAD_HEADER']
+    if not header or not uri:
+        return None
+
+    paths = current_app.config['FILES_REST_DOWNLOAD_OFFLOAD_PATHS']
+    # Longest prefix wins.
+    for prefix in sorted(paths, key=len, reverse=True):
+        base = prefix.rstrip('/') + '/'
+        if uri.startswith(base):
+            path = paths[prefix].rstrip('/') + '/' + uri[len(base):]
+            if header.lower() == 'x-accel-redirect':
+                path = url_quote(path, safe='/')
+            return path
+    return None
+
+
 def send_stream(stream, filename, size, mtime, mimetype=None, restricted=True,
                 as_attachment=False, etag=None, content_md5=None,
-                chunk_size=None, conditional=True, trusted=False):
+                chunk_size=None, conditional=True, trusted=False,
+                offload_path=None):
     """Send the contents of a file to the client.
 
     .. warning::
@@ -79,6 +275,15 @@ def send_stream(stream, filename, size, mtime, mimetype=None, restricted=True,
             3. Force the browser to download the file as an attachment
                (``as_attachment=True``).
 
+    .. note::
+
+        If ``stream`` is backed by a file descriptor (e.g. a file on the local
+        file system opened via
+        :class:`invenio_files_rest.storage.PyFSFileStorage`), it is passed to
+        the WSGI server's ``wsgi.file_wrapper``. Servers such as Gunicorn or
+        uWSGI will then send the file using ``sendfile()`` instead of copying
+        it through Python.
+
     :param stream: The file stream to send.
     :param filename: The file name.
     :param size: The file size.
@@ -91,13 +296,19 @@ def send_stream(stream, filename, size, mtime, mimetype=None, restricted=True,
     :param etag: If defined, it will be set as HTTP E-Tag.
     :param content_md5: If defined, a HTTP Content-MD5 header will be set.
     :param chunk_size: The chunk size.
-    :param conditional: Make the response conditional to the request.
-        (Default: ``True``)
+    :param conditional: Make the response conditional to the request. This
+        includes serving byte ranges requested via the HTTP ``Range`` header
+        if the stream is seekable. (Default: ``True``)
     :param trusted: Do not enable this option unless you know what you are
         doing. By default this function will send HTTP headers and MIME types
         that prevents your browser from rendering e.g. a HTML file which could
         contain a malicious script tag.
         (Default: ``False``)
+    :param offload_path: If defined, the file is not sent by the application.
+        Instead the path is set in the header configured in
+        :data:`invenio_files_rest.config.FILES_REST_DOWNLOAD_OFFLOAD_HEADER`
+        and the front-end web server sends the file. ``stream`` is ignored.
+        (Default: ``None``)
     :returns: A Flask response instance.
     """
     chunk_size = chunk_size_or_default(chunk_size)
@@ -110,7 +321,12 @@ def send_stream(stream, filename, size, mtime, mimetype=None, restricted=True,
 
     # Construct headers
     headers = Headers()
-    headers['Content-Length'] = size
+    if offload_path:
+        offload_header = current_app.config[
+            'FILES_REST_DOWNLOAD_OFFLOAD_HEADER']
+        headers[offload_header] = offload_path
+    else:
+        headers['Content-Length'] = size
     if content_md5:
         headers['Content-MD5'] = content_md5
 
@@ -148,8 +364,15 @@ def send_stream(stream, filename, size, mtime, mimetype=None, restricted=True,
         headers.add('Content-Disposition', 'inline')
 
     # Construct response object.
+    if offload_path:
+        body = []
+    elif has_fileno(stream):
+        body = wrap_file(request.environ, stream, buffer_size=chunk_size)
+    else:
+        body = FileWrapper(stream, buffer_size=chunk_size)
+
     rv = current_app.response_class(
-        FileWrapper(stream, buffer_size=chunk_size),
+        body,
         mimetype=mimetype,
         headers=headers,
         direct_passthrough=True,
@@ -173,6 +396,18 @@ def send_stream(stream, filename, size, mtime, mimetype=None, restricted=True,
 
     if conditional:
         rv = rv.make_conditional(request)
+        if offload_path:
+            # Byte ranges are served by the web server. Do not let it send
+            # the file if the request is e.g. answered with a 304.
+            if rv.status_code != 200:
+                del rv.headers[offload_header]
+        elif rv.status_code == 200 and size is not None and \
+                is_seekable(stream):
+            rv.headers['Accept-Ranges'] = 'bytes'
+            ranges = get_byte_ranges(size, etag=etag, mtime=mtime)
+            if ranges is not None:
+                rv = make_range_response(
+                    rv, stream, size, ranges, chunk_size=chunk_size)
 
     return rv
 
@@ -211,6 +446,60 @@ def make_path(base_uri, path, filename, path_dimensions, split_length):
     return os.path.join(base_uri, *uri_parts)
 
 
+def get_message_digest_factory(algo):
+    """Get the function creating message digest objects for an algorithm.
+
+    The algorithms are looked up in
+    :data:`invenio_files_rest.config.FILES_REST_CHECKSUM_ALGORITHMS`. Outside
+    of an application context, the algorithms of :mod:`hashlib` are used.
+    Tree algorithms (see :mod:`invenio_files_rest.treehash`) get a
+    :class:`invenio_files_rest.treehash.TreeHash` of the segment algorithm.
+
+    :param algo: The algorithm name.
+    :returns: A function returning an object with the ``update()`` and
+        ``hexdigest()`` methods.
+    :raises ValueError: If the algorithm is unknown.
+    """
+    tree = parse_tree_algorithm(algo)
+    if tree:
+        segment_algo, segment_size = tree
+        return partial(
+            TreeHash, get_message_digest_factory(segment_algo), segment_size)
+
+    if not has_app_context():
+        return partial(hashlib.new, algo)
+
+    factory = current_app.config['FILES_REST_CHECKSUM_ALGORITHMS'].get(algo)
+    if factory is None:
+        raise ValueError('Unknown checksum algorithm: {0}'.format(algo))
+    return obj_or_import_string(factory)
+
+
+def init_message_digest(algo):
+    """Create a message digest object for a checksum algorithm.
+
+    See :func:`get_message_digest_factory`.
+    """
+    return get_message_digest_factory(algo)()
+
+
+def get_checksum_algorithm(uri):
+    """Get the checksum algorithm used for new files.
+
+    :param uri: The file URI.
+    :returns: The algorithm configured in
+        :data:`invenio_files_rest.config.FILES_REST_LOCATION_CHECKSUM_ALGORITHMS`
+        for the location of the file, or else
+        :data:`invenio_files_rest.config.FILES_REST_CHECKSUM_ALGORITHM`.
+    """
+    algorithms = current_app.config['FILES_REST_LOCATION_CHECKSUM_ALGORITHMS']
+    # Longest prefix wins.
+    for prefix in sorted(algorithms, key=len, reverse=True):
+        if uri and uri.startswith(prefix.rstrip('/') + '/'):
+            return algorithms[prefix]
+    return current_app.config['FILES_REST_CHECKSUM_ALGORITHM']
+
+
 def compute_md5_checksum(stream, **kwargs):
     """Get helper method to compute MD5 checksum from a stream.
 
@@ -220,31 +509,53 @@ def compute_md5_checksum(stream, **kwargs):
     return compute_checksum(stream, 'md5', hashlib.md5(), **kwargs)
 
 
-def compute_checksum(stream, algo, message_digest, chunk_size=None,
-                     progress_callback=None):
+def compute_checksum(stream, algo, message_digest=None, chunk_size=None,
+                     progress_callback=None, buffer_pool=None, size=None,
+                     extra_digests=None):
     """Get helper method to compute checksum from a stream.
 
     :param stream: File-like object.
     :param algo: Identifier for checksum algorithm.
-    :param messsage_digest: A message digest instance.
+    :param message_digest: A message digest instance. If ``None``, it is
+        created with :func:`init_message_digest`.
     :param chunk_size: Read at most size bytes from the file at a time.
     :param progress_callback: Function accepting one argument with number
         of bytes read. (Default: ``None``)
+    :param buffer_pool: A :class:`invenio_files_rest.buffers.BufferPool` to
+        take the read buffer from. (Default: ``None``)
+    :param size: The stream size, if known. Used to avoid allocating a buffer
+        bigger than the stream.
+    :param extra_digests: Additional message digest objects updated with the
+        same data. (Default: ``None``)
     :returns: The checksum.
     """
-    chunk_size = chunk_size_or_default(chunk_size)
+    if message_digest is None:
+        message_digest = init_message_digest(algo)
 
-    bytes_read = 0
-    while 1:
-        chunk = stream.read(chunk_size)
-        if not chunk:
+    chunk_size = chunk_size_or_default(chunk_size)
+    if size:
+        chunk_size = min(chunk_size, size)
+
+    buf = buffer_pool.acquire(chunk_size) if buffer_pool \
+        else bytearray(chunk_size)
+    view = memoryview(buf)
+    try:
+        bytes_read = 0
+        while 1:
+            n = read_into(stream, buf)
+            if not n:
+                if progress_callback:
+                    progress_callback(bytes_read)
+                break
+            message_digest.update(view[:n])
+            for m in extra_digests or ():
+                m.update(view[:n])
+            bytes_read += n
             if progress_callback:
                 progress_callback(bytes_read)
-            break
-        message_digest.update(chunk)
-        bytes_read += len(chunk)
-        if progress_callback:
-            progress_callback(bytes_read)
+    finally:
+        if buffer_pool:
+            buffer_pool.release(buf)
     return "{0}:{1}".format(algo, message_digest.hexdigest())
 
 
@@ -22,6 +22,11 @@ The entities of this module consists of:
  * **File instance** - Identified by UUIDs. Represents a physical file on disk.
    The location of the file is specified via a URI. A file instance can have
    many object versions.
+ * **File instance checksums** - Identified uniquely with a file instance by
+   an algorithm. Used to store checksums in addition to the main checksum of
+   a file instance.
+ * **File instance segments** - Identified by their file instance and a
+   segment number. Used to store the segment checksums of tree checksums.
  * **Locations** - A bucket belongs to a specific location. Locations can be
    used to represent e.g. different storage systems and/or geographical
    locations.
@@ -48,17 +53,26 @@ import six
 from flask import current_app
 from invenio_db import db
 from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import Session, backref, joinedload, selectinload, \
+    validates
+from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql.expression import ColumnElement, _clone
 from sqlalchemy_utils.types import UUIDType
 
-from .errors import BucketLockedError, FileInstanceAlreadySetError, \
-    FileInstanceUnreadableError, FileSizeError, InvalidKeyError, \
-    InvalidOperationError, MultipartAlreadyCompleted, \
+from .errors import BucketLockedError, ChecksumMismatchError, \
+    FileInstanceAlreadySetError, FileInstanceUnreadableError, FileSizeError, \
+    InvalidKeyError, InvalidOperationError, MultipartAlreadyCompleted, \
     MultipartInvalidChunkSize, MultipartInvalidPartNumber, \
-    MultipartInvalidSize, MultipartMissingParts, MultipartNotCompleted
+    MultipartInvalidSize, MultipartMissingParts, MultipartNotCompleted, \
+    UnexpectedFileSizeError
+from .helpers import get_message_digest_factory, make_path
 from .proxies import current_files_rest
+from .treehash import TreeHash, parse_tree_algorithm
 from .utils import ENCODING_MIMETYPES, guess_mimetype
 
 slug_pattern = re.compile('^[a-z][a-z0-9-]+$')
@@ -100,6 +114,62 @@ def as_bucket_id(value):
     return value.id if isinstance(value, Bucket) else value
 
 
+class BinaryCollate(ColumnElement):
+    """Compare and sort a string column by code point.
+
+    Listings skip all the keys sharing a prefix by comparing keys, which
+    requires that the database sorts keys like Python does, whatever the
+    collation of the database. On MySQL, the key column itself has a binary
+    collation instead, so that its indexes can be used.
+    """
+
+    __visit_name__ = 'binary_collate'
+
+    def __init__(self, element):
+        """Initialize the expression."""
+        self.element = element
+        self.type = element.type
+
+    @property
+    def _from_objects(self):
+        return self.element._from_objects
+
+    def _copy_internals(self, clone=_clone, **kw):
+        self.element = clone(self.element, **kw)
+
+    def get_children(self, **kwargs):
+        """Get the column."""
+        return self.element,
+
+
+@compiles(BinaryCollate)
+def compile_binary_collate(element, compiler, **kw):
+    """Compare strings with the column collation (e.g. SQLite, MySQL)."""
+    return compiler.process(element.element, **kw)
+
+
+@compiles(BinaryCollate, 'postgresql')
+def compile_binary_collate_postgresql(element, compiler, **kw):
+    """Compare strings with the ``"C"`` collation on PostgreSQL."""
+    return '{0} COLLATE "C"'.format(compiler.process(element.element, **kw))
+
+
+db.Index.argument_for('mysql', 'nonunique', False)
+
+
+@compiles(CreateIndex, 'mysql')
+def compile_create_index_mysql(element, compiler, **kw):
+    """Create unique indexes with ``mysql_nonunique=True`` as plain indexes.
+
+    MySQL does not support partial indexes, so a partial unique index only
+    speeds up the lookups and does not enforce uniqueness.
+    """
+    sql = compiler.visit_create_index(element, **kw)
+    if element.element.dialect_options['mysql']['nonunique']:
+        sql = sql.replace('CREATE UNIQUE INDEX', 'CREATE INDEX', 1)
+    return sql
+
+
 def as_object_version(value):
     """Get an object version object from an object version ID or an object version.
 
@@ -129,7 +199,7 @@ def update_bucket_size(f):
     @wraps(f)
     def inner(self, *args, **kwargs):
         res = f(self, *args, **kwargs)
-        self.bucket.size += self.file.size
+        self.bucket.update_size(self.file.size)
         return res
     return inner
 
@@ -248,6 +318,59 @@ def timestamp_before_update(mapper, connection, target):
     target.updated = datetime.utcnow()
 
 
+def delete_after_commit(storage):
+    """Delete the data of a storage once the transaction is committed.
+
+    The data is kept if the transaction (or the savepoint) in which the
+    deletion was requested is rolled back.
+
+    :param storage: A :class:`invenio_files_rest.storage.FileStorage`.
+    """
+    session = db.session()
+    session.info.setdefault('files_rest_delete_after_commit', []).append(
+        (session.transaction, storage))
+
+
+@db.event.listens_for(Session, 'after_soft_rollback')
+def discard_rolled_back_deletions(session, previous_transaction):
+    """Forget data deletions requested in a rolled back transaction."""
+    pending = session.info.get('files_rest_delete_after_commit')
+    if not pending:
+        return
+
+    def rolled_back(transaction):
+        while transaction is not None:
+            if transaction is previous_transaction:
+                return True
+            transaction = transaction.parent
+        return False
+
+    session.info['files_rest_delete_after_commit'] = [
+        (t, s) for t, s in pending if not rolled_back(t)]
+
+
+@db.event.listens_for(Session, 'after_commit')
+def delete_committed_data(session):
+    """Delete the data requested for deletion in a committed transaction."""
+    if session.transaction is not None and session.transaction.nested:
+        return
+    for dummy, storage in session.info.pop(
+            'files_rest_delete_after_commit', []):
+        # The file instances are already removed, hence a failure only leaves
+        # dangling data behind.
+        try:
+            storage.delete()
+        except Exception:
+            current_app.logger.exception('Could not delete file data.')
+
+
+@db.event.listens_for(Session, 'after_transaction_end')
+def discard_pending_deletions(session, transaction):
+    """Forget data deletions left when a transaction ends uncommitted."""
+    if transaction.parent is None:
+        session.info.pop('files_rest_delete_after_commit', None)
+
+
 class Location(db.Model, Timestamp):
     """Model defining base locations."""
 
@@ -342,10 +465,10 @@ class Bucket(db.Model, Timestamp):
     """Default storage class."""
 
     size = db.Column(db.BigInteger, default=0, nullable=False)
-    """Size of bucket.
+    """Size of bucket, without the size deltas which are not folded yet.
 
     This is a computed property which can rebuilt any time from the objects
-    inside the bucket.
+    inside the bucket. See :meth:`get_size` for the current size.
     """
 
     quota_size = db.Column(
@@ -388,11 +511,48 @@ class Bucket(db.Model, Timestamp):
         """Return representation of location."""
         return str(self.id)
 
+    def get_size(self):
+        """Get the size of bucket, including the size deltas not folded yet.
+
+        The size and the deltas are read with a single query, so that the sum
+        is not affected by concurrent folds (see
+        :meth:`BucketSizeDelta.fold`).
+        """
+        if self.id is None:
+            return self.size or 0
+        return db.session.query(Bucket.size + db.select([
+            db.func.coalesce(db.func.sum(BucketSizeDelta.size), 0)
+        ]).where(BucketSizeDelta.bucket_id == Bucket.id).as_scalar()).filter(
+            Bucket.id == self.id).scalar()
+
+    def update_size(self, delta):
+        """Change the size of the bucket.
+
+        The change is appended to the ledger of size deltas instead of
+        updating the bucket, so that concurrent transactions changing the
+        size of the same bucket neither lock its row nor lose updates.
+
+        Only when the bucket has a quota, growing it locks the bucket row
+        until the end of the transaction, so that concurrent uploads checked
+        against the same size cannot together exceed the quota.
+
+        :param delta: The size change in bytes.
+        :raises invenio_files_rest.errors.FileSizeError: If the change exceeds
+            the quota of the bucket.
+        """
+        if delta > 0 and self.quota_size:
+            db.session.query(Bucket.id).filter(
+                Bucket.id == self.id).with_for_update().scalar()
+            if self.get_size() + delta > self.quota_size:
+                raise FileSizeError(description='Bucket quota exceeded.')
+        if delta:
+            db.session.add(BucketSizeDelta(bucket=self, size=delta))
+
     @property
     def quota_left(self):
         """Get how much space is left in the bucket."""
         if self.quota_size:
-            return max(self.quota_size - self.size, 0)
+            return max(self.quota_size - self.get_size(), 0)
 
     @property
     def size_limit(self):
@@ -562,10 +722,85 @@ class Bucket(db.Model, Timestamp):
             ObjectVersion.query.filter_by(
                 bucket_id=self.id
             ).delete()
+            BucketSizeDelta.query.filter_by(
+                bucket_id=self.id
+            ).delete()
             self.query.filter_by(id=self.id).delete()
         return self
 
 
+class BucketSizeDelta(db.Model):
+    """Model for storing the size changes of buckets.
+
+    The size changes of a bucket are appended to this ledger instead of
+    updating :attr:`Bucket.size` in place, and are periodically folded into
+    the bucket row (see :meth:`fold`).
+    """
+
+    __tablename__ = 'files_bucket_size_deltas'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'),
+                   primary_key=True, autoincrement=True)
+    """Delta identifier."""
+
+    bucket_id = db.Column(
+        UUIDType,
+        db.ForeignKey(Bucket.id, ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+    """Bucket identifier."""
+
+    size = db.Column(db.BigInteger, nullable=False)
+    """Size change in bytes (negative if the bucket shrinks)."""
+
+    bucket = db.relationship(Bucket)
+    """Relationship to the bucket."""
+
+    @classmethod
+    def fold(cls, bucket=None, batch_size=500):
+        """Fold the size deltas into the size of their buckets.
+
+        The deltas of each bucket are removed and added to the bucket row in
+        the same transaction. Deltas which are folded concurrently by another
+        transaction are left to it.
+
+        :param bucket: Only fold the deltas of this bucket (instance or ID).
+        :param batch_size: Maximum number of deltas removed per query.
+        :returns: The number of folded deltas.
+        """
+        query = cls.query.with_entities(cls.id, cls.bucket_id, cls.size)
+        if bucket is not None:
+            query = query.filter_by(bucket_id=as_bucket_id(bucket))
+        deltas = {}
+        for id_, bucket_id, size in query:
+            ids, total = deltas.get(bucket_id, ([], 0))
+            ids.append(id_)
+            deltas[bucket_id] = (ids, total + size)
+
+        folded = 0
+        # Buckets are always updated in the same order, to avoid deadlocks.
+        for bucket_id in sorted(deltas, key=str):
+            ids, total = deltas[bucket_id]
+            savepoint = db.session.begin_nested()
+            removed = sum(
+                cls.query.filter(
+                    cls.id.in_(ids[i:i + batch_size])
+                ).delete(synchronize_session=False)
+                for i in range(0, len(ids), batch_size)
+            )
+            if removed != len(ids):
+                # Folded concurrently.
+                savepoint.rollback()
+                continue
+            Bucket.query.filter_by(id=bucket_id).update(
+                {Bucket.size: Bucket.size + total},
+                synchronize_session=False)
+            savepoint.commit()
+            folded += removed
+        return folded
+
+
 class BucketTag(db.Model):
     """Model for storing tags associated to buckets.
 
@@ -686,12 +921,17 @@ class FileInstance(db.Model, Timestamp):
     file at the given URI. This is useful when e.g. copying a file instance.
     """
 
-    last_check_at = db.Column(db.DateTime, nullable=True)
+    last_check_at = db.Column(db.DateTime, nullable=True, index=True)
     """Timestamp of last fixity check."""
 
     last_check = db.Column(db.Boolean(name='last_check'), default=True)
     """Result of last fixity check."""
 
+    __table_args__ = (
+        # Lookup of the duplicates of a file.
+        db.Index('ix_files_files_checksum_size', 'checksum', 'size'),
+    )
+
     @validates('uri')
     def validate_uri(self, key, uri):
         """Validate uri."""
@@ -738,26 +978,79 @@ class FileInstance(db.Model, Timestamp):
            Normally you should use the Celery task to delete a file instance,
            as this method will not remove the file on disk.
         """
+        FileInstanceChecksum.query.filter_by(file_id=self.id).delete()
+        FileInstanceSegment.query.filter_by(file_id=self.id).delete()
         self.query.filter_by(id=self.id).delete()
         return self
 
+    @property
+    def checksums(self):
+        """Get all checksums of the file, by algorithm."""
+        checksums = dict(
+            (algo, c.checksum) for algo, c in self.extra_checksums.items())
+        if self.checksum:
+            checksums[self.checksum.split(':', 1)[0]] = self.checksum
+        return checksums
+
+    def set_extra_checksums(self, checksums):
+        """Set the checksums computed in addition to the main checksum.
+
+        :param checksums: Dictionary of checksums by algorithm. Checksums of
+            other algorithms are removed.
+        """
+        for algo in list(self.extra_checksums):
+            if algo not in checksums:
+                del self.extra_checksums[algo]
+        for algo, checksum in checksums.items():
+            if algo in self.extra_checksums:
+                self.extra_checksums[algo].checksum = checksum
+            else:
+                self.extra_checksums[algo] = FileInstanceChecksum(
+                    algorithm=algo, checksum=checksum)
+        return self
+
+    def set_segment_checksums(self, checksums):
+        """Set the segment checksums of a tree checksum.
+
+        :param checksums: List of the checksums of all segments.
+        """
+        del self.segments[len(checksums):]
+        for segment, checksum in zip(self.segments, checksums):
+            segment.checksum = checksum
+        for number in range(len(self.segments), len(checksums)):
+            self.segments.append(FileInstanceSegment(
+                number=number, checksum=checksums[number]))
+        return self
+
     def storage(self, **kwargs):
         """Get storage interface for object.
 
         Uses the applications storage factory to create a storage interface
         that can be used for this particular file instance.
 
+        Files of slow storage classes are read through the read-through
+        cache, if configured (see
+        :data:`invenio_files_rest.config.FILES_REST_STORAGE_CACHE_URI`).
+
         :returns: Storage interface.
         """
-        return current_files_rest.storage_factory(fileinstance=self, **kwargs)
+        storage = current_files_rest.storage_factory(
+            fileinstance=self, **kwargs)
+        if current_files_rest.storage_cache is not None:
+            storage = current_files_rest.storage_cache.wrap(
+                self, storage, **kwargs)
+        return storage
 
     @ensure_readable()
     def update_checksum(self, progress_callback=None, chunk_size=None,
                         checksum_kwargs=None, **kwargs):
         """Update checksum based on file."""
-        self.checksum = self.storage(**kwargs).checksum(
+        storage = self.storage(**kwargs)
+        self.checksum = storage.checksum(
             progress_callback=progress_callback, chunk_size=chunk_size,
             **(checksum_kwargs or {}))
+        self.set_extra_checksums(storage.extra_checksums)
+        self.set_segment_checksums(storage.segment_checksums)
 
     def clear_last_check(self):
         """Clear the checksum of the file."""
@@ -777,28 +1070,82 @@ class FileInstance(db.Model, Timestamp):
             performed.
         :param dict checksum_kwargs: Passed as `**kwargs`` to
             ``storage().checksum``.
+
+        The stored additional checksums computed by the storage are verified
+        as well. Missing data is reported as a checksum mismatch.
         """
+        size_mismatch = False
         try:
-            real_checksum = self.storage(**kwargs).checksum(
+            storage = self.storage(**kwargs)
+            real_checksum = storage.checksum(
                 progress_callback=progress_callback, chunk_size=chunk_size,
                 **(checksum_kwargs or {}))
+        except UnexpectedFileSizeError as exc:
+            current_app.logger.warning(str(exc))
+            real_checksum = None
+            size_mismatch = True
         except Exception as exc:
             current_app.logger.exception(str(exc))
             if throws:
                 raise
             real_checksum = None
         with db.session.begin_nested():
-            self.last_check = (None if real_checksum is None
-                               else (self.checksum == real_checksum))
+            if size_mismatch:
+                self.last_check = False
+            elif real_checksum is None:
+                self.last_check = None
+            else:
+                self.last_check = self.checksum == real_checksum and all(
+                    self.extra_checksums[algo].checksum == checksum
+                    for algo, checksum in storage.extra_checksums.items()
+                    if algo in self.extra_checksums
+                )
             self.last_check_at = datetime.utcnow()
         return self.last_check
 
+    def verify_segments(self, offset=0, length=None, chunk_size=None,
+                        **kwargs):
+        """Verify a byte range of the file with its segment checksums.
+
+        Only the segments overlapping the range are read. If one of them does
+        not match its checksum, the file is marked as corrupted
+        (``last_check`` is set to ``False``).
+
+        :param offset: Start of the byte range.
+        :param length: Length of the byte range (by default until the end of
+            the file).
+        :returns: List of the numbers of the segments which do not match their
+            checksum, or ``None`` if the file has no segment checksums.
+        """
+        if not self.segments:
+            return None
+        segment_size = parse_tree_algorithm(
+            self.checksum.split(':', 1)[0])[1]
+        end = self.size if length is None else min(self.size, offset + length)
+        numbers = list(range(
+            offset // segment_size,
+            (end + segment_size - 1) // segment_size,
+        )) if end > offset else []
+
+        checksums = self.storage(**kwargs).checksum_segments(
+            numbers, chunk_size=chunk_size)
+        mismatches = [
+            number for number, checksum in zip(numbers, checksums)
+            if checksum != self.segments[number].checksum
+        ]
+        if mismatches:
+            with db.session.begin_nested():
+                self.last_check = False
+                self.last_check_at = datetime.utcnow()
+        return mismatches
+
     @ensure_writable()
     def init_contents(self, size=0, **kwargs):
         """Initialize file."""
         self.set_uri(
             *self.storage(**kwargs).initialize(size=size),
-            readable=False, writable=True)
+            readable=False, writable=True,
+            storage_class=kwargs.get('default_storage_class'))
 
     @ensure_writable()
     def update_contents(self, stream, seek=0, size=None, chunk_size=None,
@@ -810,6 +1157,8 @@ class FileInstance(db.Model, Timestamp):
         :param stream: File-like stream.
         """
         self.checksum = None
+        self.set_extra_checksums({})
+        self.set_segment_checksums([])
         return self.storage(**kwargs).update(
             stream, seek=seek, size=size, chunk_size=chunk_size,
             progress_callback=progress_callback
@@ -824,25 +1173,150 @@ class FileInstance(db.Model, Timestamp):
             from.
         :param stream: File-like stream.
         """
+        storage = self.storage(**kwargs)
         self.set_uri(
-            *self.storage(**kwargs).save(
+            *storage.save(
                 stream, chunk_size=chunk_size, size=size,
-                size_limit=size_limit, progress_callback=progress_callback))
+                size_limit=size_limit, progress_callback=progress_callback),
+            storage_class=kwargs.get('default_storage_class'),
+            extra_checksums=storage.extra_checksums,
+            segment_checksums=storage.segment_checksums)
 
     @ensure_writable()
     def copy_contents(self, fileinstance, progress_callback=None,
-                      chunk_size=None, **kwargs):
-        """Copy this file instance into another file instance."""
+                      chunk_size=None, fixity_check=False, **kwargs):
+        """Copy this file instance into another file instance.
+
+        :param fixity_check: Verify the checksums computed while copying the
+            data against the checksums of the source file instance, and record
+            the result as the last check of both file instances. The data is
+            then always read, so the fixity check does not need to read the
+            copy again. If the source file instance has no checksum, the
+            computed checksum is recorded on it instead of being verified.
+        :raises invenio_files_rest.errors.ChecksumMismatchError: If the fixity
+            check fails. The copied data is removed.
+        """
         if not fileinstance.readable:
             raise ValueError('Source file instance is not readable.')
         if not self.size == 0:
             raise ValueError('File instance has data.')
 
-        self.set_uri(
-            *self.storage(**kwargs).copy(
-                fileinstance.storage(**kwargs),
-                chunk_size=chunk_size,
-                progress_callback=progress_callback))
+        # Keep the storage class of the source file by default.
+        kwargs.setdefault('default_storage_class', fileinstance.storage_class)
+        storage = self.storage(**kwargs)
+        uri, size, checksum = storage.copy(
+            fileinstance.storage(**kwargs),
+            chunk_size=chunk_size,
+            progress_callback=progress_callback,
+            allow_fast_copy=not fixity_check)
+        if fixity_check and fileinstance.checksum is None:
+            # Nothing to verify the data against.
+            with db.session.begin_nested():
+                fileinstance.checksum = checksum
+        elif fixity_check:
+            with db.session.begin_nested():
+                fileinstance.last_check = \
+                    fileinstance.checksum == checksum and all(
+                        fileinstance.extra_checksums[algo].checksum == value
+                        for algo, value in storage.extra_checksums.items()
+                        if algo in fileinstance.extra_checksums
+                    )
+                fileinstance.last_check_at = datetime.utcnow()
+            if not fileinstance.last_check:
+                storage.delete()
+                raise ChecksumMismatchError(
+                    description='Checksum mismatch while copying file {0} '
+                    '({1} != {2}).'.format(
+                        fileinstance.id, checksum, fileinstance.checksum))
+            self.last_check = True
+            self.last_check_at = fileinstance.last_check_at
+
+        if checksum is None:
+            # The data was copied without reading it.
+            self.set_uri(
+                uri, size, fileinstance.checksum,
+                storage_class=kwargs.get('default_storage_class'),
+                extra_checksums=dict(
+                    (algo, c.checksum)
+                    for algo, c in fileinstance.extra_checksums.items()),
+                segment_checksums=[s.checksum for s in fileinstance.segments])
+        else:
+            self.set_uri(
+                uri, size, checksum,
+                storage_class=kwargs.get('default_storage_class'),
+                extra_checksums=storage.extra_checksums,
+                segment_checksums=storage.segment_checksums)
+
+    @ensure_readable()
+    def deduplicate(self, default_location, **kwargs):
+        """Replace the file by an existing file with the same contents.
+
+        If a readable file instance with the same checksum, size and storage
+        class exists in the given location, it is locked until the end of the
+        transaction and returned, and the data of this file is removed once
+        the transaction is committed. Otherwise the data is moved to a path
+        derived from the checksum, if the storage supports it.
+
+        .. note::
+
+           The caller is responsible for replacing this file instance by the
+           returned one and for deleting this file instance.
+
+        :param default_location: The URI of the location of the file.
+        :returns: The file instance with the contents of this file.
+        """
+        if not self.checksum:
+            return self
+
+        base_uri = default_location.rstrip('/') + '/'
+        storage = self.storage(default_location=default_location, **kwargs)
+        duplicates = self.query.filter(
+            FileInstance.id != self.id,
+            FileInstance.checksum == self.checksum,
+            FileInstance.size == self.size,
+            FileInstance.storage_class == self.storage_class,
+            FileInstance.readable.is_(True),
+        )
+        for f in duplicates:
+            if not (f.uri and f.uri.startswith(base_uri)):
+                continue
+            # Lock the duplicate so that it is not removed before the
+            # reference to it is committed.
+            f = duplicates.filter(FileInstance.id == f.id) \
+                .with_for_update().one_or_none()
+            if f is not None:
+                delete_after_commit(storage)
+                return f
+
+        uri = make_path(
+            default_location,
+            self.checksum.split(':', 1)[1],
+            basename(self.uri),
+            current_app.config['FILES_REST_STORAGE_PATH_DIMENSIONS'],
+            current_app.config['FILES_REST_STORAGE_PATH_SPLIT_LENGTH'],
+        )
+        if self.uri == uri:
+            return self
+
+        # Claim the path before moving the data, so that a concurrent upload
+        # of the same contents waits for this transaction and reuses its file.
+        old_uri = self.uri
+        try:
+            with db.session.begin_nested():
+                self.uri = uri
+        except IntegrityError:
+            f = duplicates.filter(FileInstance.uri == uri) \
+                .with_for_update().one_or_none()
+            if f is not None:
+                delete_after_commit(storage)
+                return f
+            return self
+
+        try:
+            self.uri = storage.move(uri)
+        except NotImplementedError:
+            self.uri = old_uri
+        return self
 
     @ensure_readable()
     def send_file(self, filename, restricted=True, mimetype=None,
@@ -860,11 +1334,14 @@ class FileInstance(db.Model, Timestamp):
         )
 
     def set_uri(self, uri, size, checksum, readable=True, writable=False,
-                storage_class=None):
+                storage_class=None, extra_checksums=None,
+                segment_checksums=None):
         """Set a location of a file."""
         self.uri = uri
         self.size = size
         self.checksum = checksum
+        self.set_extra_checksums(extra_checksums or {})
+        self.set_segment_checksums(segment_checksums or [])
         self.writable = writable
         self.readable = readable
         self.storage_class = \
@@ -874,6 +1351,76 @@ class FileInstance(db.Model, Timestamp):
         return self
 
 
+class FileInstanceChecksum(db.Model):
+    """Model for storing additional checksums of a file instance.
+
+    The main checksum of a file instance is stored in
+    :attr:`FileInstance.checksum`, while checksums computed with other
+    algorithms in the same pass over the data are stored here, one per
+    algorithm.
+    """
+
+    __tablename__ = 'files_files_checksums'
+
+    file_id = db.Column(
+        UUIDType,
+        db.ForeignKey(FileInstance.id, ondelete='CASCADE'),
+        primary_key=True,
+    )
+    """File instance identifier."""
+
+    algorithm = db.Column(db.String(20), primary_key=True)
+    """Checksum algorithm."""
+
+    checksum = db.Column(db.String(255), nullable=False, index=True)
+    """String representing the checksum (``<algorithm>:<value>``)."""
+
+    file = db.relationship(
+        FileInstance,
+        backref=backref(
+            'extra_checksums',
+            collection_class=attribute_mapped_collection('algorithm'),
+            cascade='all, delete-orphan',
+        ),
+    )
+    """Relationship to file instance."""
+
+
+class FileInstanceSegment(db.Model):
+    """Model for storing the segment checksums of a file instance.
+
+    Tree checksums (see :mod:`invenio_files_rest.treehash`) hash a file in
+    segments of a fixed size. The segment checksums are kept, so that parts
+    of a file can be verified without reading the whole file (see
+    :meth:`FileInstance.verify_segments`).
+    """
+
+    __tablename__ = 'files_files_segments'
+
+    file_id = db.Column(
+        UUIDType,
+        db.ForeignKey(FileInstance.id, ondelete='CASCADE'),
+        primary_key=True,
+    )
+    """File instance identifier."""
+
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    """Segment number (starting from 0)."""
+
+    checksum = db.Column(db.String(255), nullable=False)
+    """String representing the checksum of the segment."""
+
+    file = db.relationship(
+        FileInstance,
+        backref=backref(
+            'segments',
+            order_by=number,
+            cascade='all, delete-orphan',
+        ),
+    )
+    """Relationship to file instance."""
+
+
 class ObjectVersion(db.Model, Timestamp):
     """Model for storing versions of objects.
 
@@ -906,7 +1453,8 @@ class ObjectVersion(db.Model, Timestamp):
     """Identifier for the specific version of an object."""
 
     key = db.Column(
-        db.Text().with_variant(mysql.VARCHAR(255), 'mysql'), nullable=False)
+        db.Text().with_variant(mysql.VARCHAR(255, binary=True), 'mysql'),
+        nullable=False)
     """Key identifying the object."""
 
     bucket_id = db.Column(
@@ -917,7 +1465,8 @@ class ObjectVersion(db.Model, Timestamp):
 
     file_id = db.Column(
         UUIDType,
-        db.ForeignKey(FileInstance.id, ondelete='RESTRICT'), nullable=True)
+        db.ForeignKey(FileInstance.id, ondelete='RESTRICT'), nullable=True,
+        index=True)
     """File instance for this object version.
 
     A null value in this column defines that the object has been deleted.
@@ -943,6 +1492,16 @@ class ObjectVersion(db.Model, Timestamp):
 
     __table_args__ = (
         db.UniqueConstraint('bucket_id', 'version_id', 'key'),
+        # Lookup of the head of an object, which also ensures that an object
+        # has at most one head (except on MySQL).
+        db.Index(
+            'uidx_files_object_bucket_id_key_head',
+            'bucket_id', 'key',
+            unique=True,
+            postgresql_where=is_head.is_(True),
+            sqlite_where=is_head.is_(True),
+            mysql_nonunique=True,
+        ),
     )
 
     @validates('key')
@@ -986,7 +1545,6 @@ class ObjectVersion(db.Model, Timestamp):
         return self.file_id is None
 
     @ensure_no_file()
-    @update_bucket_size
     def set_contents(self, stream, chunk_size=None, size=None, size_limit=None,
                      progress_callback=None):
         """Save contents of stream to file instance.
@@ -1010,6 +1568,19 @@ class ObjectVersion(db.Model, Timestamp):
             default_storage_class=self.bucket.default_storage_class,
         )
 
+        try:
+            self.bucket.update_size(self.file.size)
+        except FileSizeError:
+            # Nothing else refers to the data of the rejected file yet.
+            self.file.storage().delete()
+            raise
+
+        if current_app.config['FILES_REST_CONTENT_ADDRESSED_STORAGE']:
+            fileinstance = self.file.deduplicate(self.bucket.location.uri)
+            if fileinstance is not self.file:
+                duplicate, self.file = self.file, fileinstance
+                duplicate.delete()
+
         return self
 
     @ensure_no_file()
@@ -1113,7 +1684,7 @@ class ObjectVersion(db.Model, Timestamp):
         """
         with db.session.begin_nested():
             if self.file_id:
-                self.bucket.size -= self.file.size
+                self.bucket.update_size(-self.file.size)
             self.query.filter_by(
                 bucket_id=self.bucket_id,
                 key=self.key,
@@ -1209,7 +1780,8 @@ class ObjectVersion(db.Model, Timestamp):
 
         order = cls.created.desc() if desc else cls.created.asc()
 
-        return cls.query.filter(*filters).order_by(cls.key, order)
+        return cls.query_with_relationships().filter(*filters).order_by(
+            cls.key, order)
 
     @classmethod
     def delete(cls, bucket, key):
@@ -1250,7 +1822,96 @@ class ObjectVersion(db.Model, Timestamp):
         if not with_deleted:
             filters.append(cls.file_id.isnot(None))
 
-        return cls.query.filter(*filters).order_by(cls.key, cls.created.desc())
+        return cls.query_with_relationships().filter(*filters).order_by(
+            BinaryCollate(cls.key), cls.created.desc(), cls.version_id.desc())
+
+    @classmethod
+    def query_with_relationships(cls):
+        """Get a query loading the file instances and tags of the objects.
+
+        The file instances are joined, and the tags are loaded for all the
+        objects with one extra query, instead of one query per object when
+        they are accessed (e.g. when serializing a listing).
+        """
+        return cls.query.options(
+            joinedload(cls.file), selectinload(cls.tags))
+
+    @classmethod
+    def get_page(cls, bucket, prefix=None, delimiter=None, max_keys=1000,
+                 marker=None, versions=False, with_deleted=False):
+        """Fetch a page of the objects in a bucket.
+
+        Pages are fetched with keyset pagination on the listing order (key,
+        newest version first), so fetching a page costs the same whatever its
+        position in the bucket.
+
+        Keys containing the delimiter after the prefix are rolled up into a
+        single common prefix (up to and including the delimiter). The keys of
+        a common prefix are skipped in the fetched rows, and by seeking past
+        the prefix if they fill them. This assumes that keys sharing a prefix
+        are sorted together, hence keys are compared by code point whatever
+        the collation of the database.
+
+        :param bucket: The bucket (instance or id) to query.
+        :param prefix: Only fetch the objects with keys starting with prefix.
+        :param delimiter: Roll up the keys containing the delimiter.
+        :param max_keys: Maximum number of objects and common prefixes.
+        :param marker: The marker of the previous page, if any.
+        :param versions: Select all versions if True, only heads otherwise.
+        :param with_deleted: Select also deleted objects if True.
+        :returns: A tuple ``(objects, common_prefixes, next_marker)``, where
+            ``next_marker`` is ``None`` on the last page. A marker is a
+            ``(key, created, version_id)`` tuple of the last object of a page,
+            or a ``(common_prefix, None, None)`` tuple.
+        """
+        query = cls.get_by_bucket(
+            bucket, versions=versions, with_deleted=with_deleted)
+        key_column = BinaryCollate(cls.key)
+        prefix = prefix or ''
+        if prefix:
+            query = query.filter(
+                key_column >= prefix,
+                cls.key.startswith(prefix, autoescape=True))
+
+        objects = []
+        common_prefixes = []
+        while True:
+            filtered = query
+            if marker is not None:
+                key, created, version_id = marker
+                if created is None:
+                    # Skip all the keys starting with a common prefix.
+                    filtered = query.filter(
+                        key_column >= key[:-1] + six.unichr(ord(key[-1]) + 1))
+                else:
+                    # The leading range condition lets the database seek in
+                    # the listing index.
+                    filtered = query.filter(key_column >= key, db.or_(
+                        key_column > key,
+                        db.and_(key_column == key, db.or_(
+                            cls.created < created,
+                            db.and_(cls.created == created,
+                                    cls.version_id < version_id)))))
+
+            limit = max_keys - len(objects) - len(common_prefixes) + 1
+            rows = filtered.limit(limit).all()
+            for obj in rows:
+                if common_prefixes and marker[1] is None and \
+                        obj.key.startswith(marker[0]):
+                    continue
+                if len(objects) + len(common_prefixes) == max_keys:
+                    return objects, common_prefixes, marker
+                index = obj.key.find(delimiter, len(prefix)) \
+                    if delimiter else -1
+                if index != -1:
+                    common_prefix = obj.key[:index + len(delimiter)]
+                    common_prefixes.append(common_prefix)
+                    marker = (common_prefix, None, None)
+                else:
+                    objects.append(obj)
+                    marker = (obj.key, obj.created, obj.version_id)
+            if len(rows) < limit:
+                return objects, common_prefixes, None
 
     @classmethod
     def relink_all(cls, old_file, new_file):
@@ -1282,6 +1943,16 @@ class ObjectVersion(db.Model, Timestamp):
         return not self.__eq__(other=other)
 
 
+# Listing order of the objects of a bucket.
+db.Index(
+    'ix_files_object_bucket_id_key_created_version_id',
+    ObjectVersion.__table__.c.bucket_id,
+    BinaryCollate(ObjectVersion.__table__.c.key),
+    ObjectVersion.__table__.c.created.desc(),
+    ObjectVersion.__table__.c.version_id.desc(),
+)
+
+
 class ObjectVersionTag(db.Model):
     """Model for storing tags associated to object versions.
 
@@ -1416,7 +2087,8 @@ class MultipartObject(db.Model, Timestamp):
 
     file_id = db.Column(
         UUIDType,
-        db.ForeignKey(FileInstance.id, ondelete='RESTRICT'), nullable=False)
+        db.ForeignKey(FileInstance.id, ondelete='RESTRICT'), nullable=False,
+        index=True)
     """File instance for this multipart object."""
 
     chunk_size = db.Column(db.Integer, nullable=True)
@@ -1491,16 +2163,59 @@ class MultipartObject(db.Model, Timestamp):
         if Part.count(self) != self.last_part_number + 1:
             raise MultipartMissingParts()
 
+        self.file.storage().complete()
         with db.session.begin_nested():
             self.completed = True
             self.file.readable = True
             self.file.writable = False
         return self
 
+    def get_composite_checksum(self):
+        """Get the checksum of the file from the checksums of its parts.
+
+        The checksum is a tree checksum (see
+        :mod:`invenio_files_rest.treehash`) with the chunk size as segment
+        size and the part checksums as segment checksums. It can thus be
+        verified like any other checksum.
+
+        :returns: A tuple with the checksum and the list of part checksums, or
+            ``None`` if the parts do not all have a checksum of the same
+            (non-tree) algorithm.
+        """
+        checksums = [p.checksum for p in Part.query_by_multipart(
+            self).order_by(Part.part_number)]
+        algos = set(c.split(':', 1)[0] if c else None for c in checksums)
+        if len(algos) != 1:
+            return None
+        algo = algos.pop()
+        if algo is None or parse_tree_algorithm(algo):
+            return None
+
+        m = TreeHash(get_message_digest_factory(algo), self.chunk_size)
+        m.segments = [c.split(':', 1)[1] for c in checksums]
+        return '{0}-tree-{1}:{2}'.format(
+            algo, self.chunk_size, m.hexdigest()), checksums
+
     @ensure_completed()
     def merge_parts(self, version_id=None, **kwargs):
-        """Merge parts into object version."""
-        self.file.update_checksum(**kwargs)
+        """Merge parts into object version.
+
+        If ``FILES_REST_MULTIPART_COMPOSITE_CHECKSUM`` is enabled, the
+        checksum of the file is combined from the checksums of the parts
+        (see :meth:`get_composite_checksum`) instead of reading the whole
+        file again.
+        """
+        composite = None
+        if current_app.config['FILES_REST_MULTIPART_COMPOSITE_CHECKSUM'] and \
+                not self.file.storage().extra_checksum_algorithms:
+            composite = self.get_composite_checksum()
+        if composite:
+            checksum, part_checksums = composite
+            self.file.checksum = checksum
+            self.file.set_extra_checksums({})
+            self.file.set_segment_checksums(part_checksums)
+        else:
+            self.file.update_checksum(**kwargs)
         with db.session.begin_nested():
             obj = ObjectVersion.create(
                 self.bucket,
@@ -1514,7 +2229,7 @@ class MultipartObject(db.Model, Timestamp):
     def delete(self):
         """Delete a multipart object."""
         # Update bucket size.
-        self.bucket.size -= self.size
+        self.bucket.update_size(-self.size)
         # Remove parts
         Part.query_by_multipart(self).delete()
         # Remove self
@@ -1555,13 +2270,14 @@ class MultipartObject(db.Model, Timestamp):
                 completed=False,
                 file=file_,
             )
-            bucket.size += size
+            bucket.update_size(size)
             db.session.add(obj)
-        file_.init_contents(
-            size=size,
-            default_location=bucket.location.uri,
-            default_storage_class=bucket.default_storage_class,
-        )
+            # Failures (e.g. not enough disk space) roll back the upload.
+            file_.init_contents(
+                size=size,
+                default_location=bucket.location.uri,
+                default_storage_class=bucket.default_storage_class,
+            )
         return obj
 
     @classmethod
@@ -1712,7 +2428,10 @@ class Part(db.Model, Timestamp):
 
 __all__ = (
     'Bucket',
+    'BucketSizeDelta',
     'FileInstance',
+    'FileInstanceChecksum',
+    'FileInstanceSegment',
     'Location',
     'MultipartObject',
     'ObjectVersion',
@@ -106,8 +106,23 @@ class ObjectVersionSchema(BaseSchema):
             bucket = self.context.get('bucket')
             if bucket:
                 data.update(BucketSchema().dump(bucket).data)
+            common_prefixes = self.context.get('common_prefixes')
+            if common_prefixes is not None:
+                data['common_prefixes'] = common_prefixes
+            token = self.context.get('next_continuation_token')
+            if token:
+                data['next_continuation_token'] = token
+                if bucket:
+                    data['links']['next'] = self.dump_next_link(token)
             return data
 
+    def dump_next_link(self, token):
+        """Dump the link of the next page of a listing."""
+        args = request.args.to_dict()
+        args['continuation-token'] = token
+        return url_for(request.endpoint, _external=True,
+                       **dict(request.view_args, **args))
+
 
 class MultipartObjectSchema(BaseSchema):
     """Schema for ObjectVersions."""
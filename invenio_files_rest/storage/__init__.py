@@ -11,10 +11,21 @@
 from __future__ import absolute_import, print_function
 
 from .base import FileStorage
-from .pyfs import PyFSFileStorage, pyfs_storage_factory
+from .local import LocalFileStorage, local_storage_factory
+from .pyfs import PyFSCache, PyFSFileStorage, pyfs_storage_factory
+from .s3 import S3ClientPool, S3FileStorage, s3_storage_factory
+from .segmented import SegmentedFileStorage, segmented_storage_factory
 
 __all__ = (
     'FileStorage',
+    'local_storage_factory',
+    'LocalFileStorage',
+    'PyFSCache',
     'pyfs_storage_factory',
     'PyFSFileStorage',
+    'S3ClientPool',
+    's3_storage_factory',
+    'S3FileStorage',
+    'segmented_storage_factory',
+    'SegmentedFileStorage',
 )
@@ -10,12 +10,24 @@
 
 from __future__ import absolute_import, print_function
 
-import hashlib
+import ctypes
+import errno
+import mmap
+import os
+import sys
+import threading
 from calendar import timegm
 from functools import partial
 
-from ..errors import FileSizeError, StorageError, UnexpectedFileSizeError
-from ..helpers import chunk_size_or_default, compute_checksum, send_stream
+import six
+from six.moves import queue
+
+from ..buffers import read_into
+from ..errors import FileSizeError, InsufficientStorageError, StorageError, \
+    UnexpectedFileSizeError
+from ..helpers import chunk_size_or_default, compute_checksum, has_fileno, \
+    init_message_digest, send_stream
+from ..treehash import TreeHash, parse_tree_algorithm
 
 
 def check_sizelimit(size_limit, bytes_written, total_size):
@@ -53,13 +65,429 @@ def check_size(bytes_written, total_size):
             description='File is smaller than expected.')
 
 
+def preallocate(fp, size):
+    """Allocate the disk space of a file.
+
+    Uses ``posix_fallocate()``, so that the file is not sparse and later
+    (possibly parallel) writes do not fragment it. If the file system does
+    not support it, only checks that there is enough free space.
+
+    :param fp: File object, with a file descriptor.
+    :param size: The file size.
+    :returns: ``True`` if the space was allocated.
+    :raises invenio_files_rest.errors.InsufficientStorageError: If there is
+        not enough space on the device (or the file system does not support
+        files of this size).
+    """
+    if not has_fileno(fp):
+        return False
+    fd = fp.fileno()
+
+    fallocate = getattr(os, 'posix_fallocate', None)
+    if fallocate is not None:
+        try:
+            fallocate(fd, 0, size)
+            return True
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EFBIG):
+                raise InsufficientStorageError()
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+                raise
+
+    # Fallback: keep the file sparse, but fail early if it cannot fit.
+    try:
+        st = os.fstatvfs(fd)
+    except (AttributeError, OSError):
+        return False
+    if st.f_bavail * st.f_frsize < size:
+        raise InsufficientStorageError()
+    return False
+
+
+FICLONE = 0x40049409
+"""Linux ``ioctl()`` request cloning a file (reflink)."""
+
+
+def fast_copy(src_path, dst_path, methods):
+    """Copy a local file without reading it through Python.
+
+    The methods are tried in order, until one is supported by the platform
+    and the file system:
+
+    * ``'link'``: hard link the destination to the source.
+    * ``'reflink'``: clone the source with the ``FICLONE`` ioctl (e.g. on
+      Btrfs or XFS), so that both files share their data blocks until
+      modified.
+    * ``'copy_file_range'``: copy the data in the kernel (Python 3.8+), which
+      network file systems may perform on the server.
+
+    :param src_path: The source path.
+    :param dst_path: The destination path.
+    :param methods: List of method names.
+    :returns: ``True`` if the file was copied.
+    """
+    for method in methods:
+        try:
+            if method == 'link':
+                if os.path.exists(dst_path):
+                    os.remove(dst_path)
+                os.link(src_path, dst_path)
+                return True
+            with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                if method == 'reflink':
+                    import fcntl
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return True
+                elif method == 'copy_file_range':
+                    remaining = os.fstat(src.fileno()).st_size
+                    while remaining:
+                        n = os.copy_file_range(
+                            src.fileno(), dst.fileno(), remaining)
+                        if not n:
+                            break
+                        remaining -= n
+                    if not remaining:
+                        return True
+        except (AttributeError, ImportError, IOError, OSError):
+            # Not supported, try the next method.
+            pass
+    return False
+
+
+SCAN_ADVICE_WINDOW = 8 * 1024 * 1024
+"""Size of the ranges read ahead and dropped from the page cache by
+:class:`ScanFile` (a multiple of :data:`mmap.PAGESIZE`)."""
+
+
+def fadvise(fd, offset, length, advice):
+    """Give the kernel a hint on the access pattern of a file range.
+
+    :param fd: The file descriptor.
+    :param offset: The range offset.
+    :param length: The range length (``0`` up to the end of the file).
+    :param advice: Name of the advice, e.g. ``'SEQUENTIAL'``, ``'WILLNEED'``
+        or ``'DONTNEED'``.
+    :returns: ``True`` if the hint was given, ``False`` if it is not
+        supported by the platform.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    try:
+        os.posix_fadvise(
+            fd, offset, length, getattr(os, 'POSIX_FADV_' + advice))
+    except OSError:
+        return False
+    return True
+
+
+_mincore = []
+
+
+def get_mincore():
+    """Get the ``mincore`` function of the C library, or ``None``."""
+    if not _mincore:
+        try:
+            mincore = ctypes.CDLL(None, use_errno=True).mincore
+            mincore.argtypes = [
+                ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+            mincore.restype = ctypes.c_int
+        except (AttributeError, OSError, TypeError):
+            mincore = None
+        _mincore.append(mincore)
+    return _mincore[0]
+
+
+def page_residency(fd, offset, length):
+    """Check which pages of a file range are in the page cache.
+
+    :param fd: The file descriptor.
+    :param offset: The range offset (a multiple of :data:`mmap.PAGESIZE`).
+    :param length: The range length.
+    :returns: A ``bytearray`` with one byte per page of the range (up to the
+        end of the file), whose lowest bit is set if the page is in the page
+        cache, or ``None`` if it cannot be checked.
+    """
+    mincore = get_mincore()
+    if mincore is None:
+        return None
+    try:
+        length = min(length, os.fstat(fd).st_size - offset)
+        if length <= 0:
+            return bytearray()
+        m = mmap.mmap(fd, length, access=mmap.ACCESS_COPY, offset=offset)
+    except (EnvironmentError, ValueError):
+        return None
+    try:
+        vec = (ctypes.c_ubyte * (
+            (length + mmap.PAGESIZE - 1) // mmap.PAGESIZE))()
+        buf = (ctypes.c_char * length).from_buffer(m)
+        try:
+            if mincore(ctypes.addressof(buf), length, vec) != 0:
+                return None
+        finally:
+            del buf
+        return bytearray(vec)
+    finally:
+        m.close()
+
+
+class ScanFile(object):
+    """File object reading a file once without polluting the page cache.
+
+    The file is read ahead sequentially, and the ranges which have been read
+    are dropped from the page cache, so that checksums and copies of whole
+    files do not evict the files being downloaded.
+
+    Pages which were already in the page cache before being read (e.g. a file
+    being downloaded) are not dropped. The page cache is checked (with
+    ``mincore``) one window ahead of the reads, and the pages of windows
+    which could not be checked before being read are kept. If the page cache
+    cannot be checked at all, everything read is dropped.
+    """
+
+    def __init__(self, fp, window=SCAN_ADVICE_WINDOW):
+        """Initialize the file object.
+
+        :param fp: The file object, with a file descriptor. It is closed with
+            this object.
+        :param window: Size of the ranges read ahead and dropped (a multiple
+            of :data:`mmap.PAGESIZE`).
+        """
+        self.fp = fp
+        self.fd = fp.fileno()
+        self.window = window
+        # Range read since the last dropped range.
+        self._start = self._end = None
+        # Pages cached before being read, by window number.
+        self._resident = {}
+        fadvise(self.fd, 0, 0, 'SEQUENTIAL')
+        self._check_residency(fp.tell(), window)
+
+    def fileno(self):
+        """Get the file descriptor."""
+        return self.fd
+
+    def advise(self, offset, length):
+        """Record that a range of the file was read.
+
+        Called by the read methods, and by readers using the file descriptor
+        directly.
+        """
+        if self._end != offset:
+            self._drop()
+            self._start = self._end = offset
+        self._end += length
+        self._check_residency(self._end, self.window)
+        if self._end - self._start >= self.window:
+            self._drop()
+            self._start = self._end
+            fadvise(self.fd, self._end, self.window, 'WILLNEED')
+
+    def _check_residency(self, offset, length):
+        """Check the page cache for the windows of a range not read yet."""
+        for number in range(offset // self.window,
+                            (offset + length - 1) // self.window + 1):
+            if number not in self._resident:
+                self._resident[number] = page_residency(
+                    self.fd, number * self.window, self.window)
+
+    def _drop(self):
+        """Drop the pages read since the last dropped range.
+
+        Only the pages which were not cached before being read are dropped.
+        """
+        if self._start is None or self._end <= self._start:
+            return
+        page_size = mmap.PAGESIZE
+        pages_per_window = self.window // page_size
+        run = None
+        for page in range(self._start // page_size,
+                          (self._end + page_size - 1) // page_size):
+            number, index = divmod(page, pages_per_window)
+            if number not in self._resident:
+                # Read before the page cache could be checked.
+                drop = False
+            elif self._resident[number] is None:
+                drop = True
+            else:
+                vec = self._resident[number]
+                drop = index < len(vec) and not vec[index] & 1
+            if drop and run is None:
+                run = page
+            elif not drop and run is not None:
+                fadvise(self.fd, run * page_size, (page - run) * page_size,
+                        'DONTNEED')
+                run = None
+        if run is not None:
+            fadvise(self.fd, run * page_size, self._end - run * page_size,
+                    'DONTNEED')
+        # Forget the windows read entirely.
+        for number in list(self._resident):
+            if (number + 1) * self.window <= self._end:
+                del self._resident[number]
+
+    def readinto(self, buf):
+        """Read into a buffer."""
+        offset = self.fp.tell()
+        self._check_residency(offset, len(buf) + self.window)
+        n = read_into(self.fp, buf)
+        self.advise(offset, n)
+        return n
+
+    def read(self, size=-1):
+        """Read data."""
+        offset = self.fp.tell()
+        if size is not None and size >= 0:
+            self._check_residency(offset, size + self.window)
+        data = self.fp.read(size)
+        self.advise(offset, len(data))
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Change the position."""
+        return self.fp.seek(offset, whence)
+
+    def tell(self):
+        """Get the position."""
+        return self.fp.tell()
+
+    def close(self):
+        """Drop the last range read and close the file."""
+        try:
+            self._drop()
+        finally:
+            self._start = self._end = None
+            self.fp.close()
+
+
+def pipe_chunks(chunks, consumers, depth, release=None):
+    """Feed chunks to several consumers running in their own threads.
+
+    Each consumer gets its own bounded queue, so reading the next chunk
+    overlaps with the consumers processing the previous ones (e.g. hashing
+    and writing to disk, which both release the GIL).
+
+    :param chunks: Iterable of chunks (read in the calling thread).
+    :param consumers: List of callables, called with each chunk in order.
+    :param depth: Maximum number of chunks queued for each consumer.
+    :param release: Function called with each chunk once all consumers are
+        done with it (e.g. to reuse its buffer).
+    :raises: The first exception raised by the iterable or a consumer. All
+        threads have finished when the function returns or raises.
+    """
+    stop = threading.Event()
+    errors = []
+    lock = threading.Lock()
+    pending = {}
+
+    def done(chunk):
+        if release is None:
+            return
+        with lock:
+            pending[id(chunk)] -= 1
+            if pending[id(chunk)]:
+                return
+            del pending[id(chunk)]
+        release(chunk)
+
+    def work(q, consumer):
+        while 1:
+            chunk = q.get()
+            if chunk is None:
+                break
+            if not stop.is_set():
+                try:
+                    consumer(chunk)
+                except Exception:
+                    errors.append(sys.exc_info())
+                    stop.set()
+            # Chunks are still drained after a failure, so the producer
+            # never blocks.
+            done(chunk)
+
+    queues = [queue.Queue(maxsize=depth) for dummy in consumers]
+    threads = [
+        threading.Thread(target=work, args=(q, consumer))
+        for q, consumer in zip(queues, consumers)
+    ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        for chunk in chunks:
+            if stop.is_set():
+                if release is not None:
+                    release(chunk)
+                break
+            if release is not None:
+                with lock:
+                    pending[id(chunk)] = len(queues)
+            for q in queues:
+                q.put(chunk)
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        for q in queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+    if errors:
+        six.reraise(*errors[0])
+
+
 class FileStorage(object):
     """Base class for storage interface to a single file."""
 
-    def __init__(self, size=None, modified=None):
-        """Initialize storage object."""
+    def __init__(self, size=None, modified=None, pipeline_depth=0,
+                 buffer_pool=None, checksum_algorithm='md5',
+                 extra_checksum_algorithms=None, checksum_workers=1,
+                 copy_methods=None, scan_advice=False, scan_direct_io=False):
+        """Initialize storage object.
+
+        :param size: The file size.
+        :param modified: The last modification time.
+        :param pipeline_depth: If not zero, incoming streams are read, hashed
+            and written in separate threads, with at most this number of
+            chunks queued between them (see
+            :data:`invenio_files_rest.config.FILES_REST_STORAGE_PIPELINE_DEPTH`).
+        :param buffer_pool: A :class:`invenio_files_rest.buffers.BufferPool`
+            used for the read buffers. If ``None``, each transfer allocates
+            its own buffer.
+        :param checksum_algorithm: Algorithm of the main checksum (see
+            :data:`invenio_files_rest.config.FILES_REST_CHECKSUM_ALGORITHMS`).
+        :param extra_checksum_algorithms: Names of additional checksum
+            algorithms computed in the same pass over the data as the main
+            checksum (see
+            :data:`invenio_files_rest.config.FILES_REST_STORAGE_EXTRA_CHECKSUMS`).
+        :param checksum_workers: Number of threads computing the segments of
+            tree checksums of existing files (see
+            :mod:`invenio_files_rest.treehash`).
+        :param copy_methods: Methods used to copy local files without
+            reading them (see :func:`fast_copy`).
+        :param scan_advice: Read files with page cache hints when computing
+            their checksum or copying them (see :class:`ScanFile`).
+        :param scan_direct_io: Read files bypassing the page cache when
+            computing their checksum or copying them, if supported by the
+            storage (see
+            :data:`invenio_files_rest.config.FILES_REST_STORAGE_SCAN_DIRECT_IO`).
+        """
         self._size = size
         self._modified = timegm(modified.timetuple()) if modified else None
+        self.pipeline_depth = pipeline_depth
+        self.buffer_pool = buffer_pool
+        self.checksum_algorithm = checksum_algorithm
+        self.extra_checksum_algorithms = tuple(extra_checksum_algorithms or ())
+        self.checksum_workers = checksum_workers
+        self.copy_methods = tuple(copy_methods or ())
+        self.scan_advice = scan_advice
+        self.scan_direct_io = scan_direct_io
+        # Additional and segment checksums computed by the last write or
+        # checksum.
+        self.extra_checksums = {}
+        self.segment_checksums = []
 
     def open(self, mode=None):
         """Open the file.
@@ -86,6 +514,24 @@ class FileStorage(object):
         """Update part of file with incoming stream."""
         raise NotImplementedError
 
+    def complete(self):
+        """Complete a file written in parts with :meth:`update`.
+
+        Overwrite this method if your storage backend has to assemble the
+        parts once they are all written (e.g. S3 multipart uploads).
+        """
+
+    def move(self, fileurl):
+        """Move the file to another URL of the same storage.
+
+        Overwrite this method if your storage backend can rename files (see
+        :data:`invenio_files_rest.config.FILES_REST_CONTENT_ADDRESSED_STORAGE`).
+
+        :param fileurl: The new URL of the file.
+        :returns: The new URL of the file.
+        """
+        raise NotImplementedError
+
     #
     # Default implementation
     #
@@ -93,8 +539,9 @@ class FileStorage(object):
                   checksum=None, trusted=False, chunk_size=None,
                   as_attachment=False):
         """Send the file to the client."""
+        offload_path = self._get_offload_path()
         try:
-            fp = self.open(mode='rb')
+            fp = None if offload_path else self.open(mode='rb')
         except Exception as e:
             raise StorageError('Could not send file: {}'.format(e))
 
@@ -118,14 +565,28 @@ class FileStorage(object):
                 chunk_size=chunk_size,
                 trusted=trusted,
                 as_attachment=as_attachment,
+                offload_path=offload_path,
             )
         except Exception as e:
-            fp.close()
+            if fp is not None:
+                fp.close()
             raise StorageError('Could not send file: {}'.format(e))
 
     def checksum(self, chunk_size=None, progress_callback=None, **kwargs):
-        """Compute checksum of file."""
-        fp = self.open(mode='rb')
+        """Compute checksum of file.
+
+        Tree checksums of files with several segments are computed in
+        parallel by ``checksum_workers`` threads, unless additional checksums
+        have to be computed in the same pass.
+        """
+        tree = parse_tree_algorithm(self.checksum_algorithm)
+        if tree and self.checksum_workers > 1 and \
+                not self.extra_checksum_algorithms and \
+                (self._size or 0) > tree[1]:
+            return self._compute_tree_checksum(
+                chunk_size=chunk_size, progress_callback=progress_callback)
+
+        fp = self._open_scan()
         try:
             value = self._compute_checksum(
                 fp, size=self._size, chunk_size=None,
@@ -136,13 +597,79 @@ class FileStorage(object):
             fp.close()
         return value
 
-    def copy(self, src, chunk_size=None, progress_callback=None):
+    def checksum_segments(self, numbers, chunk_size=None):
+        """Compute the checksums of some segments of a tree checksum.
+
+        Only the given segments are read, so that parts of a file can be
+        verified against its stored segment checksums.
+
+        :param numbers: The segment numbers.
+        :param chunk_size: Chunk size to read the segments.
+        :returns: List of the segment checksums, in the order of ``numbers``.
+            The checksum of a segment is ``None`` if data is missing.
+        """
+        tree = parse_tree_algorithm(self.checksum_algorithm)
+        if not tree:
+            raise StorageError('The file has no tree checksum.')
+        segment_algo, segment_size = tree
+        factory = self._init_hash()[1].factory
+        size = self._size
+        chunk_size = min(chunk_size_or_default(chunk_size), segment_size)
+
+        checksums = []
+        try:
+            fp = self._open_scan()
+            buf = self._acquire_buffer(chunk_size)
+            try:
+                for number in numbers:
+                    offset = number * segment_size
+                    try:
+                        digest = self._compute_segment_digest(
+                            fp, buf, factory(), offset,
+                            min(segment_size, size - offset),
+                            lambda n: None)
+                    except UnexpectedFileSizeError:
+                        checksums.append(None)
+                    else:
+                        checksums.append(
+                            '{0}:{1}'.format(segment_algo, digest))
+            finally:
+                self._release_buffer(buf)
+                fp.close()
+        except Exception as e:
+            raise StorageError(
+                'Could not compute checksum of file: {0}'.format(e))
+        return checksums
+
+    def copy(self, src, chunk_size=None, progress_callback=None,
+             allow_fast_copy=True):
         """Copy data from another file instance.
 
+        If both files are local files, they are copied with
+        :func:`fast_copy` if possible. The data is then not read, and the
+        returned checksum is ``None``.
+
         :param src: Source stream.
         :param chunk_size: Chunk size to read from source stream.
+        :param allow_fast_copy: Set to ``False`` to always read the data, e.g.
+            to verify it while copying it.
         """
-        fp = src.open(mode='rb')
+        # Keep the checksum comparable with the one of the source.
+        self.checksum_algorithm = src.checksum_algorithm
+
+        if self.copy_methods and allow_fast_copy:
+            src_path = src._get_local_path()
+            dst_path = self._get_local_path()
+            if src_path and dst_path and \
+                    fast_copy(src_path, dst_path, self.copy_methods):
+                self._size = os.path.getsize(dst_path)
+                self._set_extra_checksums([])
+                self._set_segment_checksums(None, None)
+                if progress_callback:
+                    progress_callback(self._size, self._size)
+                return self._get_url(), self._size, None
+
+        fp = src._open_scan()
         try:
             return self.save(
                 fp, chunk_size=chunk_size, progress_callback=progress_callback)
@@ -152,13 +679,82 @@ class FileStorage(object):
     #
     # Helpers
     #
+    def _get_offload_path(self):
+        """Get path used to let the front-end web server send the file.
+
+        Overwrite this method if the files of your storage backend can be
+        served directly by the web server (see
+        :data:`invenio_files_rest.config.FILES_REST_DOWNLOAD_OFFLOAD_HEADER`).
+        """
+        return None
+
+    def _get_local_path(self):
+        """Get the local path of the file, if its data is stored as is.
+
+        Overwrite this method to let files be copied without reading them
+        (see :func:`fast_copy`). The directory of the file is created.
+        """
+        return None
+
+    def _get_url(self):
+        """Get the URL of the file, as returned by :meth:`save`."""
+        raise NotImplementedError
+
+    def _open_scan(self):
+        """Open the file to read it once (e.g. checksums and copies).
+
+        Overwrite this method if your storage backend can read files
+        bypassing the page cache (see ``scan_direct_io``).
+        """
+        fp = self.open(mode='rb')
+        if self.scan_advice and has_fileno(fp):
+            return ScanFile(fp)
+        return fp
+
+    def _acquire_buffer(self, size):
+        """Get a read buffer of at most the given size."""
+        if self.buffer_pool is not None:
+            return self.buffer_pool.acquire(size)
+        return bytearray(size)
+
+    def _release_buffer(self, buf):
+        """Give back a buffer obtained with :meth:`_acquire_buffer`."""
+        if self.buffer_pool is not None:
+            self.buffer_pool.release(buf)
+
     def _init_hash(self):
         """Initialize message digest object.
 
         Overwrite this method if you want to use different checksum
         algorithm for your storage backend.
         """
-        return 'md5', hashlib.md5()
+        return self.checksum_algorithm, init_message_digest(
+            self.checksum_algorithm)
+
+    def _init_extra_hashes(self, algo=None):
+        """Initialize message digest objects of the additional checksums.
+
+        :param algo: Algorithm of the main checksum, which is not computed a
+            second time.
+        :returns: List of ``(algorithm, message digest)`` tuples.
+        """
+        return [(name, init_message_digest(name))
+                for name in self.extra_checksum_algorithms if name != algo]
+
+    def _set_extra_checksums(self, extra_hashes):
+        """Store the values of the additional checksums."""
+        self.extra_checksums = dict(
+            (name, '{0}:{1}'.format(name, m.hexdigest()))
+            for name, m in extra_hashes
+        )
+
+    def _set_segment_checksums(self, algo, m):
+        """Store the segment checksums of a tree checksum."""
+        tree = parse_tree_algorithm(algo) if m else None
+        self.segment_checksums = [
+            '{0}:{1}'.format(tree[0], digest)
+            for digest in m.segment_digests()
+        ] if tree else []
 
     def _compute_checksum(self, stream, size=None, chunk_size=None,
                           progress_callback=None, **kwargs):
@@ -174,16 +770,132 @@ class FileStorage(object):
 
         try:
             algo, m = self._init_hash()
-            return compute_checksum(
+            extra_hashes = self._init_extra_hashes(algo)
+            value = compute_checksum(
                 stream, algo, m,
                 chunk_size=chunk_size,
                 progress_callback=progress_callback,
+                buffer_pool=self.buffer_pool,
+                size=size,
+                extra_digests=[h for dummy, h in extra_hashes],
                 **kwargs
             )
+            # Report missing data like the parallel computation does.
+            if isinstance(m, TreeHash) and size is not None:
+                check_sizelimit(None, m.size, size)
+                check_size(m.size, size)
+            self._set_extra_checksums(extra_hashes)
+            self._set_segment_checksums(algo, m)
+            return value
+        except UnexpectedFileSizeError:
+            raise
+        except Exception as e:
+            raise StorageError(
+                'Could not compute checksum of file: {0}'.format(e))
+
+    def _compute_tree_checksum(self, chunk_size=None, progress_callback=None):
+        """Compute a tree checksum by hashing its segments in parallel.
+
+        Each thread reads the segments with its own file object. Progress
+        callbacks are called from the calling thread.
+        """
+        try:
+            algo, tree = self._init_hash()
+            size = self._size
+            chunk_size = min(chunk_size_or_default(chunk_size),
+                             tree.segment_size)
+
+            segments = queue.Queue()
+            for i in range(tree.segment_count(size)):
+                segments.put(i)
+            digests = [None] * segments.qsize()
+            progress = queue.Queue()
+            stop = threading.Event()
+            errors = []
+
+            def work():
+                try:
+                    fp = self._open_scan()
+                    buf = self._acquire_buffer(chunk_size)
+                    try:
+                        while not stop.is_set():
+                            try:
+                                i = segments.get_nowait()
+                            except queue.Empty:
+                                break
+                            offset = i * tree.segment_size
+                            digests[i] = self._compute_segment_digest(
+                                fp, buf, tree.factory(), offset,
+                                min(tree.segment_size, size - offset),
+                                progress.put)
+                    finally:
+                        self._release_buffer(buf)
+                        fp.close()
+                except Exception:
+                    errors.append(sys.exc_info())
+                    stop.set()
+                finally:
+                    progress.put(None)
+
+            threads = [
+                threading.Thread(target=work)
+                for dummy in range(min(self.checksum_workers, len(digests)))
+            ]
+            for t in threads:
+                t.daemon = True
+                t.start()
+
+            bytes_read = 0
+            running = len(threads)
+            while running:
+                n = progress.get()
+                if n is None:
+                    running -= 1
+                    continue
+                bytes_read += n
+                if progress_callback:
+                    progress_callback(size, bytes_read)
+            for t in threads:
+                t.join()
+
+            if errors:
+                six.reraise(*errors[0])
+        except UnexpectedFileSizeError:
+            raise
         except Exception as e:
             raise StorageError(
                 'Could not compute checksum of file: {0}'.format(e))
 
+        tree.segments = digests
+        self._set_extra_checksums([])
+        self._set_segment_checksums(algo, tree)
+        return '{0}:{1}'.format(algo, tree.hexdigest())
+
+    def _compute_segment_digest(self, fp, buf, m, offset, length,
+                                progress_callback):
+        """Hash a segment of a file.
+
+        :param fp: The file object.
+        :param buf: The read buffer.
+        :param m: The message digest object of the segment.
+        :param offset: The segment offset.
+        :param length: The segment length.
+        :param progress_callback: Function called with the number of bytes
+            read for each chunk.
+        :returns: The hex digest of the segment.
+        """
+        view = memoryview(buf)
+        fp.seek(offset)
+        while length:
+            n = read_into(fp, view[:min(len(buf), length)])
+            if not n:
+                raise UnexpectedFileSizeError(
+                    description='File is smaller than expected.')
+            m.update(view[:n])
+            length -= n
+            progress_callback(n)
+        return m.hexdigest()
+
     def _write_stream(self, src, dst, size=None, size_limit=None,
                       chunk_size=None, progress_callback=None):
         """Get helper to save stream from src to dest + compute checksum.
@@ -196,32 +908,73 @@ class FileStorage(object):
             to write.
         """
         chunk_size = chunk_size_or_default(chunk_size)
+        if size:
+            chunk_size = min(chunk_size, size)
 
         algo, m = self._init_hash()
-        bytes_written = 0
-
-        while 1:
-            # Check that size limits aren't bypassed
-            check_sizelimit(size_limit, bytes_written, size)
-
-            chunk = src.read(chunk_size)
-
-            if not chunk:
-                if progress_callback:
-                    progress_callback(bytes_written, bytes_written)
-                break
-
-            dst.write(chunk)
-
-            bytes_written += len(chunk)
-
-            if m:
-                m.update(chunk)
+        extra_hashes = self._init_extra_hashes(algo)
+        digests = ([m] if m else []) + [h for dummy, h in extra_hashes]
+        counter = dict(bytes_written=0)
+        # Buffers of the chunks which are still used by the pipeline.
+        buffers = {}
+
+        def read_chunks():
+            buf = None
+            try:
+                while 1:
+                    # Check that size limits aren't bypassed
+                    check_sizelimit(
+                        size_limit, counter['bytes_written'], size)
+
+                    if buf is None:
+                        buf = self._acquire_buffer(chunk_size)
+                    n = read_into(src, buf)
+
+                    if not n:
+                        break
+
+                    chunk = memoryview(buf)[:n]
+                    if self.pipeline_depth:
+                        # Use a new buffer for the next chunk, since this one
+                        # may not be processed yet.
+                        buffers[id(chunk)] = buf
+                        buf = None
+
+                    yield chunk
+
+                    counter['bytes_written'] += n
+
+                    if progress_callback:
+                        progress_callback(None, counter['bytes_written'])
+            finally:
+                if buf is not None:
+                    self._release_buffer(buf)
+
+        chunks = read_chunks()
+        try:
+            if self.pipeline_depth:
+                pipe_chunks(
+                    chunks,
+                    [dst.write] + [h.update for h in digests],
+                    self.pipeline_depth,
+                    release=lambda chunk: self._release_buffer(
+                        buffers.pop(id(chunk))),
+                )
+            else:
+                for chunk in chunks:
+                    dst.write(chunk)
+                    for h in digests:
+                        h.update(chunk)
+        finally:
+            chunks.close()
 
-            if progress_callback:
-                progress_callback(None, bytes_written)
+        bytes_written = counter['bytes_written']
+        if progress_callback:
+            progress_callback(bytes_written, bytes_written)
 
         check_size(bytes_written, size)
+        self._set_extra_checksums(extra_hashes)
+        self._set_segment_checksums(algo, m)
 
         return bytes_written, '{0}:{1}'.format(
             algo, m.hexdigest()) if m else None
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Read-through cache of files of slow storage classes on a local disk."""
+
+from __future__ import absolute_import, print_function
+
+import errno
+import io
+import os
+import uuid
+
+from flask import current_app
+
+from ..proxies import current_files_rest
+from .local import LocalFileStorage, url_to_path
+
+
+class CachedCopyStorage(LocalFileStorage):
+    """Storage of a cached copy, served from a file opened by the cache.
+
+    The copy stays readable through the opened file even if it is evicted
+    concurrently.
+    """
+
+    def __init__(self, fp, path, **kwargs):
+        """Initialize the storage.
+
+        :param fp: The opened copy, returned by the first :meth:`open`.
+        :param path: Path of the copy.
+        """
+        super(CachedCopyStorage, self).__init__(
+            path, clean_dir=False, **kwargs)
+        self._fp = fp
+
+    def open(self, mode='rb'):
+        """Open file."""
+        if mode == 'rb' and self._fp is not None:
+            fp, self._fp = self._fp, None
+            return fp
+        return super(CachedCopyStorage, self).open(mode=mode)
+
+    def _get_offload_path(self):
+        """Send the opened copy instead of offloading it."""
+        return None
+
+
+class CachedFileStorage(object):
+    """Storage of a file instance which reads the file through the cache.
+
+    Reading the file (:meth:`open` in read mode and :meth:`send_file`) uses
+    the cached copy. Everything else, including checksum computations, is
+    done by the storage of the file instance.
+    """
+
+    def __init__(self, cache, fileinstance, storage, **kwargs):
+        """Initialize the storage.
+
+        :param cache: The :class:`StorageCache`.
+        :param fileinstance: The file instance.
+        :param storage: The storage of the file instance.
+        :param kwargs: Passed to the storage factory of the file instance.
+        """
+        self.cache = cache
+        self.fileinstance = fileinstance
+        self.storage = storage
+        self.kwargs = kwargs
+
+    def __getattr__(self, name):
+        """Get the attributes of the storage of the file instance."""
+        return getattr(self.storage, name)
+
+    def open(self, mode='rb'):
+        """Open file, from the cache if opened for reading."""
+        if mode == 'rb':
+            fp = self.cache.open(self.fileinstance, **self.kwargs)
+            if fp is not None:
+                return fp
+        return self.storage.open(mode=mode)
+
+    def send_file(self, *args, **kwargs):
+        """Send the file to the client, from the cache if possible."""
+        storage = self.cache.get_storage(self.fileinstance, **self.kwargs)
+        if storage is None:
+            storage = self.storage
+        return storage.send_file(*args, **kwargs)
+
+
+class StorageCache(object):
+    """Size-bounded cache of file copies on a fast local file system.
+
+    Files are copied to the cache the first time they are read, and are
+    verified against the checksum of the file instance. The least recently
+    used files are removed by :meth:`evict` (see
+    :func:`invenio_files_rest.tasks.evict_storage_cache`). The cache is
+    shared by all processes using the same directory.
+    """
+
+    def __init__(self, uri, max_size, storage_classes=('A', )):
+        """Initialize the cache.
+
+        :param uri: Path of the cache directory.
+        :param max_size: Maximum total size of the cached files, in bytes.
+        :param storage_classes: Storage classes of the cached files.
+        """
+        self.path = os.path.normpath(url_to_path(uri))
+        self.max_size = max_size
+        self.storage_classes = storage_classes
+
+    def get_path(self, fileinstance):
+        """Get the path of the cached copy of a file instance."""
+        file_id = str(fileinstance.id)
+        return os.path.join(
+            self.path, file_id[:2], file_id,
+            fileinstance.checksum.replace(':', '-'))
+
+    def is_cacheable(self, fileinstance):
+        """Check if a file instance is cached."""
+        return fileinstance.readable and bool(fileinstance.checksum) and \
+            fileinstance.storage_class in self.storage_classes and \
+            (fileinstance.size or 0) <= self.max_size
+
+    def wrap(self, fileinstance, storage, **kwargs):
+        """Read the file of a storage through the cache, if cacheable.
+
+        :param fileinstance: The file instance.
+        :param storage: The storage of the file instance.
+        :param kwargs: Passed to the storage factory of the file instance.
+        :returns: A :class:`CachedFileStorage`, or the storage if the file
+            instance is not cacheable.
+        """
+        if not self.is_cacheable(fileinstance):
+            return storage
+        return CachedFileStorage(self, fileinstance, storage, **kwargs)
+
+    def open(self, fileinstance, **kwargs):
+        """Open the cached copy of a file instance.
+
+        The file is copied to the cache if needed.
+
+        :param fileinstance: The file instance.
+        :param kwargs: Passed to the storage factory of the file instance.
+        :returns: The copy opened for reading, or ``None`` if the file is not
+            cacheable (or the copy failed).
+        """
+        if not self.is_cacheable(fileinstance):
+            return None
+
+        path = self.get_path(fileinstance)
+        try:
+            fp = io.open(path, mode='rb', buffering=0)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                return self.add(fileinstance, path, **kwargs)
+            except Exception:
+                current_app.logger.exception(
+                    'Could not cache file {0}.'.format(fileinstance.id))
+                return None
+
+        try:
+            # Mark the copy as recently used.
+            os.utime(path, None)
+        except OSError as e:
+            # Evicted since it was opened.
+            if e.errno != errno.ENOENT:
+                fp.close()
+                raise
+        return fp
+
+    def get_storage(self, fileinstance, **kwargs):
+        """Get the storage of the cached copy of a file instance.
+
+        The file is copied to the cache if needed.
+
+        :param fileinstance: The file instance.
+        :param kwargs: Passed to the storage factory of the file instance.
+        :returns: A :class:`CachedCopyStorage` or ``None`` if the file is not
+            cached (or the copy failed).
+        """
+        fp = self.open(fileinstance, **kwargs)
+        if fp is None:
+            return None
+        return CachedCopyStorage(
+            fp, self.get_path(fileinstance), size=fileinstance.size,
+            modified=fileinstance.updated)
+
+    def add(self, fileinstance, path, **kwargs):
+        """Copy a file instance to the cache.
+
+        The copy is written to a temporary file, and only moved in place if
+        its checksum matches the one of the file instance.
+
+        :returns: The copy opened for reading.
+        """
+        tmp = LocalFileStorage(
+            '{0}.{1}.tmp'.format(path, uuid.uuid4()), clean_dir=False,
+            checksum_algorithm=fileinstance.checksum.split(':', 1)[0])
+        src = current_files_rest.storage_factory(
+            fileinstance=fileinstance, **kwargs)
+        fp = src.open(mode='rb')
+        try:
+            dummy, size, checksum = tmp.save(fp, size=fileinstance.size)
+        finally:
+            fp.close()
+
+        if checksum != fileinstance.checksum:
+            tmp.delete()
+            raise ValueError(
+                'Checksum mismatch of cached copy ({0} != {1}).'.format(
+                    checksum, fileinstance.checksum))
+        fp = io.open(tmp.path, mode='rb', buffering=0)
+        try:
+            os.rename(tmp.path, path)
+        except Exception:
+            fp.close()
+            tmp.delete()
+            raise
+        return fp
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits.
+
+        The whole cache directory is scanned, hence this should be run
+        periodically rather than on each copy.
+        """
+        files = []
+        total = 0
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                total += st.st_size
+                # Copies in progress are not removed.
+                if not name.endswith('.tmp'):
+                    files.append((st.st_mtime, st.st_size, path))
+
+        files.sort()
+        for dummy, size, path in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Removed by another process.
+                pass
+            total -= size
+
+            filedir = os.path.dirname(path)
+            while filedir.startswith(self.path + os.sep):
+                try:
+                    os.rmdir(filedir)
+                except OSError:
+                    # Not empty.
+                    break
+                filedir = os.path.dirname(filedir)
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Storage of files on a local (or network mounted) file system."""
+
+from __future__ import absolute_import, print_function
+
+import errno
+import io
+import mmap
+import os
+import shutil
+
+from ..errors import StorageError, UnexpectedFileSizeError
+from ..helpers import has_fileno
+from .base import preallocate
+from .pyfs import PyFSFileStorage, pyfs_storage_factory
+
+
+def url_to_path(fileurl):
+    """Get the local path of a file URL.
+
+    :param fileurl: A path or a ``file://`` URL.
+    :raises ValueError: If the URL is not a local path.
+    """
+    if fileurl.startswith('file://'):
+        return fileurl[len('file://'):]
+    if '://' in fileurl:
+        raise ValueError('Not a local file URL: {0}'.format(fileurl))
+    return fileurl
+
+
+def pread_into(fd, buf, offset):
+    """Read from a file descriptor at an offset into a buffer.
+
+    :param fd: The file descriptor.
+    :param buf: A writable buffer (e.g. ``bytearray`` or ``memoryview``).
+    :param offset: The file offset.
+    :returns: The number of bytes read (``0`` at the end of the file).
+    """
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [buf], offset)
+    if hasattr(os, 'pread'):
+        data = os.pread(fd, len(buf), offset)
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        data = os.read(fd, len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+def pwrite(fd, data, offset):
+    """Write data to a file descriptor at an offset.
+
+    :param fd: The file descriptor.
+    :param data: The data (bytes-like object).
+    :param offset: The file offset.
+    :returns: The number of bytes written.
+    """
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+class DescriptorFile(object):
+    """Write-only file object over a file descriptor.
+
+    Each write is a positional write at the current offset, so the
+    descriptor offset is never used.
+    """
+
+    def __init__(self, fd, offset=0):
+        """Initialize the file object.
+
+        :param fd: The file descriptor, closed with the object.
+        :param offset: The offset of the first write.
+        """
+        self.fd = fd
+        self.offset = offset
+
+    def fileno(self):
+        """Get the file descriptor."""
+        return self.fd
+
+    def flush(self):
+        """Do nothing, as writes are not buffered."""
+
+    def write(self, data):
+        """Write data at the current offset."""
+        view = memoryview(data)
+        while len(view):
+            n = pwrite(self.fd, view, self.offset)
+            self.offset += n
+            view = view[n:]
+        return len(data)
+
+    def close(self):
+        """Close the file descriptor."""
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            os.close(fd)
+
+
+DIRECT_IO_ALIGNMENT = 4096
+"""Alignment of the offsets, lengths and buffers of direct I/O."""
+
+
+class DirectFile(io.RawIOBase):
+    """Read-only file object over a file descriptor opened with ``O_DIRECT``.
+
+    Data is read in aligned blocks into a page aligned buffer, and copied to
+    the buffers of the caller.
+    """
+
+    def __init__(self, fd, buffer_size=1024 * 1024):
+        """Initialize the file object.
+
+        :param fd: The file descriptor, closed with the object.
+        :param buffer_size: Size of the aligned buffer (a multiple of
+            :data:`DIRECT_IO_ALIGNMENT`).
+        """
+        super(DirectFile, self).__init__()
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        self.pos = 0
+        self._buf = mmap.mmap(-1, buffer_size)
+
+    def readable(self):
+        """Return ``True``."""
+        return True
+
+    def seekable(self):
+        """Return ``True``."""
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Change the position."""
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position {0}'.format(offset))
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        """Get the position."""
+        return self.pos
+
+    def readinto(self, buf):
+        """Read into a buffer."""
+        skip = self.pos % DIRECT_IO_ALIGNMENT
+        length = skip + len(buf)
+        length = min(length + -length % DIRECT_IO_ALIGNMENT, len(self._buf))
+        with memoryview(self._buf) as view:
+            n = pread_into(self.fd, view[:length], self.pos - skip) - skip
+        n = min(n, len(buf))
+        if n <= 0:
+            return 0
+        buf[:n] = self._buf[skip:skip + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        """Close the file descriptor."""
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            self._buf.close()
+            os.close(fd)
+        super(DirectFile, self).close()
+
+
+class LocalFileStorage(PyFSFileStorage):
+    """File system storage using the operating system calls directly.
+
+    Files are stored like with :class:`PyFSFileStorage`, but are read and
+    written with file descriptors (and positional reads and writes) instead
+    of through the PyFilesystem abstraction. Only plain paths and ``file://``
+    URLs are supported.
+
+    This saves the overhead of PyFilesystem on each operation, which matters
+    for small files. Large files are bound by the copies and the checksums,
+    and are processed at the same speed by both storages.
+    """
+
+    @property
+    def path(self):
+        """Local path of the file."""
+        return url_to_path(self.fileurl)
+
+    def _make_dir(self, path=None):
+        """Create the directory of the file."""
+        try:
+            os.makedirs(os.path.dirname(path or self.path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _open_fd(self, flags, offset=0):
+        """Open the file descriptor of the file."""
+        if flags & os.O_CREAT:
+            self._make_dir()
+        flags |= getattr(os, 'O_BINARY', 0) | getattr(os, 'O_CLOEXEC', 0)
+        return DescriptorFile(os.open(self.path, flags, 0o666), offset=offset)
+
+    def open(self, mode='rb'):
+        """Open file.
+
+        Files opened only for reading are not buffered, as they are read in
+        large chunks. The caller is responsible for closing the file.
+        """
+        if mode == 'rb':
+            return self._wrap_file(
+                io.open(self.path, mode=mode, buffering=0), mode)
+        if not mode.startswith('r'):
+            self._make_dir()
+        return self._wrap_file(io.open(self.path, mode=mode), mode)
+
+    def delete(self):
+        """Delete a file.
+
+        The base directory is also removed, as it is assumed that only one file
+        exists in the directory.
+        """
+        path = self.path
+        if os.path.exists(path):
+            os.remove(path)
+        filedir = os.path.dirname(path)
+        if self.clean_dir and os.path.isdir(filedir):
+            os.rmdir(filedir)
+        return True
+
+    def initialize(self, size=0):
+        """Initialize file on storage and truncate to given size."""
+        self._init_uncompressed()
+        fp = self._open_fd(os.O_RDWR | os.O_CREAT)
+        try:
+            # Preallocate first, so that a file which cannot fit is not
+            # created at its full size.
+            if self.preallocate and size:
+                preallocate(fp, size)
+            os.ftruncate(fp.fileno(), size)
+        except Exception:
+            fp.close()
+            self.delete()
+            raise
+        finally:
+            fp.close()
+
+        self._size = size
+
+        return self.fileurl, size, None
+
+    def save(self, incoming_stream, size_limit=None, size=None,
+             chunk_size=None, progress_callback=None):
+        """Save file in the file system.
+
+        If the size is given, the disk space of uncompressed files is
+        preallocated as well.
+        """
+        fp = self._open_fd(os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            if self.preallocate and size and self.compression is None:
+                preallocate(fp, size)
+            fp = self._wrap_file(fp, 'wb')
+            bytes_written, checksum = self._write_stream(
+                incoming_stream, fp, chunk_size=chunk_size,
+                progress_callback=progress_callback,
+                size_limit=size_limit, size=size)
+        except Exception:
+            fp.close()
+            self.delete()
+            raise
+        finally:
+            fp.close()
+
+        self._size = bytes_written
+
+        return self.fileurl, bytes_written, checksum
+
+    def update(self, incoming_stream, seek=0, size=None, chunk_size=None,
+               progress_callback=None):
+        """Update a file in the file system."""
+        if self.compression is not None:
+            raise StorageError('Compressed files cannot be updated.')
+        fp = self._open_fd(os.O_WRONLY, offset=seek)
+        try:
+            bytes_written, checksum = self._write_stream(
+                incoming_stream, fp, chunk_size=chunk_size,
+                size=size, progress_callback=progress_callback)
+        finally:
+            fp.close()
+
+        return bytes_written, checksum
+
+    def move(self, fileurl):
+        """Move the file to another URL.
+
+        The base directory of the old URL is removed.
+        """
+        path = url_to_path(fileurl)
+        self._make_dir(path)
+        shutil.move(self.path, path)
+        self.delete()
+
+        self.fileurl = fileurl
+        return fileurl
+
+    def _get_local_path(self):
+        """Get the local path of the file, if it is not compressed."""
+        if self.compression is not None:
+            return None
+        self._make_dir()
+        return self.path
+
+    def _open_scan(self):
+        """Open the file to read it once, bypassing the page cache if enabled.
+
+        Falls back to the page cache hints if the file system does not
+        support direct I/O (e.g. tmpfs).
+        """
+        if self.scan_direct_io and hasattr(os, 'O_DIRECT') and \
+                hasattr(os, 'preadv'):
+            try:
+                fd = os.open(
+                    self.path,
+                    os.O_RDONLY | os.O_DIRECT | getattr(os, 'O_CLOEXEC', 0))
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+            else:
+                return self._wrap_file(DirectFile(fd), 'rb')
+        return super(LocalFileStorage, self)._open_scan()
+
+    def _compute_segment_digest(self, fp, buf, m, offset, length,
+                                progress_callback):
+        """Hash a segment of a file with positional reads."""
+        if not has_fileno(fp):
+            return super(LocalFileStorage, self)._compute_segment_digest(
+                fp, buf, m, offset, length, progress_callback)
+        view = memoryview(buf)
+        fd = fp.fileno()
+        advise = getattr(fp, 'advise', None)
+        while length:
+            n = pread_into(fd, view[:min(len(buf), length)], offset)
+            if not n:
+                raise UnexpectedFileSizeError(
+                    description='File is smaller than expected.')
+            if advise is not None:
+                advise(offset, n)
+            m.update(view[:n])
+            offset += n
+            length -= n
+            progress_callback(n)
+        return m.hexdigest()
+
+
+def local_storage_factory(fileinstance=None, default_location=None,
+                          default_storage_class=None,
+                          filestorage_class=LocalFileStorage, fileurl=None,
+                          size=None, modified=None, clean_dir=True):
+    """Get factory function for creating a local file storage instance."""
+    return pyfs_storage_factory(
+        fileinstance=fileinstance, default_location=default_location,
+        default_storage_class=default_storage_class,
+        filestorage_class=filestorage_class, fileurl=fileurl, size=size,
+        modified=modified, clean_dir=clean_dir)
@@ -10,12 +10,108 @@
 
 from __future__ import absolute_import, print_function
 
+import copy
+import gzip
+import io
+import threading
+from collections import OrderedDict
+
 from flask import current_app
+from fs.errors import ResourceNotFoundError
 from fs.opener import opener
 from fs.path import basename, dirname
+from fs.utils import movefile
+
+from ..errors import StorageError
+from ..helpers import get_checksum_algorithm, get_offload_path, make_path
+from ..proxies import current_files_rest
+from .base import FileStorage, preallocate
+
+COMPRESSED_SUFFIX = '.gz'
+"""Suffix of the name of compressed files."""
+
+
+class CompressedFile(gzip.GzipFile):
+    """Gzip file object over another file object.
+
+    The underlying file is closed with the object. Its file descriptor is
+    hidden, so that e.g. the WSGI server does not send the compressed data.
+    """
+
+    def __init__(self, fp, mode, compresslevel):
+        """Initialize the file object.
+
+        :param fp: The underlying file object.
+        :param mode: ``'rb'`` or ``'wb'``.
+        :param compresslevel: The compression level used when writing.
+        """
+        super(CompressedFile, self).__init__(
+            fileobj=fp, mode=mode, compresslevel=compresslevel)
+        self._fp = fp
 
-from ..helpers import make_path
-from .base import FileStorage
+    def fileno(self):
+        """Not supported."""
+        raise io.UnsupportedOperation('fileno')
+
+    def close(self):
+        """Close the file and the underlying file."""
+        try:
+            super(CompressedFile, self).close()
+        finally:
+            self._fp.close()
+
+
+class PyFSCache(object):
+    """Thread-safe LRU cache of opened file systems.
+
+    Opening a file system from a URL parses the URL and checks (or creates)
+    the directory. The cache keeps the file systems of the storage locations,
+    so that files can be accessed relative to them.
+    """
+
+    def __init__(self, max_size):
+        """Initialize the cache.
+
+        :param max_size: Maximum number of cached file systems.
+        """
+        self.max_size = max_size
+        self._fs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uri):
+        """Get the file system of a directory, creating it if needed.
+
+        :param uri: The directory URL.
+        """
+        with self._lock:
+            fs = self._fs.pop(uri, None)
+            if fs is not None:
+                self._fs[uri] = fs
+                return fs
+
+        fs = opener.opendir(uri, writeable=True, create_dir=True)
+
+        with self._lock:
+            self._fs[uri] = fs
+            while len(self._fs) > self.max_size:
+                self._fs.popitem(last=False)
+        return fs
+
+
+def split_base_uri(fileurl, depth):
+    """Split a file URL into the base URL and the relative file path.
+
+    :param fileurl: The file URL.
+    :param depth: Number of path components of the relative path (see
+        :func:`invenio_files_rest.helpers.make_path`).
+    :returns: A tuple ``(base URL, relative path)``, or ``None`` if the URL
+        has not enough path components.
+    """
+    parts = fileurl.rstrip('/').rsplit('/', depth)
+    base = parts[0].rstrip('/')
+    if len(parts) <= depth or not base or base.endswith(':'):
+        return None
+    return parts[0], '/'.join(parts[1:])
 
 
 class PyFSFileStorage(FileStorage):
@@ -33,21 +129,67 @@ class PyFSFileStorage(FileStorage):
 
     """
 
-    def __init__(self, fileurl, size=None, modified=None, clean_dir=True):
-        """Storage initialization."""
+    def __init__(self, fileurl, size=None, modified=None, clean_dir=True,
+                 preallocate=False, base_uri=None, fs_cache=None,
+                 compression=None, **kwargs):
+        """Storage initialization.
+
+        :param base_uri: URL of the storage location of the file. If given
+            together with ``fs_cache``, the file is accessed relative to the
+            cached file system of the location.
+        :param fs_cache: A :class:`PyFSCache` instance.
+        :param compression: If not ``None``, the file is stored compressed
+            with gzip, and this is the compression level (see
+            :data:`invenio_files_rest.config.FILES_REST_STORAGE_COMPRESSION`).
+        """
         self.fileurl = fileurl
         self.clean_dir = clean_dir
-        super(PyFSFileStorage, self).__init__(size=size, modified=modified)
+        self.preallocate = preallocate
+        self.base_uri = base_uri
+        self.fs_cache = fs_cache
+        self.compression = compression
+        super(PyFSFileStorage, self).__init__(
+            size=size, modified=modified, **kwargs)
+        if compression is not None:
+            # Compressed files cannot be read from arbitrary offsets.
+            self.checksum_workers = 1
+
+    def _wrap_file(self, fp, mode):
+        """Wrap a file object to compress or decompress the data if needed."""
+        if self.compression is None:
+            return fp
+        if mode not in ('rb', 'wb'):
+            fp.close()
+            raise StorageError(
+                'Compressed files cannot be opened in mode {0}.'.format(mode))
+        return CompressedFile(fp, mode, self.compression)
+
+    def _init_uncompressed(self):
+        """Store the file uncompressed, as it is written in parts."""
+        if self.compression is not None:
+            self.fileurl = self.fileurl[:-len(COMPRESSED_SUFFIX)]
+            self.compression = None
 
     def _get_fs(self, create_dir=True):
-        """Return tuple with filesystem and filename."""
-        filedir = dirname(self.fileurl)
-        filename = basename(self.fileurl)
+        """Return tuple with filesystem and file path."""
+        if self.fs_cache is None or not self.base_uri:
+            filedir = dirname(self.fileurl)
+            filename = basename(self.fileurl)
+
+            return (
+                opener.opendir(
+                    filedir, writeable=True, create_dir=create_dir),
+                filename
+            )
 
-        return (
-            opener.opendir(filedir, writeable=True, create_dir=create_dir),
-            filename
-        )
+        fs = self.fs_cache.get(self.base_uri)
+        path = self.fileurl[len(self.base_uri):].lstrip('/')
+        filedir = dirname(path)
+        if filedir and not fs.isdir(filedir):
+            if not create_dir:
+                raise ResourceNotFoundError(dirname(self.fileurl))
+            fs.makedir(filedir, recursive=True, allow_recreate=True)
+        return fs, path
 
     def open(self, mode='rb'):
         """Open file.
@@ -55,7 +197,7 @@ class PyFSFileStorage(FileStorage):
         The caller is responsible for closing the file.
         """
         fs, path = self._get_fs()
-        return fs.open(path, mode=mode)
+        return self._wrap_file(fs.open(path, mode=mode), mode)
 
     def delete(self):
         """Delete a file.
@@ -66,12 +208,14 @@ class PyFSFileStorage(FileStorage):
         fs, path = self._get_fs(create_dir=False)
         if fs.exists(path):
             fs.remove(path)
-        if self.clean_dir and fs.exists('.'):
-            fs.removedir('.')
+        filedir = dirname(path) or '.'
+        if self.clean_dir and fs.exists(filedir):
+            fs.removedir(filedir)
         return True
 
     def initialize(self, size=0):
         """Initialize file on storage and truncate to given size."""
+        self._init_uncompressed()
         fs, path = self._get_fs()
 
         # Required for reliably opening the file on certain file systems:
@@ -81,6 +225,10 @@ class PyFSFileStorage(FileStorage):
             fp = fs.open(path, mode='wb')
 
         try:
+            # Preallocate first, so that a file which cannot fit is not
+            # created at its full size.
+            if self.preallocate and size:
+                preallocate(fp, size)
             fp.truncate(size)
         except Exception:
             fp.close()
@@ -127,6 +275,42 @@ class PyFSFileStorage(FileStorage):
 
         return bytes_written, checksum
 
+    def move(self, fileurl):
+        """Move the file to another URL.
+
+        The base directory of the old URL is removed.
+        """
+        dst = copy.copy(self)
+        dst.fileurl = fileurl
+        if self.base_uri and not fileurl.startswith(self.base_uri):
+            dst.base_uri = None
+
+        src_fs, src_path = self._get_fs(create_dir=False)
+        dst_fs, dst_path = dst._get_fs()
+        movefile(src_fs, src_path, dst_fs, dst_path)
+        self.delete()
+
+        self.fileurl = dst.fileurl
+        self.base_uri = dst.base_uri
+        return fileurl
+
+    def _get_local_path(self):
+        """Get the local path of the file, if it is not compressed."""
+        if self.compression is not None:
+            return None
+        fs, path = self._get_fs()
+        return fs.getsyspath(path, allow_none=True)
+
+    def _get_url(self):
+        """Get the URL of the file."""
+        return self.fileurl
+
+    def _get_offload_path(self):
+        """Get path used to let the front-end web server send the file."""
+        if self.compression is not None:
+            return None
+        return get_offload_path(self.fileurl)
+
 
 def pyfs_storage_factory(fileinstance=None, default_location=None,
                          default_storage_class=None,
@@ -137,26 +321,66 @@ def pyfs_storage_factory(fileinstance=None, default_location=None,
     # class parameters need to be specified
     assert fileinstance or (fileurl and size)
 
+    storage_class = default_storage_class
+    checksum_algorithm = None
+    base_uri = None
+    compression = None
     if fileinstance:
         # FIXME: Code here should be refactored since it assumes a lot on the
         # directory structure where the file instances are written
         fileurl = None
         size = fileinstance.size
         modified = fileinstance.updated
+        storage_class = fileinstance.storage_class or storage_class
+        compression_level = current_app.config[
+            'FILES_REST_STORAGE_COMPRESSION'].get(
+                storage_class or
+                current_app.config['FILES_REST_DEFAULT_STORAGE_CLASS'])
+        if fileinstance.checksum:
+            # Existing checksums are verified with their own algorithm.
+            checksum_algorithm = fileinstance.checksum.split(':', 1)[0]
 
         if fileinstance.uri:
             # Use already existing URL.
             fileurl = fileinstance.uri
+            if basename(fileurl) == 'data' + COMPRESSED_SUFFIX:
+                # The name alone tells that the file is compressed, as the
+                # configured level only applies to new files.
+                compression = 9 if compression_level is None \
+                    else compression_level
+            split = split_base_uri(fileurl, current_app.config[
+                'FILES_REST_STORAGE_PATH_DIMENSIONS'] + 2)
+            base_uri = split[0] if split else None
         else:
             assert default_location
+            base_uri = default_location
+            compression = compression_level
             # Generate a new URL.
             fileurl = make_path(
                 default_location,
                 str(fileinstance.id),
-                'data',
+                'data' if compression is None else 'data' + COMPRESSED_SUFFIX,
                 current_app.config['FILES_REST_STORAGE_PATH_DIMENSIONS'],
                 current_app.config['FILES_REST_STORAGE_PATH_SPLIT_LENGTH'],
             )
 
     return filestorage_class(
-        fileurl, size=size, modified=modified, clean_dir=clean_dir)
+        fileurl, size=size, modified=modified, clean_dir=clean_dir,
+        preallocate=current_app.config['FILES_REST_STORAGE_PREALLOCATE'],
+        base_uri=base_uri,
+        fs_cache=current_files_rest.fs_cache,
+        compression=compression,
+        pipeline_depth=current_app.config['FILES_REST_STORAGE_PIPELINE_DEPTH'],
+        buffer_pool=current_files_rest.buffer_pool,
+        checksum_algorithm=(
+            checksum_algorithm or get_checksum_algorithm(fileurl)),
+        checksum_workers=current_app.config['FILES_REST_CHECKSUM_WORKERS'],
+        copy_methods=current_app.config['FILES_REST_STORAGE_COPY_METHODS'],
+        scan_advice=current_app.config['FILES_REST_STORAGE_SCAN_ADVICE'],
+        scan_direct_io=current_app.config[
+            'FILES_REST_STORAGE_SCAN_DIRECT_IO'],
+        extra_checksum_algorithms=current_app.config[
+            'FILES_REST_STORAGE_EXTRA_CHECKSUMS'].get(
+                storage_class or
+                current_app.config['FILES_REST_DEFAULT_STORAGE_CLASS']),
+    )
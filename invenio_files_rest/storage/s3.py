@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Storage of files in S3 compatible object stores.
+
+Files are stored as objects named like the files of
+:class:`invenio_files_rest.storage.PyFSFileStorage`, in the bucket of the URL
+of their location (e.g. ``s3://<bucket>/<prefix>``). Requires ``boto3``,
+which is installed with the ``s3`` extra.
+"""
+
+from __future__ import absolute_import, print_function
+
+import io
+import tempfile
+import threading
+
+from flask import current_app
+
+from ..errors import StorageError
+from ..helpers import get_checksum_algorithm, make_path
+from ..proxies import current_files_rest
+from .base import FileStorage
+from .pyfs import pyfs_storage_factory
+
+S3_SCHEME = 's3://'
+"""Scheme of the URLs of files stored in S3."""
+
+
+def split_s3_url(fileurl):
+    """Split an S3 URL into a bucket name and a key.
+
+    :param fileurl: A ``s3://<bucket>/<key>`` URL.
+    :raises ValueError: If the URL is not an S3 URL.
+    """
+    if not fileurl.startswith(S3_SCHEME):
+        raise ValueError('Not an S3 URL: {0}'.format(fileurl))
+    bucket, dummy, key = fileurl[len(S3_SCHEME):].partition('/')
+    return bucket, key
+
+
+class S3ClientPool(object):
+    """Thread-safe pool of S3 clients, with one client per bucket.
+
+    Each client keeps its own pool of keep-alive HTTP connections, which is
+    shared by all threads using the bucket.
+    """
+
+    def __init__(self, client_kwargs=None, max_pool_connections=10):
+        """Initialize the pool.
+
+        :param client_kwargs: Keyword arguments of the clients (e.g.
+            ``endpoint_url`` or ``region_name``).
+        :param max_pool_connections: Maximum number of connections kept open
+            by each client.
+        """
+        self.client_kwargs = client_kwargs or {}
+        self.max_pool_connections = max_pool_connections
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket):
+        """Get the client of a bucket."""
+        with self._lock:
+            client = self._clients.get(bucket)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                # Sessions are not thread-safe, unlike clients.
+                client = self._clients[bucket] = boto3.session.Session(
+                ).client('s3', config=Config(
+                    max_pool_connections=self.max_pool_connections),
+                    **self.client_kwargs)
+            return client
+
+
+class S3File(io.RawIOBase):
+    """Read-only file object over an S3 object.
+
+    Data is read with a ranged GET request starting at the current position,
+    which is only repeated when seeking.
+    """
+
+    def __init__(self, client, bucket, key, size=None):
+        """Initialize the file object.
+
+        :param client: The S3 client.
+        :param bucket: The bucket name.
+        :param key: The object key.
+        :param size: The object size (fetched if not given).
+        """
+        super(S3File, self).__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self._size = size
+        self.pos = 0
+        self._body = None
+
+    @property
+    def size(self):
+        """Size of the object."""
+        if self._size is None:
+            self._size = self.client.head_object(
+                Bucket=self.bucket, Key=self.key)['ContentLength']
+        return self._size
+
+    def readable(self):
+        """Return ``True``."""
+        return True
+
+    def seekable(self):
+        """Return ``True``."""
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Change the position."""
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position {0}'.format(offset))
+        if offset != self.pos:
+            self._close_body()
+            self.pos = offset
+        return self.pos
+
+    def tell(self):
+        """Get the position."""
+        return self.pos
+
+    def readinto(self, buf):
+        """Read from the object into a buffer."""
+        if self.pos >= self.size:
+            return 0
+        if self._body is None:
+            self._body = self.client.get_object(
+                Bucket=self.bucket, Key=self.key,
+                Range='bytes={0}-'.format(self.pos))['Body']
+        data = self._body.read(len(buf))
+        n = len(data)
+        buf[:n] = data
+        self.pos += n
+        return n
+
+    def _close_body(self):
+        """Close the response of the current request."""
+        if self._body is not None:
+            body, self._body = self._body, None
+            body.close()
+
+    def close(self):
+        """Close the file."""
+        self._close_body()
+        super(S3File, self).close()
+
+
+class S3UploadWriter(object):
+    """Write-only file object uploading a stream to an S3 object.
+
+    Data is spooled into parts, which are uploaded one at a time with a
+    multipart upload. Objects smaller than one part are uploaded with a single
+    request.
+    """
+
+    def __init__(self, storage, part_size):
+        """Initialize the file object.
+
+        :param storage: The :class:`S3FileStorage`.
+        :param part_size: The part size.
+        """
+        self.storage = storage
+        self.part_size = part_size
+        self.upload_id = None
+        self.parts = []
+        self._spool = None
+        self._spool_size = 0
+
+    def write(self, data):
+        """Write data, uploading each part once it is complete."""
+        view = memoryview(data)
+        while len(view):
+            if self._spool is None:
+                self._spool = tempfile.SpooledTemporaryFile(
+                    max_size=self.part_size)
+                self._spool_size = 0
+            n = min(len(view), self.part_size - self._spool_size)
+            self._spool.write(view[:n])
+            self._spool_size += n
+            view = view[n:]
+            if self._spool_size == self.part_size:
+                self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        """Upload the spooled part."""
+        s = self.storage
+        if self.upload_id is None:
+            self.upload_id = s.client.create_multipart_upload(
+                Bucket=s.bucket, Key=s.key)['UploadId']
+        part_number = len(self.parts) + 1
+        self._spool.seek(0)
+        try:
+            etag = s.client.upload_part(
+                Bucket=s.bucket, Key=s.key, UploadId=self.upload_id,
+                PartNumber=part_number, Body=self._spool,
+                ContentLength=self._spool_size)['ETag']
+        finally:
+            self._spool.close()
+            self._spool = None
+        self.parts.append(dict(ETag=etag, PartNumber=part_number))
+
+    def close(self):
+        """Upload the last part and complete the upload."""
+        s = self.storage
+        if self.upload_id is None:
+            if self._spool is None:
+                s.client.put_object(Bucket=s.bucket, Key=s.key, Body=b'')
+                return
+            self._spool.seek(0)
+            try:
+                s.client.put_object(
+                    Bucket=s.bucket, Key=s.key, Body=self._spool,
+                    ContentLength=self._spool_size)
+            finally:
+                self._spool.close()
+                self._spool = None
+            return
+        if self._spool is not None:
+            self._upload_part()
+        s.client.complete_multipart_upload(
+            Bucket=s.bucket, Key=s.key, UploadId=self.upload_id,
+            MultipartUpload=dict(Parts=self.parts))
+
+    def abort(self):
+        """Abort the upload."""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self.upload_id is not None:
+            s = self.storage
+            s.client.abort_multipart_upload(
+                Bucket=s.bucket, Key=s.key, UploadId=self.upload_id)
+
+
+class S3FileStorage(FileStorage):
+    """Storage of files in an S3 compatible object store.
+
+    Files are saved with streamed multipart uploads. Files initialized with
+    :meth:`initialize` are written in parts with :meth:`update`, each part
+    being uploaded as the part of an S3 multipart upload, which is completed
+    by :meth:`complete`.
+    """
+
+    def __init__(self, fileurl, client_pool=None, part_size=8 * 1024 * 1024,
+                 upload_part_size=None, **kwargs):
+        """Storage initialization.
+
+        :param fileurl: The ``s3://<bucket>/<key>`` URL of the file.
+        :param client_pool: The :class:`S3ClientPool` (a new one by default).
+        :param part_size: Part size of uploaded streams (see
+            :data:`invenio_files_rest.config.FILES_REST_S3_PART_SIZE`).
+        :param upload_part_size: Size of the parts written by :meth:`update`
+            (i.e. the chunk size of the multipart object of the file).
+        """
+        super(S3FileStorage, self).__init__(**kwargs)
+        self.fileurl = fileurl
+        self.bucket, self.key = split_s3_url(fileurl)
+        self.client_pool = client_pool or S3ClientPool()
+        self.part_size = part_size
+        self.upload_part_size = upload_part_size
+        self._upload_id = None
+
+    @property
+    def client(self):
+        """S3 client of the bucket of the file."""
+        return self.client_pool.get(self.bucket)
+
+    def open(self, mode='rb'):
+        """Open file.
+
+        The caller is responsible for closing the file.
+        """
+        if mode != 'rb':
+            raise StorageError('S3 files can only be opened for reading.')
+        return S3File(self.client, self.bucket, self.key, size=self._size)
+
+    def delete(self):
+        """Delete a file, and abort its unfinished uploads."""
+        for upload_id in self._list_upload_ids():
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+        self.client.delete_object(Bucket=self.bucket, Key=self.key)
+        return True
+
+    def initialize(self, size=0):
+        """Initialize the file, to be written in parts with :meth:`update`.
+
+        Objects cannot be preallocated, so a multipart upload is started
+        instead (an empty object is created if the size is zero).
+        """
+        if size:
+            self._upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        else:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=b'')
+
+        self._size = size
+
+        return self.fileurl, size, None
+
+    def save(self, incoming_stream, size_limit=None, size=None,
+             chunk_size=None, progress_callback=None):
+        """Save file in the object store."""
+        fp = S3UploadWriter(self, self.part_size)
+        try:
+            bytes_written, checksum = self._write_stream(
+                incoming_stream, fp, chunk_size=chunk_size,
+                progress_callback=progress_callback,
+                size_limit=size_limit, size=size)
+            fp.close()
+        except Exception:
+            fp.abort()
+            raise
+
+        self._size = bytes_written
+
+        return self.fileurl, bytes_written, checksum
+
+    def update(self, incoming_stream, seek=0, size=None, chunk_size=None,
+               progress_callback=None):
+        """Upload a part of a file initialized with :meth:`initialize`.
+
+        The data is spooled, and uploaded as the part of the multipart upload
+        starting at the given offset.
+        """
+        if not self.upload_part_size or seek % self.upload_part_size:
+            raise StorageError(
+                'S3 files can only be updated in parts of a multipart '
+                'upload.')
+        upload_id = self._get_upload_id()
+        spool = tempfile.SpooledTemporaryFile(max_size=self.part_size)
+        try:
+            bytes_written, checksum = self._write_stream(
+                incoming_stream, spool, chunk_size=chunk_size,
+                size=size, progress_callback=progress_callback)
+            spool.seek(0)
+            self.client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                PartNumber=seek // self.upload_part_size + 1, Body=spool,
+                ContentLength=bytes_written)
+        finally:
+            spool.close()
+
+        return bytes_written, checksum
+
+    def complete(self):
+        """Complete the multipart upload of the parts written so far."""
+        upload_id = self._get_upload_id()
+        parts = []
+        kwargs = {}
+        while 1:
+            res = self.client.list_parts(
+                Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                **kwargs)
+            parts.extend(
+                dict(ETag=p['ETag'], PartNumber=p['PartNumber'])
+                for p in res.get('Parts', []))
+            if not res.get('IsTruncated'):
+                break
+            kwargs['PartNumberMarker'] = res['NextPartNumberMarker']
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+            MultipartUpload=dict(Parts=parts))
+        self._upload_id = None
+
+    def move(self, fileurl):
+        """Move the file to another URL, copying it on the server."""
+        bucket, key = split_s3_url(fileurl)
+        self.client_pool.get(bucket).copy(
+            dict(Bucket=self.bucket, Key=self.key), bucket, key)
+        self.client.delete_object(Bucket=self.bucket, Key=self.key)
+
+        self.fileurl = fileurl
+        self.bucket, self.key = bucket, key
+        return fileurl
+
+    def _get_url(self):
+        """Get the URL of the file."""
+        return self.fileurl
+
+    def _list_upload_ids(self):
+        """List the IDs of the unfinished multipart uploads of the file."""
+        upload_ids = []
+        kwargs = {}
+        while 1:
+            res = self.client.list_multipart_uploads(
+                Bucket=self.bucket, Prefix=self.key, **kwargs)
+            upload_ids.extend(
+                u['UploadId'] for u in sorted(
+                    res.get('Uploads', []), key=lambda u: u['Initiated'])
+                if u['Key'] == self.key)
+            if not res.get('IsTruncated'):
+                break
+            kwargs = dict(KeyMarker=res['NextKeyMarker'],
+                          UploadIdMarker=res['NextUploadIdMarker'])
+        return upload_ids
+
+    def _get_upload_id(self):
+        """Get the ID of the multipart upload of the file."""
+        if self._upload_id is None:
+            upload_ids = self._list_upload_ids()
+            if not upload_ids:
+                raise StorageError(
+                    'No multipart upload of {0}.'.format(self.fileurl))
+            # The most recent upload.
+            self._upload_id = upload_ids[-1]
+        return self._upload_id
+
+
+def s3_storage_factory(fileinstance=None, default_location=None,
+                       default_storage_class=None,
+                       filestorage_class=S3FileStorage, fileurl=None,
+                       size=None, modified=None, clean_dir=True):
+    """Get factory function for creating an S3 file storage instance.
+
+    Files whose location is not an S3 URL are stored with
+    :func:`invenio_files_rest.storage.pyfs_storage_factory`, so that files can
+    be migrated between locations of both kinds.
+    """
+    url = (fileinstance.uri if fileinstance else fileurl) or default_location
+    if not url or not url.startswith(S3_SCHEME):
+        return pyfs_storage_factory(
+            fileinstance=fileinstance, default_location=default_location,
+            default_storage_class=default_storage_class, fileurl=fileurl,
+            size=size, modified=modified, clean_dir=clean_dir)
+
+    # Either the FileInstance needs to be specified or all filestorage
+    # class parameters need to be specified
+    assert fileinstance or (fileurl and size)
+
+    storage_class = default_storage_class
+    checksum_algorithm = None
+    upload_part_size = None
+    if fileinstance:
+        size = fileinstance.size
+        modified = fileinstance.updated
+        storage_class = fileinstance.storage_class or storage_class
+        if fileinstance.checksum:
+            # Existing checksums are verified with their own algorithm.
+            checksum_algorithm = fileinstance.checksum.split(':', 1)[0]
+        if fileinstance.multipart_objects:
+            # Parts of multipart objects are uploaded as S3 parts.
+            upload_part_size = fileinstance.multipart_objects[0].chunk_size
+
+        if fileinstance.uri:
+            fileurl = fileinstance.uri
+        else:
+            # Generate a new URL.
+            fileurl = make_path(
+                default_location,
+                str(fileinstance.id),
+                'data',
+                current_app.config['FILES_REST_STORAGE_PATH_DIMENSIONS'],
+                current_app.config['FILES_REST_STORAGE_PATH_SPLIT_LENGTH'],
+            )
+
+    return filestorage_class(
+        fileurl, size=size, modified=modified,
+        client_pool=current_files_rest.s3_clients,
+        part_size=current_app.config['FILES_REST_S3_PART_SIZE'],
+        upload_part_size=upload_part_size,
+        pipeline_depth=current_app.config['FILES_REST_STORAGE_PIPELINE_DEPTH'],
+        buffer_pool=current_files_rest.buffer_pool,
+        checksum_algorithm=(
+            checksum_algorithm or get_checksum_algorithm(fileurl)),
+        checksum_workers=current_app.config['FILES_REST_CHECKSUM_WORKERS'],
+        extra_checksum_algorithms=current_app.config[
+            'FILES_REST_STORAGE_EXTRA_CHECKSUMS'].get(
+                storage_class or
+                current_app.config['FILES_REST_DEFAULT_STORAGE_CLASS']),
+    )
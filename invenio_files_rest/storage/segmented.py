@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Storage of files as fixed size segment files.
+
+Each file is stored in a directory, with one file per segment and a small
+JSON manifest recording the file size and the segment size::
+
+    <file url>/manifest.json
+    <file url>/00000000
+    <file url>/00000001
+    ...
+
+Segments are separate files, so they can be written and read in parallel
+(e.g. the parts of a multipart upload, or the segments of a tree checksum)
+without contending on a single inode.
+"""
+
+from __future__ import absolute_import, print_function
+
+import io
+import json
+import os
+import shutil
+from functools import partial
+
+from flask import current_app
+
+from ..errors import StorageError
+from .base import preallocate
+from .local import DescriptorFile, LocalFileStorage, pread_into, pwrite
+from .pyfs import pyfs_storage_factory
+
+MANIFEST_NAME = 'manifest.json'
+"""Name of the manifest file."""
+
+
+class SegmentedFile(io.RawIOBase):
+    """Read-only file object over the segments of a file."""
+
+    def __init__(self, storage, size, segment_size):
+        """Initialize the file object.
+
+        :param storage: The :class:`SegmentedFileStorage`.
+        :param size: The file size.
+        :param segment_size: The segment size.
+        """
+        super(SegmentedFile, self).__init__()
+        self.storage = storage
+        self.size = size
+        self.segment_size = segment_size
+        self.pos = 0
+        self._fds = {}
+
+    def readable(self):
+        """Return ``True``."""
+        return True
+
+    def seekable(self):
+        """Return ``True``."""
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Change the position."""
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position {0}'.format(offset))
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        """Get the position."""
+        return self.pos
+
+    def readinto(self, buf):
+        """Read from a single segment into a buffer."""
+        number, offset = divmod(self.pos, self.segment_size)
+        n = min(len(buf), self.size - self.pos, self.segment_size - offset)
+        if n <= 0:
+            return 0
+        fd = self._fds.get(number)
+        if fd is None:
+            fd = self._fds[number] = os.open(
+                self.storage.get_segment_path(number), os.O_RDONLY)
+        n = pread_into(fd, memoryview(buf)[:n], offset)
+        self.pos += n
+        return n
+
+    def close(self):
+        """Close the segment files."""
+        while self._fds:
+            os.close(self._fds.popitem()[1])
+        super(SegmentedFile, self).close()
+
+
+class SegmentedWriter(object):
+    """Write-only file object over the segments of a file."""
+
+    def __init__(self, storage, segment_size, offset=0, truncate=False):
+        """Initialize the file object.
+
+        :param storage: The :class:`SegmentedFileStorage`.
+        :param segment_size: The segment size.
+        :param offset: The offset of the first write.
+        :param truncate: Truncate the segments when opening them.
+        """
+        self.storage = storage
+        self.segment_size = segment_size
+        self.offset = offset
+        self.truncate = truncate
+        self._number = None
+        self._fd = None
+
+    def _get_fd(self, number):
+        """Get the file descriptor of a segment (only one is kept open)."""
+        if number != self._number:
+            self.close()
+            flags = os.O_WRONLY | os.O_CREAT
+            if self.truncate:
+                flags |= os.O_TRUNC
+            self._fd = os.open(
+                self.storage.get_segment_path(number), flags, 0o666)
+            self._number = number
+        return self._fd
+
+    def write(self, data):
+        """Write data at the current offset."""
+        view = memoryview(data)
+        while len(view):
+            number, offset = divmod(self.offset, self.segment_size)
+            n = min(len(view), self.segment_size - offset)
+            n = pwrite(self._get_fd(number), view[:n], offset)
+            self.offset += n
+            view = view[n:]
+        return len(data)
+
+    def close(self):
+        """Close the file descriptor of the current segment."""
+        if self._fd is not None:
+            fd, self._fd, self._number = self._fd, None, None
+            os.close(fd)
+
+
+class SegmentedFileStorage(LocalFileStorage):
+    """File system storage of files as fixed size segment files.
+
+    Files are not compressed, and cannot be offloaded to the front-end web
+    server.
+    """
+
+    def __init__(self, fileurl, segment_size=64 * 1024 * 1024, **kwargs):
+        """Storage initialization.
+
+        :param segment_size: The segment size of new files (see
+            :data:`invenio_files_rest.config.FILES_REST_STORAGE_SEGMENT_SIZE`).
+            Existing files use the segment size of their manifest.
+        """
+        super(SegmentedFileStorage, self).__init__(fileurl, **kwargs)
+        self.compression = None
+        self.segment_size = segment_size
+
+    def get_segment_path(self, number):
+        """Get the path of a segment file."""
+        return os.path.join(self.path, '{0:08d}'.format(number))
+
+    def _read_manifest(self):
+        """Read the manifest of the file."""
+        with io.open(os.path.join(self.path, MANIFEST_NAME), 'rb') as fp:
+            return json.loads(fp.read().decode('utf-8'))
+
+    def _write_manifest(self, size, segment_size):
+        """Write the manifest of the file, replacing it atomically."""
+        path = os.path.join(self.path, MANIFEST_NAME)
+        with io.open(path + '.tmp', 'wb') as fp:
+            fp.write(json.dumps(dict(
+                size=size, segment_size=segment_size)).encode('utf-8'))
+        os.rename(path + '.tmp', path)
+
+    def _make_dir(self, path=None):
+        """Create the directory of the segments."""
+        super(SegmentedFileStorage, self)._make_dir(
+            os.path.join(path or self.path, MANIFEST_NAME))
+
+    def open(self, mode='rb'):
+        """Open file.
+
+        The caller is responsible for closing the file.
+        """
+        if mode != 'rb':
+            raise StorageError(
+                'Segmented files can only be opened for reading.')
+        manifest = self._read_manifest()
+        return SegmentedFile(
+            self, manifest['size'], manifest['segment_size'])
+
+    def delete(self):
+        """Delete a file.
+
+        The base directory is also removed, as it is assumed that only one file
+        exists in the directory.
+        """
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        filedir = os.path.dirname(self.path)
+        if self.clean_dir and os.path.isdir(filedir):
+            os.rmdir(filedir)
+        return True
+
+    def initialize(self, size=0):
+        """Initialize the segments of the file."""
+        self._make_dir()
+        try:
+            for number in range(0, (size + self.segment_size - 1) //
+                                self.segment_size):
+                fp = DescriptorFile(os.open(
+                    self.get_segment_path(number), os.O_RDWR | os.O_CREAT,
+                    0o666))
+                try:
+                    length = min(
+                        self.segment_size, size - number * self.segment_size)
+                    os.ftruncate(fp.fileno(), length)
+                    if self.preallocate:
+                        preallocate(fp, length)
+                finally:
+                    fp.close()
+            self._write_manifest(size, self.segment_size)
+        except Exception:
+            self.delete()
+            raise
+
+        self._size = size
+
+        return self.fileurl, size, None
+
+    def save(self, incoming_stream, size_limit=None, size=None,
+             chunk_size=None, progress_callback=None):
+        """Save file in the file system."""
+        self._make_dir()
+        fp = SegmentedWriter(self, self.segment_size, truncate=True)
+        try:
+            bytes_written, checksum = self._write_stream(
+                incoming_stream, fp, chunk_size=chunk_size,
+                progress_callback=progress_callback,
+                size_limit=size_limit, size=size)
+            fp.close()
+            self._write_manifest(bytes_written, self.segment_size)
+            # Remove the segments of previous contents.
+            number = (bytes_written + self.segment_size - 1) // \
+                self.segment_size
+            while os.path.exists(self.get_segment_path(number)):
+                os.remove(self.get_segment_path(number))
+                number += 1
+        except Exception:
+            fp.close()
+            self.delete()
+            raise
+
+        self._size = bytes_written
+
+        return self.fileurl, bytes_written, checksum
+
+    def update(self, incoming_stream, seek=0, size=None, chunk_size=None,
+               progress_callback=None):
+        """Update a file in the file system.
+
+        Only the segments containing the updated range are opened, so
+        updates of different segments can run in parallel.
+        """
+        fp = SegmentedWriter(
+            self, self._read_manifest()['segment_size'], offset=seek)
+        try:
+            bytes_written, checksum = self._write_stream(
+                incoming_stream, fp, chunk_size=chunk_size,
+                size=size, progress_callback=progress_callback)
+        finally:
+            fp.close()
+
+        return bytes_written, checksum
+
+    def move(self, fileurl):
+        """Move the file to another URL.
+
+        The base directory of the old URL is removed.
+        """
+        path = self.path
+        self.fileurl = fileurl
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        super(SegmentedFileStorage, self)._make_dir()
+        os.rename(path, self.path)
+
+        filedir = os.path.dirname(path)
+        if self.clean_dir and os.path.isdir(filedir):
+            os.rmdir(filedir)
+        return fileurl
+
+    def _get_local_path(self):
+        """Segmented files are not stored as is."""
+        return None
+
+    def _open_scan(self):
+        """Open the file to read it once, without direct I/O."""
+        return self.open(mode='rb')
+
+    def _get_offload_path(self):
+        """Segmented files cannot be sent by the web server."""
+        return None
+
+
+def segmented_storage_factory(fileinstance=None, default_location=None,
+                              default_storage_class=None,
+                              filestorage_class=SegmentedFileStorage,
+                              fileurl=None, size=None, modified=None,
+                              clean_dir=True):
+    """Get factory function for creating a segmented file storage instance.
+
+    Each part of a multipart upload is stored in its own segment.
+    """
+    segment_size = current_app.config['FILES_REST_STORAGE_SEGMENT_SIZE']
+    if fileinstance is not None and not fileinstance.uri and \
+            fileinstance.multipart_objects:
+        segment_size = fileinstance.multipart_objects[0].chunk_size
+
+    return pyfs_storage_factory(
+        fileinstance=fileinstance, default_location=default_location,
+        default_storage_class=default_storage_class,
+        filestorage_class=partial(
+            filestorage_class, segment_size=segment_size),
+        fileurl=fileurl, size=size, modified=modified, clean_dir=clean_dir)
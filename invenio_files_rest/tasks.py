@@ -12,7 +12,7 @@ from __future__ import absolute_import, print_function
 
 import math
 import uuid
-from datetime import date, datetime, timedelta
+from datetime import datetime, timedelta
 
 import sqlalchemy as sa
 from celery import current_app as current_celery
@@ -23,7 +23,9 @@ from flask import current_app
 from invenio_db import db
 from sqlalchemy.exc import IntegrityError
 
-from .models import FileInstance, Location, MultipartObject, ObjectVersion
+from .models import BucketSizeDelta, FileInstance, Location, MultipartObject, \
+    ObjectVersion
+from .proxies import current_files_rest
 from .utils import obj_or_import_string
 
 logger = get_task_logger(__name__)
@@ -110,8 +112,6 @@ def schedule_checksum_verification(frequency=None, batch_interval=None,
 
     files = obj_or_import_string(
         files_query, default=default_checksum_verification_files_query)()
-    files = files.order_by(
-        sa.func.coalesce(FileInstance.last_check_at, date.min))
 
     if max_count is not None:
         all_files_count = files.count()
@@ -123,7 +123,6 @@ def schedule_checksum_verification(frequency=None, batch_interval=None,
                  'minimum batch file count required ({1}) in order to achieve '
                  'the file checks over the specified period ({2}).'
                  .format(max_count, min_count, frequency))
-        files = files.limit(max_count)
 
     if max_size is not None:
         all_files_size = db.session.query(
@@ -137,14 +136,29 @@ def schedule_checksum_verification(frequency=None, batch_interval=None,
                  'achieve the file checks over the specified period ({2}).'
                  .format(max_size, min_size, frequency))
 
-    files = files.yield_per(1000)
+    # The files never checked come first, then the least recently checked
+    # ones. Both queries can use the index on "last_check_at", unlike an
+    # ordering on e.g. "coalesce(last_check_at, ...)".
+    queries = [
+        files.filter(FileInstance.last_check_at.is_(None)),
+        files.filter(FileInstance.last_check_at.isnot(None)).order_by(
+            FileInstance.last_check_at),
+    ]
     scheduled_file_ids = []
     total_size = 0
-    for f in files:
-        # Add at least the first file, since it might be larger than "max_size"
-        scheduled_file_ids.append(str(f.id))
-        total_size += f.size
-        if max_size and max_size <= total_size:
+    for query in queries:
+        if max_count is not None:
+            query = query.limit(max_count - len(scheduled_file_ids))
+        for f in query.yield_per(1000):
+            # Add at least the first file, since it might be larger than
+            # "max_size".
+            scheduled_file_ids.append(str(f.id))
+            total_size += f.size
+            if max_size and max_size <= total_size:
+                break
+        if (max_size and max_size <= total_size) or (
+                max_count is not None and
+                len(scheduled_file_ids) >= max_count):
             break
     group(
         verify_checksum.s(
@@ -163,8 +177,9 @@ def migrate_file(src_id, location_name, post_fixity_check=False):
 
     :param src_id: The :class:`invenio_files_rest.models.FileInstance` ID.
     :param location_name: Where to migrate the file.
-    :param post_fixity_check: Verify checksum after migration.
-        (Default: ``False``)
+    :param post_fixity_check: Verify checksum during migration, by comparing
+        the checksum of the copied data with the checksum of the source file
+        instance. (Default: ``False``)
     """
     location = Location.get_by_name(location_name)
     f_src = FileInstance.get(src_id)
@@ -179,6 +194,7 @@ def migrate_file(src_id, location_name, post_fixity_check=False):
             f_src,
             progress_callback=progress_updater,
             default_location=location.uri,
+            fixity_check=post_fixity_check,
         )
         db.session.commit()
     except Exception:
@@ -191,10 +207,6 @@ def migrate_file(src_id, location_name, post_fixity_check=False):
     ObjectVersion.relink_all(f_src, f_dst)
     db.session.commit()
 
-    # Start a fixity check
-    if post_fixity_check:
-        verify_checksum.delay(str(f_dst.id))
-
 
 @shared_task(ignore_result=True)
 def remove_file_data(file_id, silent=True):
@@ -265,3 +277,26 @@ def remove_expired_multipartobjects():
 
     for fid in file_ids:
         remove_file_data.delay(fid)
+
+
+@shared_task(ignore_result=True)
+def fold_bucket_size_deltas():
+    """Fold the size deltas of the buckets into their size.
+
+    Should be scheduled periodically, so that the ledger of size deltas
+    stays small (see :class:`invenio_files_rest.models.BucketSizeDelta`).
+    """
+    BucketSizeDelta.fold()
+    db.session.commit()
+
+
+@shared_task(ignore_result=True)
+def evict_storage_cache():
+    """Remove the least recently used files of the read-through cache.
+
+    Should be scheduled periodically, so that the cache stays within
+    :data:`invenio_files_rest.config.FILES_REST_STORAGE_CACHE_SIZE` (see
+    :class:`invenio_files_rest.storage.cache.StorageCache`).
+    """
+    if current_files_rest.storage_cache is not None:
+        current_files_rest.storage_cache.evict()
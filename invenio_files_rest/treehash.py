@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Tree checksums built from fixed size segments.
+
+A tree checksum splits a file in segments of a fixed size, hashes each
+segment separately and hashes the concatenation of the (binary) segment
+digests into the root digest. Segments are independent, so the checksum of an
+existing file can be computed by several threads in parallel, and the segment
+digests can be used to verify parts of a file.
+
+Tree algorithms are named ``<algorithm>-tree-<segment size>``, e.g.
+``sha256-tree-64M``, where the segment size is in bytes and may have a ``K``,
+``M`` or ``G`` suffix.
+"""
+
+from __future__ import absolute_import, print_function
+
+import binascii
+import re
+
+_tree_algorithm_re = re.compile(
+    r'^(?P<algo>.+)-tree-(?P<size>\d+)(?P<unit>[KMG]?)$')
+
+_units = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 * 1024,
+    'G': 1024 * 1024 * 1024,
+}
+
+
+def parse_tree_algorithm(algo):
+    """Parse the name of a tree checksum algorithm.
+
+    :param algo: The algorithm name.
+    :returns: A tuple ``(segment algorithm, segment size)`` or ``None`` if the
+        algorithm is not a tree algorithm.
+    """
+    match = _tree_algorithm_re.match(algo)
+    if not match:
+        return None
+    size = int(match.group('size')) * _units[match.group('unit')]
+    if not size:
+        return None
+    return match.group('algo'), size
+
+
+class TreeHash(object):
+    """Message digest of a tree checksum.
+
+    The object can be updated with a stream of data like any message digest,
+    or be given the segment digests computed elsewhere.
+    """
+
+    def __init__(self, factory, segment_size):
+        """Initialize the digest.
+
+        :param factory: Function returning a new message digest object for a
+            segment (and for the root digest).
+        :param segment_size: The segment size in bytes.
+        """
+        self.factory = factory
+        self.segment_size = segment_size
+        self.segments = []
+        self.size = 0
+        self._current = None
+        self._current_size = 0
+
+    def update(self, data):
+        """Update the digest with a chunk of data."""
+        view = memoryview(data)
+        self.size += len(view)
+        while len(view):
+            if self._current is None:
+                self._current = self.factory()
+                self._current_size = 0
+            n = min(len(view), self.segment_size - self._current_size)
+            self._current.update(view[:n])
+            self._current_size += n
+            view = view[n:]
+            if self._current_size == self.segment_size:
+                self.segments.append(self._current.hexdigest())
+                self._current = None
+
+    def segment_count(self, size):
+        """Get the number of segments of a file.
+
+        :param size: The file size.
+        """
+        return (size + self.segment_size - 1) // self.segment_size
+
+    def segment_digests(self):
+        """Get the hex digests of all segments, including the last one."""
+        if self._current is not None:
+            return self.segments + [self._current.hexdigest()]
+        return list(self.segments)
+
+    def hexdigest(self):
+        """Get the root digest."""
+        root = self.factory()
+        for digest in self.segment_digests():
+            root.update(binascii.unhexlify(digest))
+        return root.hexdigest()
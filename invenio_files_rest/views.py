@@ -10,9 +10,12 @@
 
 from __future__ import absolute_import, print_function
 
+import base64
 import uuid
+from datetime import datetime
 from functools import partial, wraps
 
+import six
 from flask import Blueprint, abort, current_app, json, request
 from flask_login import current_user
 from invenio_db import db
@@ -23,7 +26,8 @@ from webargs import fields
 from webargs.flaskparser import use_kwargs
 
 from .errors import DuplicateTagError, ExhaustedStreamError, FileSizeError, \
-    InvalidTagError, MissingQueryParameter, MultipartInvalidChunkSize
+    InvalidContinuationTokenError, InvalidTagError, MissingQueryParameter, \
+    MultipartInvalidChunkSize
 from .models import Bucket, MultipartObject, ObjectVersion, ObjectVersionTag, \
     Part
 from .proxies import current_files_rest, current_permission_factory
@@ -64,6 +68,56 @@ def invalid_subresource_validator(value):
     abort(405)
 
 
+def max_keys_validator(value):
+    """Validate the maximum number of keys of a listing."""
+    return 0 < value <= current_app.config['FILES_REST_MAX_LIST_KEYS']
+
+
+CONTINUATION_TOKEN_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_continuation_token(marker):
+    """Encode the marker of a page as an opaque continuation token.
+
+    :param marker: A marker of
+        :meth:`invenio_files_rest.models.ObjectVersion.get_page`.
+    :returns: The continuation token.
+    """
+    key, created, version_id = marker
+    data = [key]
+    if created is not None:
+        data.extend([
+            created.strftime(CONTINUATION_TOKEN_DATETIME_FORMAT),
+            str(version_id),
+        ])
+    return base64.urlsafe_b64encode(
+        json.dumps(data).encode('utf-8')).decode('ascii')
+
+
+def decode_continuation_token(token):
+    """Decode a continuation token to the marker of a page.
+
+    :raises invenio_files_rest.errors.InvalidContinuationTokenError: If the
+        token is invalid.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            token.encode('ascii')).decode('utf-8'))
+        key = data[0]
+        if not key or not isinstance(key, six.string_types):
+            raise ValueError('Invalid key.')
+        if len(data) == 1:
+            return key, None, None
+        key, created, version_id = data
+        return (
+            key,
+            datetime.strptime(created, CONTINUATION_TOKEN_DATETIME_FORMAT),
+            uuid.UUID(version_id),
+        )
+    except (LookupError, TypeError, ValueError, UnicodeError):
+        raise InvalidContinuationTokenError()
+
+
 def validate_tag(key, value):
     """Validate a tag.
 
@@ -370,7 +424,26 @@ class BucketResource(ContentNegotiatedMethodView):
         ),
         'uploads': fields.Raw(
             location='query',
-        )
+        ),
+        'prefix': fields.Str(
+            location='query',
+            missing=None,
+        ),
+        'delimiter': fields.Str(
+            location='query',
+            missing=None,
+        ),
+        'max_keys': fields.Int(
+            location='query',
+            load_from='max-keys',
+            missing=None,
+            validate=max_keys_validator,
+        ),
+        'continuation_token': fields.Str(
+            location='query',
+            load_from='continuation-token',
+            missing=None,
+        ),
     }
 
     def __init__(self, *args, **kwargs):
@@ -394,13 +467,19 @@ class BucketResource(ContentNegotiatedMethodView):
         )
 
     @need_permissions(
-        lambda self, bucket, versions: bucket,
+        lambda self, bucket, versions, **kwargs: bucket,
         'bucket-read',
     )
-    def listobjects(self, bucket, versions):
+    def listobjects(self, bucket, versions, prefix=None, delimiter=None,
+                    max_keys=None, continuation_token=None):
         """List objects in a bucket.
 
         :param bucket: A :class:`invenio_files_rest.models.Bucket` instance.
+        :param prefix: Only list the objects with keys starting with prefix.
+        :param delimiter: Roll up the keys containing the delimiter after the
+            prefix into common prefixes.
+        :param max_keys: Maximum number of objects and common prefixes.
+        :param continuation_token: Token of the page to list.
         :returns: The Flask response.
         """
         if versions is not missing:
@@ -408,19 +487,31 @@ class BucketResource(ContentNegotiatedMethodView):
                 current_permission_factory(bucket, 'bucket-read-versions'),
                 hidden=False
             )
+        objects, common_prefixes, next_marker = ObjectVersion.get_page(
+            bucket.id,
+            prefix=prefix,
+            delimiter=delimiter or None,
+            max_keys=max_keys or current_app.config[
+                'FILES_REST_MAX_LIST_KEYS'],
+            marker=decode_continuation_token(continuation_token)
+            if continuation_token else None,
+            versions=versions is not missing,
+        )
         return self.make_response(
-            data=ObjectVersion.get_by_bucket(
-                bucket.id, versions=versions is not missing).limit(1000).all(),
+            data=objects,
             context={
                 'class': ObjectVersion,
                 'bucket': bucket,
                 'many': True,
+                'common_prefixes': common_prefixes if delimiter else None,
+                'next_continuation_token': encode_continuation_token(
+                    next_marker) if next_marker else None,
             }
         )
 
     @use_kwargs(get_args)
     @pass_bucket
-    def get(self, bucket=None, versions=missing, uploads=missing):
+    def get(self, bucket=None, versions=missing, uploads=missing, **kwargs):
         """Get list of objects in the bucket.
 
         :param bucket: A :class:`invenio_files_rest.models.Bucket` instance.
@@ -429,7 +520,7 @@ class BucketResource(ContentNegotiatedMethodView):
         if uploads is not missing:
             return self.multipart_listuploads(bucket)
         else:
-            return self.listobjects(bucket, versions)
+            return self.listobjects(bucket, versions, **kwargs)
 
     @pass_bucket
     @need_bucket_permission('bucket-read')
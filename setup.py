@@ -27,6 +27,8 @@ tests_require = [
     'invenio-celery>=1.0.0',
     'isort>=4.3.4',
     'mock>=1.3.0',
+    'moto>=1.3.7,<5.0.0;python_version<"3.8"',
+    'moto>=5.0.0;python_version>="3.8"',
     'pydocstyle>=1.0.0',
     'pytest-cov>=1.8.0',
     'pytest-pep8>=1.0.6',
@@ -44,6 +46,9 @@ extras_require = {
     'mysql': [
         'invenio-db[mysql]>=1.0.0',
     ],
+    's3': [
+        'boto3>=1.9.0',
+    ],
     'sqlite': [
         'invenio-db>=1.0.0',
     ],
@@ -176,6 +176,36 @@ def extra_location(db):
     shutil.rmtree(tmppath)
 
 
+@pytest.yield_fixture()
+def s3_location(app, db):
+    """S3 location, in a bucket mocked with moto."""
+    boto3 = pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    app.config.update(dict(
+        FILES_REST_STORAGE_FACTORY=(
+            'invenio_files_rest.storage.s3_storage_factory'),
+        FILES_REST_S3_CLIENT_KWARGS=dict(
+            region_name='us-east-1',
+            aws_access_key_id='testing',
+            aws_secret_access_key='testing',
+        ),
+    ))
+
+    # moto 5 mocks all services at once, older versions only S3.
+    with getattr(moto, 'mock_aws', getattr(moto, 'mock_s3', None))():
+        boto3.client('s3', **app.config['FILES_REST_S3_CLIENT_KWARGS']) \
+            .create_bucket(Bucket='testbucket')
+        loc = Location(
+            name='s3',
+            uri='s3://testbucket/files',
+            default=False
+        )
+        db.session.add(loc)
+        db.session.commit()
+
+        yield loc
+
+
 @pytest.fixture()
 def bucket(db, dummy_location):
     """File system location."""
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Buffer pool tests."""
+
+from __future__ import absolute_import, print_function
+
+import threading
+
+from six import BytesIO
+
+from invenio_files_rest.buffers import BufferPool, read_into
+
+
+def test_buffer_pool_reuse():
+    """Test that released buffers are reused."""
+    pool = BufferPool(100, min_chunk_size=10)
+    buf = pool.acquire(40)
+    assert len(buf) == 40
+    pool.release(buf)
+    assert pool.acquire(40) is buf
+    assert pool.allocated == 40
+
+    # Requests bigger than the pool are clamped.
+    pool.release(buf)
+    assert len(pool.acquire(1000)) == 100
+    assert pool.allocated == 100
+
+
+def test_buffer_pool_shrink():
+    """Test that chunks shrink when the memory budget is exhausted."""
+    pool = BufferPool(100, min_chunk_size=10)
+    buf = pool.acquire(80)
+    assert len(buf) == 80
+    assert len(pool.acquire(80)) == 20
+    assert pool.allocated == 100
+
+    # Unused buffers of another size are dropped to make room.
+    pool.release(buf)
+    assert len(pool.acquire(50)) == 50
+    assert pool.allocated == 70
+
+
+def test_buffer_pool_blocks():
+    """Test that a transfer waits for a buffer once the pool is empty."""
+    pool = BufferPool(20, min_chunk_size=10)
+    buf1 = pool.acquire(10)
+    pool.acquire(10)
+
+    acquired = []
+    t = threading.Thread(target=lambda: acquired.append(pool.acquire(10)))
+    t.start()
+    t.join(0.1)
+    assert not acquired
+
+    pool.release(buf1)
+    t.join()
+    assert acquired == [buf1]
+
+
+def test_buffer_pool_context():
+    """Test the buffer context manager."""
+    pool = BufferPool(20, min_chunk_size=10)
+    with pool.buffer(20) as buf:
+        assert pool.allocated == 20
+    assert pool.acquire(20) is buf
+
+
+def test_read_into():
+    """Test reading into a buffer."""
+    buf = bytearray(4)
+    assert read_into(BytesIO(b'abcdef'), buf) == 4
+    assert buf == b'abcd'
+
+    class Stream(object):
+        """Stream without readinto()."""
+
+        def read(self, size):
+            return b'xy'
+
+    assert read_into(Stream(), buf) == 2
+    assert buf == b'xycd'
@@ -10,20 +10,28 @@
 
 from __future__ import absolute_import, print_function
 
+import hashlib
 import sys
 import uuid
-from os.path import getsize
+from os import stat, walk
+from os.path import exists, getsize, join
 
 import pytest
 from fs.errors import ResourceNotFoundError
+from mock import patch
 from six import BytesIO, b
+from sqlalchemy.dialects import mysql
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex, CreateTable
+from testutils import count_queries
 
 from invenio_files_rest.errors import BucketLockedError, \
-    FileInstanceAlreadySetError, FileInstanceUnreadableError, \
+    FileInstanceAlreadySetError, FileInstanceUnreadableError, FileSizeError, \
     InvalidKeyError, InvalidOperationError
-from invenio_files_rest.models import Bucket, BucketTag, FileInstance, \
-    Location, ObjectVersion, ObjectVersionTag
+from invenio_files_rest.helpers import make_path
+from invenio_files_rest.models import Bucket, BucketSizeDelta, BucketTag, \
+    FileInstance, FileInstanceChecksum, FileInstanceSegment, Location, \
+    ObjectVersion, ObjectVersionTag
 
 
 def test_location(app, db):
@@ -231,10 +239,85 @@ def test_object_create_with_fileid(app, db, dummy_location):
         b = Bucket.create()
         obj = ObjectVersion.create(b, 'test', stream=BytesIO(b'test'))
 
-    assert b.size == 4
+    assert b.get_size() == 4
 
     ObjectVersion.create(b, 'test', _file_id=obj.file)
-    assert b.size == 8
+    assert b.get_size() == 8
+
+
+def test_bucket_size_deltas(app, db, dummy_location):
+    """Test accounting of bucket sizes with a ledger of size deltas."""
+    b1 = Bucket.create()
+    b2 = Bucket.create()
+    obj = ObjectVersion.create(b1, 'test', stream=BytesIO(b'test'))
+    ObjectVersion.create(b1, 'other', stream=BytesIO(b'other'))
+    ObjectVersion.create(b2, 'test', _file_id=obj.file)
+    db.session.commit()
+
+    # The buckets rows are not updated.
+    assert BucketSizeDelta.query.count() == 3
+    assert b1.size == 0
+    assert b1.get_size() == 9
+    assert b2.get_size() == 4
+
+    # Fold the deltas of one bucket.
+    assert BucketSizeDelta.fold(bucket=b2) == 1
+    db.session.commit()
+    assert BucketSizeDelta.query.count() == 2
+    assert Bucket.get(b2.id).size == 4
+
+    obj.remove()
+    assert b1.get_size() == 5
+    assert BucketSizeDelta.fold() == 3
+    db.session.commit()
+    assert BucketSizeDelta.query.count() == 0
+    assert Bucket.get(b1.id).size == 5
+    assert Bucket.get(b1.id).get_size() == 5
+    assert BucketSizeDelta.fold() == 0
+
+    # Deltas folded concurrently are skipped.
+    ObjectVersion.create(b1, 'test', stream=BytesIO(b'test'))
+    db.session.commit()
+    with patch.object(BucketSizeDelta, 'query') as query:
+        query.with_entities.return_value = [(0, b1.id, 4)]
+        query.filter.return_value.delete.return_value = 0
+        assert BucketSizeDelta.fold() == 0
+    assert Bucket.get(b1.id).size == 5
+    assert Bucket.get(b1.id).get_size() == 9
+
+    b1.remove()
+    db.session.commit()
+    assert BucketSizeDelta.query.count() == 0
+
+
+def test_bucket_quota_concurrent_uploads(app, db, dummy_location):
+    """Test that concurrent uploads cannot together exceed the quota."""
+    b1 = Bucket.create(quota_size=10)
+    db.session.commit()
+
+    # Both uploads are checked against the size limit of the empty bucket.
+    size_limit = b1.size_limit
+    ObjectVersion.create(b1, 'a').set_contents(
+        BytesIO(b'123456'), size_limit=size_limit)
+    with pytest.raises(FileSizeError):
+        with db.session.begin_nested():
+            ObjectVersion.create(b1, 'b').set_contents(
+                BytesIO(b'123456'), size_limit=size_limit)
+    db.session.commit()
+    assert b1.get_size() == 6
+    assert ObjectVersion.get(b1, 'b') is None
+    # The data of the rejected file is removed.
+    assert len([
+        name for dummy, dummy, names in walk(dummy_location.uri)
+        for name in names
+    ]) == 1
+
+    # Shrinking the bucket is not limited.
+    ObjectVersion.create(b1, 'b').set_contents(BytesIO(b'1234'))
+    db.session.commit()
+    assert b1.get_size() == 10
+    ObjectVersion.get(b1, 'a').remove()
+    assert b1.get_size() == 4
 
 
 def test_object_multibucket(app, db, dummy_location):
@@ -308,6 +391,173 @@ def test_object_get_by_bucket(app, db, dummy_location):
     assert objs[3].version_id == obj1_first.version_id
 
 
+def test_object_get_page(app, db, dummy_location):
+    """Test keyset paginated object listing."""
+    b1 = Bucket.create()
+    keys = ['a.txt', 'a/1.txt', 'a/2.txt', 'a/b/3.txt', 'a_b.txt', 'b%.txt',
+            'b/4.txt', 'c.txt']
+    for key in keys:
+        ObjectVersion.create(b1, key).set_location(key, 1, "achecksum")
+    # Older versions of a key are listed after its latest version.
+    ObjectVersion.create(b1, 'c.txt').set_location('c2', 1, "achecksum")
+    db.session.commit()
+
+    def list_all(max_keys, **kwargs):
+        pages = []
+        marker = None
+        while True:
+            objs, prefixes, marker = ObjectVersion.get_page(
+                b1, max_keys=max_keys, marker=marker, **kwargs)
+            assert len(objs) + len(prefixes) <= max_keys
+            pages.append(([o.key for o in objs], prefixes))
+            if marker is None:
+                return pages
+
+    # Without delimiter
+    assert list_all(1000) == [(keys, [])]
+    pages = list_all(3)
+    assert len(pages) == 3
+    assert sum([p[0] for p in pages], []) == keys
+    assert sum([p[0] for p in list_all(2, versions=True)], []) == \
+        keys + ['c.txt']
+    objs = ObjectVersion.get_page(b1, prefix='c', versions=True)[0]
+    assert objs[0].is_head and not objs[1].is_head
+
+    # Prefix
+    assert list_all(1000, prefix='a/') == [
+        (['a/1.txt', 'a/2.txt', 'a/b/3.txt'], [])]
+    assert list_all(1000, prefix='a_') == [(['a_b.txt'], [])]
+    assert list_all(1000, prefix='b%') == [(['b%.txt'], [])]
+    assert list_all(1000, prefix='d') == [([], [])]
+
+    # Delimiter
+    assert list_all(1000, delimiter='/') == [
+        (['a.txt', 'a_b.txt', 'b%.txt', 'c.txt'], ['a/', 'b/'])]
+    assert list_all(1000, prefix='a/', delimiter='/') == [
+        (['a/1.txt', 'a/2.txt'], ['a/b/'])]
+    assert list_all(1, delimiter='/') == [
+        (['a.txt'], []), ([], ['a/']), (['a_b.txt'], []), (['b%.txt'], []),
+        ([], ['b/']), (['c.txt'], [])]
+    assert list_all(1, delimiter='/', versions=True)[-2:] == [
+        (['c.txt'], []), (['c.txt'], [])]
+
+    # The keys of common prefixes are skipped without extra queries.
+    bucket_id = b1.id
+    db.session.expire_all()
+    with count_queries(db.engine) as statements:
+        ObjectVersion.get_page(bucket_id, delimiter='/')
+    assert len(statements) == 2
+
+
+def test_object_get_page_order(app, db, dummy_location):
+    """Test that keys are listed by code point."""
+    b1 = Bucket.create()
+    keys = [u'B.txt', u'a-b.txt', u'a/1.txt', u'a/\xe9.txt', u'a0.txt',
+            u'b.txt', u'\xe9.txt']
+    for key in reversed(keys):
+        ObjectVersion.create(b1, key).set_location(key, 1, "achecksum")
+    db.session.commit()
+
+    assert [o.key for o in ObjectVersion.get_by_bucket(b1)] == keys
+    pages = []
+    marker = None
+    while True:
+        objs, prefixes, marker = ObjectVersion.get_page(
+            b1, delimiter='/', max_keys=1, marker=marker)
+        pages.append(([o.key for o in objs], prefixes))
+        if marker is None:
+            break
+    assert pages == [
+        ([u'B.txt'], []), ([u'a-b.txt'], []), ([], [u'a/']),
+        ([u'a0.txt'], []), ([u'b.txt'], []), ([u'\xe9.txt'], [])]
+
+    if db.engine.name == 'sqlite':
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM files_object '
+            'WHERE bucket_id = :bucket_id '
+            'ORDER BY key, created DESC, version_id DESC',
+            {'bucket_id': b1.id.bytes}).fetchall()
+        assert 'ix_files_object_bucket_id_key_created_version_id' in \
+            str(plan)
+
+    # MySQL compares the keys with their binary collation, so that the
+    # listing index is used.
+    assert '`key` VARCHAR(255) BINARY NOT NULL' in str(
+        CreateTable(ObjectVersion.__table__).compile(dialect=mysql.dialect()))
+    assert 'ORDER BY files_object.`key`, ' in str(
+        ObjectVersion.get_by_bucket(b1).statement.compile(
+            dialect=mysql.dialect()))
+
+
+def test_object_listing_queries(app, db, dummy_location):
+    """Test that listings load the files and tags in constant queries."""
+    b1 = Bucket.create()
+    for i in range(10):
+        obj = ObjectVersion.create(
+            b1, 'key{0}'.format(i), stream=BytesIO(b'test'))
+        ObjectVersionTag.create(obj, 'mykey', 'myvalue')
+    ObjectVersion.create(b1, 'key0', stream=BytesIO(b'new'))
+    db.session.commit()
+    bucket_id = b1.id
+
+    for query in [ObjectVersion.get_by_bucket(bucket_id, versions=True),
+                  ObjectVersion.get_versions(bucket_id, 'key0')]:
+        db.session.expire_all()
+        with count_queries(db.engine) as statements:
+            for obj in query.all():
+                assert obj.file.size
+                assert obj.file.checksum
+                obj.get_tags()
+        assert len(statements) == 2
+
+    db.session.expire_all()
+    with count_queries(db.engine) as statements:
+        objs = ObjectVersion.get_page(bucket_id, max_keys=5)[0]
+        assert [o.get_tags() for o in objs] == \
+            [{}] + [{'mykey': 'myvalue'}] * 4
+        assert [o.file.size for o in objs] == [3, 4, 4, 4, 4]
+    assert len(statements) == 2
+
+
+def test_object_head_index(app, db, dummy_location):
+    """Test that an object has at most one head."""
+    if db.engine.name == 'mysql':
+        raise pytest.skip('Partial indexes are not supported on MySQL.')
+
+    b1 = Bucket.create()
+    ObjectVersion.create(b1, 'test', stream=BytesIO(b'v1'))
+    ObjectVersion.create(b1, 'test', stream=BytesIO(b'v2'))
+    ObjectVersion.delete(b1, 'test')
+    db.session.commit()
+    assert ObjectVersion.get_versions(b1, 'test').count() == 3
+
+    db.session.add(ObjectVersion(bucket=b1, key='test', is_head=True))
+    pytest.raises(IntegrityError, db.session.commit)
+    db.session.rollback()
+
+    db.session.add(ObjectVersion(bucket=b1, key='test', is_head=False))
+    db.session.commit()
+    assert ObjectVersion.get_versions(b1, 'test').count() == 4
+
+
+def test_object_head_index_mysql(app, db):
+    """Test that only the head index is not unique on MySQL."""
+    def create_index(index):
+        return str(CreateIndex(index).compile(dialect=mysql.dialect()))
+
+    index, = [i for i in ObjectVersion.__table__.indexes
+              if i.name == 'uidx_files_object_bucket_id_key_head']
+    assert create_index(index).startswith('CREATE INDEX')
+
+    table = db.Table(
+        'test_mysql_index', db.MetaData(), db.Column('key', db.Integer),
+        db.Column('flag', db.Boolean))
+    index = db.Index(
+        'uidx_test', table.c.key, unique=True,
+        postgresql_where=table.c.flag.is_(True))
+    assert create_index(index).startswith('CREATE UNIQUE INDEX')
+
+
 def test_object_delete(app, db, dummy_location):
     """Test object creation."""
     # Create three versions, with latest being a delete marker.
@@ -339,12 +589,12 @@ def test_object_remove(app, db, bucket, objects):
     """Test object remove."""
     obj = objects[0]
     obj_size = obj.file.size
-    before_size = bucket.size
+    before_size = bucket.get_size()
 
     assert ObjectVersion.query.count() == 4
     obj.remove()
     assert ObjectVersion.query.count() == 3
-    assert bucket.size == before_size - obj_size
+    assert bucket.get_size() == before_size - obj_size
 
     bucket.locked = True
     obj = objects[1]
@@ -381,7 +631,7 @@ def test_object_set_contents(app, db, dummy_location):
     assert obj.file.uri is not None
     assert obj.file.size == getsize('LICENSE')
     assert obj.file.checksum is not None
-    assert b1.size == obj.file.size
+    assert b1.get_size() == obj.file.size
 
     # Try to overwrite
     with db.session.begin_nested():
@@ -397,7 +647,7 @@ def test_object_set_contents(app, db, dummy_location):
     assert obj2.file_id is not None and obj2.file_id != obj.file_id
     assert obj2.file.size == getsize('README.rst')
     assert obj2.file.uri != obj.file.uri
-    assert Bucket.get(b1.id).size == obj.file.size + obj2.file.size
+    assert Bucket.get(b1.id).get_size() == obj.file.size + obj2.file.size
 
     obj2.file.verify_checksum()
     assert obj2.file.last_check_at
@@ -889,6 +1139,29 @@ def test_fileinstance_copy_contents(app, db, dummy_location):
     fp.close()
 
 
+def test_fileinstance_copy_contents_fast_copy(app, db, dummy_location):
+    """Test copying contents without reading them."""
+    app.config['FILES_REST_STORAGE_COPY_METHODS'] = ['link']
+    app.config['FILES_REST_STORAGE_EXTRA_CHECKSUMS'] = {'S': ['sha256']}
+    data = b('this is some data')
+    src = FileInstance.create()
+    src.set_contents(BytesIO(data), default_location=dummy_location.uri)
+    db.session.commit()
+
+    dst = FileInstance.create()
+    with patch('invenio_files_rest.storage.base.FileStorage._write_stream') \
+            as write_stream:
+        dst.copy_contents(src, default_location=dummy_location.uri)
+        assert not write_stream.called
+    db.session.commit()
+
+    assert dst.uri != src.uri
+    assert stat(dst.uri).st_nlink == 2
+    assert dst.size == src.size
+    assert dst.checksums == src.checksums
+    assert dst.verify_checksum()
+
+
 def test_fileinstance_copy_contents_invalid(app, db, dummy_location):
     """Test invalid copy contents."""
     # Source not readable
@@ -928,6 +1201,125 @@ def test_fileinstance_send_file(app, db, dummy_location):
         assert int(res.headers['Content-Length']) == len(data)
 
 
+def test_fileinstance_checksum_algorithm(app, db, dummy_location,
+                                         extra_location, get_md5):
+    """Test checksum algorithm configured per location."""
+    app.config['FILES_REST_LOCATION_CHECKSUM_ALGORITHMS'] = {
+        dummy_location.uri: 'sha256'}
+    data = b('test file instance checksum algorithm')
+    sha256 = 'sha256:{0}'.format(hashlib.sha256(data).hexdigest())
+
+    f = FileInstance.create()
+    f.set_contents(BytesIO(data), default_location=dummy_location.uri)
+    db.session.commit()
+    assert f.checksum == sha256
+
+    # Existing checksums are verified with their own algorithm.
+    app.config['FILES_REST_LOCATION_CHECKSUM_ALGORITHMS'] = {}
+    assert f.verify_checksum() is True
+    f.update_checksum()
+    assert f.checksum == sha256
+
+    # Copies keep the algorithm of the source.
+    dst = FileInstance.create()
+    dst.copy_contents(f, default_location=extra_location.uri)
+    db.session.commit()
+    assert dst.checksum == sha256
+
+    f = FileInstance.create()
+    f.set_contents(BytesIO(data), default_location=dummy_location.uri)
+    assert f.checksum == get_md5(data)
+
+
+def test_fileinstance_segments(app, db, dummy_location):
+    """Test segment checksums of a file instance."""
+    app.config['FILES_REST_CHECKSUM_ALGORITHM'] = 'md5-tree-10'
+    data = b('test file instance segments')
+
+    f = FileInstance.create()
+    f.set_contents(BytesIO(data), default_location=dummy_location.uri)
+    db.session.commit()
+    assert f.checksum.startswith('md5-tree-10:')
+    assert [s.number for s in f.segments] == [0, 1, 2]
+    assert f.segments[1].checksum == 'md5:{0}'.format(
+        hashlib.md5(data[10:20]).hexdigest())
+    assert f.verify_checksum() is True
+
+    f.segments[2].checksum = 'md5:invalid'
+    f.update_checksum()
+    db.session.commit()
+    assert f.segments[2].checksum == 'md5:{0}'.format(
+        hashlib.md5(data[20:]).hexdigest())
+
+    f.set_uri(f.uri, f.size, 'md5:{0}'.format(hashlib.md5(data).hexdigest()))
+    db.session.commit()
+    assert f.segments == []
+    assert FileInstanceSegment.query.count() == 0
+
+
+@pytest.mark.parametrize('checksum_workers', [1, 3])
+def test_fileinstance_verify_segments(app, db, dummy_location,
+                                      checksum_workers):
+    """Test verifying files with their segment checksums."""
+    app.config['FILES_REST_CHECKSUM_ALGORITHM'] = 'md5-tree-10'
+    app.config['FILES_REST_CHECKSUM_WORKERS'] = checksum_workers
+    data = b('test file instance segments')
+
+    f = FileInstance.create()
+    f.set_contents(BytesIO(data), default_location=dummy_location.uri)
+    db.session.commit()
+    assert f.verify_segments() == []
+    assert f.verify_segments(offset=30) == []
+
+    # Only the segments in the range are read.
+    with open(f.uri, 'r+b') as fp:
+        fp.seek(15)
+        fp.write(b'X')
+    assert f.verify_segments(length=10) == []
+    assert f.verify_segments(offset=20) == []
+    assert f.last_check is True
+    assert f.verify_segments(offset=12, length=3) == [1]
+    assert f.last_check is False
+    assert f.verify_checksum() is False
+
+    # Missing data is a checksum mismatch.
+    with open(f.uri, 'wb') as fp:
+        fp.write(data[:15])
+    assert f.verify_segments() == [1, 2]
+    assert f.verify_checksum() is False
+    assert f.verify_checksum(throws=False) is False
+
+    f.set_uri(f.uri, 15, 'md5:{0}'.format(hashlib.md5(data).hexdigest()))
+    assert f.verify_segments() is None
+
+
+def test_fileinstance_extra_checksums(app, db, dummy_location, get_md5):
+    """Test additional checksums of a file instance."""
+    app.config['FILES_REST_STORAGE_EXTRA_CHECKSUMS'] = {'S': ['sha256']}
+    data = b('test file instance extra checksums')
+    sha256 = 'sha256:{0}'.format(hashlib.sha256(data).hexdigest())
+
+    obj = ObjectVersion.create(Bucket.create(), 'test', stream=BytesIO(data))
+    db.session.commit()
+    f = obj.file
+    assert f.checksums == {'md5': get_md5(data), 'sha256': sha256}
+    assert FileInstanceChecksum.query.filter_by(
+        algorithm='sha256', checksum=sha256).one().file_id == f.id
+
+    assert f.verify_checksum() is True
+    f.extra_checksums['sha256'].checksum = 'sha256:invalid'
+    assert f.verify_checksum() is False
+    f.update_checksum()
+    assert f.extra_checksums['sha256'].checksum == sha256
+
+    # Only files of the configured storage classes get additional checksums.
+    f.storage_class = 'A'
+    f.update_checksum()
+    db.session.commit()
+    assert f.checksums == {'md5': get_md5(data)}
+    assert FileInstanceChecksum.query.count() == 0
+
+
 def test_fileinstance_validation(app, db, dummy_location):
     """Test validating the FileInstance."""
     f = FileInstance.create()
@@ -985,3 +1377,103 @@ def test_object_version_tags(app, db, dummy_location):
     ObjectVersion.query.delete()
     db.session.commit()
     assert ObjectVersionTag.query.count() == 0
+
+
+def test_object_content_addressed_storage(app, db, bucket):
+    """Test deduplication of object contents."""
+    app.config['FILES_REST_CONTENT_ADDRESSED_STORAGE'] = True
+    data = b'somedata'
+
+    obj1 = ObjectVersion.create(bucket, 'a.txt', stream=BytesIO(data))
+    f = obj1.file
+    algo, value = f.checksum.split(':', 1)
+    assert f.uri == join(
+        bucket.location.uri, value[:2], value[2:4], value[4:], 'data')
+    assert exists(f.uri)
+
+    obj2 = ObjectVersion.create(bucket, 'b.txt', stream=BytesIO(data))
+    obj3 = ObjectVersion.create(bucket, 'c.txt', stream=BytesIO(b'other'))
+    # Uploaded duplicates are kept on disk until the transaction is committed.
+    assert len([
+        name for dummy, dummy, names in walk(bucket.location.uri)
+        for name in names
+    ]) == 3
+    db.session.commit()
+
+    assert obj2.file_id == f.id
+    assert obj3.file_id != f.id
+    assert FileInstance.query.count() == 2
+    assert bucket.get_size() == 2 * len(data) + len(b'other')
+    # Uploaded duplicates are removed from disk.
+    assert len([
+        name for dummy, dummy, names in walk(bucket.location.uri)
+        for name in names
+    ]) == 2
+    assert obj2.file.storage().open().read() == data
+
+
+def test_object_content_addressed_storage_race(app, db, bucket):
+    """Test deduplication of contents uploaded concurrently."""
+    app.config['FILES_REST_CONTENT_ADDRESSED_STORAGE'] = True
+    data = b'somedata'
+
+    obj1 = ObjectVersion.create(bucket, 'a.txt', stream=BytesIO(data))
+    file_id, uri = obj1.file_id, obj1.file.uri
+    # The first upload is not visible yet when the second one looks for
+    # duplicates, but it is by the time the second one claims the same path.
+    obj1.file.readable = False
+    db.session.commit()
+
+    def first_upload_committed(*args):
+        db.session.execute(FileInstance.__table__.update().where(
+            FileInstance.id == file_id).values(readable=True))
+        return make_path(*args)
+
+    with patch('invenio_files_rest.models.make_path',
+               side_effect=first_upload_committed):
+        obj2 = ObjectVersion.create(bucket, 'b.txt', stream=BytesIO(data))
+    db.session.commit()
+
+    assert obj2.file_id == file_id
+    assert FileInstance.query.count() == 1
+    assert len([
+        name for dummy, dummy, names in walk(bucket.location.uri)
+        for name in names
+    ]) == 1
+    assert obj2.file.storage().open().read() == data
+
+
+def test_object_compressed_storage_class(app, db, dummy_location):
+    """Test objects in a bucket of the compressed storage class."""
+    b = Bucket.create(storage_class='C')
+    data = b'a,b,c\n1,2,3\n' * 100
+    obj = ObjectVersion.create(b, 'test.csv', stream=BytesIO(data))
+    db.session.commit()
+
+    assert obj.file.storage_class == 'C'
+    assert obj.file.uri.endswith('data.gz')
+    assert obj.file.size == len(data)
+    assert obj.file.checksum == \
+        'md5:{0}'.format(hashlib.md5(data).hexdigest())
+    assert getsize(obj.file.uri) < len(data)
+    assert obj.file.verify_checksum()
+
+    fp = obj.file.storage().open()
+    assert fp.read() == data
+    fp.close()
+
+
+def test_object_compressed_storage_class_removed(app, db, dummy_location):
+    """Test reading compressed files after their class is unconfigured."""
+    b = Bucket.create(storage_class='C')
+    data = b'a,b,c\n1,2,3\n' * 100
+    obj = ObjectVersion.create(b, 'test.csv', stream=BytesIO(data))
+    db.session.commit()
+    assert obj.file.uri.endswith('data.gz')
+
+    app.config['FILES_REST_STORAGE_COMPRESSION'] = {}
+    fp = obj.file.storage().open()
+    assert fp.read() == data
+    fp.close()
+    assert obj.file.verify_checksum()
+    assert obj.file.last_check is True
@@ -11,12 +11,16 @@
 from __future__ import absolute_import, print_function
 
 import hashlib
-from os.path import exists
+from os import listdir
+from os.path import exists, join
 
+import pytest
+from mock import patch
 from six import BytesIO
 
-from invenio_files_rest.models import Bucket, MultipartObject, ObjectVersion, \
-    Part
+from invenio_files_rest.errors import InsufficientStorageError
+from invenio_files_rest.models import Bucket, FileInstance, MultipartObject, \
+    ObjectVersion, Part
 
 
 def make_stream(size):
@@ -36,7 +40,7 @@ def test_multipart_creation(app, db, bucket):
     assert mp.size == 100
     assert mp.chunk_size == 20
     assert mp.completed is False
-    assert mp.bucket.size == 100
+    assert mp.bucket.get_size() == 100
     assert exists(mp.file.uri)
 
 
@@ -52,20 +56,20 @@ def test_multipart_last_part(app, db, bucket):
 
 def test_part_creation(app, db, bucket, get_md5):
     """Test part creation."""
-    assert bucket.size == 0
+    assert bucket.get_size() == 0
     mp = MultipartObject.create(bucket, 'test.txt', 5, 2)
     db.session.commit()
-    assert bucket.size == 5
+    assert bucket.get_size() == 5
 
     Part.create(mp, 2, stream=BytesIO(b'p'))
     Part.create(mp, 0, stream=BytesIO(b'p1'))
     Part.create(mp, 1, stream=BytesIO(b'p2'))
     db.session.commit()
-    assert bucket.size == 5
+    assert bucket.get_size() == 5
 
     mp.complete()
     db.session.commit()
-    assert bucket.size == 5
+    assert bucket.get_size() == 5
 
     # Assert checksum of part.
     m = hashlib.md5()
@@ -74,7 +78,7 @@ def test_part_creation(app, db, bucket, get_md5):
 
     obj = mp.merge_parts()
     db.session.commit()
-    assert bucket.size == 5
+    assert bucket.get_size() == 5
 
     assert MultipartObject.query.count() == 0
     assert Part.query.count() == 0
@@ -88,6 +92,69 @@ def test_part_creation(app, db, bucket, get_md5):
     assert obj.version_id == ObjectVersion.get(bucket, 'test.txt').version_id
 
 
+def test_multipart_insufficient_storage(app, db, bucket):
+    """Test creating a multipart object without enough disk space."""
+    app.config['FILES_REST_STORAGE_PREALLOCATE'] = True
+    with patch('invenio_files_rest.storage.pyfs.preallocate',
+               side_effect=InsufficientStorageError()):
+        pytest.raises(
+            InsufficientStorageError,
+            MultipartObject.create, bucket, 'test.txt', 5, 2)
+    db.session.commit()
+    assert MultipartObject.query.count() == 0
+    assert FileInstance.query.count() == 0
+    assert Bucket.get(bucket.id).get_size() == 0
+
+
+def test_multipart_composite_checksum(app, db, bucket):
+    """Test checksum of merged parts combined from the part checksums."""
+    app.config['FILES_REST_MULTIPART_COMPOSITE_CHECKSUM'] = True
+    mp = MultipartObject.create(bucket, 'test.txt', 5, 2)
+    Part.create(mp, 2, stream=BytesIO(b'p'))
+    Part.create(mp, 0, stream=BytesIO(b'p1'))
+    Part.create(mp, 1, stream=BytesIO(b'p2'))
+    mp.complete()
+    db.session.commit()
+
+    parts = [hashlib.md5(p) for p in (b'p1', b'p2', b'p')]
+    root = hashlib.md5(b''.join(m.digest() for m in parts)).hexdigest()
+    assert mp.get_composite_checksum() == (
+        'md5-tree-2:{0}'.format(root),
+        ['md5:{0}'.format(m.hexdigest()) for m in parts],
+    )
+
+    with patch('invenio_files_rest.storage.PyFSFileStorage.checksum') as c:
+        obj = mp.merge_parts()
+        assert not c.called
+    db.session.commit()
+    assert obj.file.checksum == 'md5-tree-2:{0}'.format(root)
+    assert [s.checksum for s in obj.file.segments] == \
+        ['md5:{0}'.format(m.hexdigest()) for m in parts]
+    assert obj.file.verify_checksum() is True
+
+
+def test_multipart_segmented_storage(app, db, bucket):
+    """Test storing each part in its own segment."""
+    app.config['FILES_REST_STORAGE_FACTORY'] = \
+        'invenio_files_rest.storage.segmented_storage_factory'
+    mp = MultipartObject.create(bucket, 'test.txt', 5, 2)
+    Part.create(mp, 2, stream=BytesIO(b'p'))
+    Part.create(mp, 0, stream=BytesIO(b'p1'))
+    Part.create(mp, 1, stream=BytesIO(b'p2'))
+    mp.complete()
+    obj = mp.merge_parts()
+    db.session.commit()
+
+    assert sorted(listdir(obj.file.uri)) == \
+        ['00000000', '00000001', '00000002', 'manifest.json']
+    assert open(join(obj.file.uri, '00000001'), 'rb').read() == b'p2'
+    assert obj.file.checksum == \
+        'md5:{0}'.format(hashlib.md5(b'p1p2p').hexdigest())
+    fp = obj.file.storage().open()
+    assert fp.read() == b'p1p2p'
+    fp.close()
+
+
 def test_multipart_full(app, db, bucket):
     """Test full multipart object."""
     app.config.update(dict(
@@ -117,15 +184,39 @@ def test_multipart_full(app, db, bucket):
     db.session.commit()
 
     # Merge parts.
-    pre_size = mp.bucket.size
+    pre_size = mp.bucket.get_size()
     mp.merge_parts()
     db.session.commit()
 
     # Test size update
     bucket = Bucket.get(bucket.id)
-    assert bucket.size == pre_size
+    assert bucket.get_size() == pre_size
 
     app.config.update(dict(
         FILES_REST_MULTIPART_CHUNKSIZE_MIN=2,
         FILES_REST_MULTIPART_CHUNKSIZE_MAX=20,
     ))
+
+
+def test_multipart_s3_storage(app, db, s3_location):
+    """Test uploading each part as an S3 part."""
+    chunk_size = 5 * 1024 * 1024
+    app.config.update(dict(
+        FILES_REST_MULTIPART_CHUNKSIZE_MIN=chunk_size,
+        FILES_REST_MULTIPART_CHUNKSIZE_MAX=chunk_size,
+    ))
+    data = b'a' * chunk_size + b'b' * 3
+    bucket = Bucket.create(location=s3_location)
+    mp = MultipartObject.create(bucket, 'test.txt', len(data), chunk_size)
+    Part.create(mp, 1, stream=BytesIO(data[chunk_size:]))
+    Part.create(mp, 0, stream=BytesIO(data[:chunk_size]))
+    mp.complete()
+    obj = mp.merge_parts()
+    db.session.commit()
+
+    assert obj.file.uri.startswith('s3://testbucket/files/')
+    assert obj.file.checksum == \
+        'md5:{0}'.format(hashlib.md5(data).hexdigest())
+    fp = obj.file.storage().open()
+    assert fp.read() == data
+    fp.close()
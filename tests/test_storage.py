@@ -12,18 +12,31 @@
 from __future__ import absolute_import, print_function
 
 import errno
+import gzip
+import hashlib
 import os
+import shutil
+import tempfile
 from os.path import dirname, exists, getsize, join
 
 import pytest
 from fs.errors import DirectoryNotEmptyError, ResourceNotFoundError
+from fs.opener import opener
 from mock import patch
 from six import BytesIO
 
-from invenio_files_rest.errors import FileSizeError, StorageError, \
-    UnexpectedFileSizeError
+from invenio_files_rest.buffers import BufferPool
+from invenio_files_rest.errors import FileSizeError, \
+    InsufficientStorageError, StorageError, UnexpectedFileSizeError
 from invenio_files_rest.limiters import FileSizeLimit
-from invenio_files_rest.storage import FileStorage, PyFSFileStorage
+from invenio_files_rest.models import Bucket, FileInstance, ObjectVersion
+from invenio_files_rest.storage import FileStorage, LocalFileStorage, \
+    PyFSCache, PyFSFileStorage, S3ClientPool, S3FileStorage, \
+    SegmentedFileStorage, local_storage_factory
+from invenio_files_rest.storage.base import ScanFile, fadvise, \
+    page_residency, pipe_chunks
+from invenio_files_rest.storage.cache import StorageCache
+from invenio_files_rest.storage.local import DirectFile
 
 
 def test_storage_interface():
@@ -52,6 +65,32 @@ def test_pyfs_initialize(pyfs, pyfs_testpath):
     assert size == os.stat(pyfs_testpath).st_size
 
 
+def test_pyfs_initialize_preallocate(pyfs_testpath):
+    """Test preallocation of files."""
+    s = PyFSFileStorage(pyfs_testpath, preallocate=True)
+    with patch('os.posix_fallocate', create=True) as fallocate:
+        s.initialize(size=100)
+        assert fallocate.call_args[0][1:] == (0, 100)
+    assert os.stat(pyfs_testpath).st_size == 100
+
+    # Not enough space.
+    with patch('os.posix_fallocate', create=True,
+               side_effect=OSError(errno.ENOSPC, 'No space left')):
+        pytest.raises(InsufficientStorageError, s.initialize, size=100)
+    assert not exists(pyfs_testpath)
+    with patch('os.posix_fallocate', create=True,
+               side_effect=OSError(errno.EFBIG, 'File too large')):
+        pytest.raises(InsufficientStorageError, s.initialize, size=100)
+    assert not exists(pyfs_testpath)
+
+    # Fallback when the file system does not support it.
+    with patch('os.posix_fallocate', create=True,
+               side_effect=OSError(errno.EOPNOTSUPP, 'Not supported')):
+        s.initialize(size=100)
+        assert os.stat(pyfs_testpath).st_size == 100
+        pytest.raises(InsufficientStorageError, s.initialize, size=2 ** 62)
+
+
 def test_pyfs_delete(app, db, dummy_location):
     """Test init of files."""
     testurl = join(dummy_location.uri, 'subpath/data')
@@ -66,6 +105,81 @@ def test_pyfs_delete(app, db, dummy_location):
     pytest.raises(ResourceNotFoundError, s.delete)
 
 
+def test_pyfs_cache(dummy_location):
+    """Test accessing files relative to cached file systems."""
+    cache = PyFSCache(1)
+    base = dummy_location.uri
+    testurl = join(base, 'ab', 'cd', 'ef', 'data')
+
+    with patch('invenio_files_rest.storage.pyfs.opener.opendir',
+               wraps=opener.opendir) as opendir:
+        s = PyFSFileStorage(testurl, base_uri=base, fs_cache=cache)
+        s.save(BytesIO(b'somedata'))
+        assert exists(testurl)
+        fp = s.open()
+        assert fp.read() == b'somedata'
+        fp.close()
+        s.delete()
+        assert not exists(testurl)
+        assert not exists(dirname(testurl))
+        assert exists(join(base, 'ab', 'cd'))
+        assert opendir.call_count == 1
+
+        s = PyFSFileStorage(join(base, 'anotherpath', 'data'),
+                            base_uri=base, fs_cache=cache)
+        pytest.raises(ResourceNotFoundError, s.delete)
+        assert opendir.call_count == 1
+
+        # Least recently used file system is evicted.
+        cache.get(join(base, 'ab'))
+        cache.get(base)
+        assert opendir.call_count == 3
+
+
+@pytest.mark.parametrize('storage_class', [PyFSFileStorage, LocalFileStorage])
+def test_storage_move(dummy_location, pyfs_testpath, storage_class):
+    """Test moving files."""
+    s = storage_class(pyfs_testpath)
+    s.save(BytesIO(b'somedata'))
+
+    newurl = join(dummy_location.uri, 'ab', 'cd', 'data')
+    assert s.move(newurl) == newurl
+    assert s.fileurl == newurl
+    assert not exists(dirname(pyfs_testpath))
+    assert open(newurl, 'rb').read() == b'somedata'
+
+
+@pytest.mark.parametrize('storage_class', [PyFSFileStorage, LocalFileStorage])
+def test_storage_compression(dummy_location, get_md5, storage_class):
+    """Test compressed files."""
+    testurl = join(dummy_location.uri, 'subpath', 'data.gz')
+    data = b'a,b,c\n1,2,3\n' * 100
+    s = storage_class(testurl, compression=1)
+
+    uri, size, checksum = s.save(BytesIO(data))
+    assert uri == testurl
+    assert size == len(data)
+    assert checksum == get_md5(data)
+    assert getsize(testurl) < len(data)
+    assert gzip.open(testurl).read() == data
+
+    fp = s.open()
+    assert fp.read() == data
+    pytest.raises(IOError, fp.fileno)
+    fp.close()
+    assert s._get_offload_path() is None
+
+    s = storage_class(testurl, size=len(data), compression=1)
+    assert s.checksum() == checksum
+    pytest.raises(StorageError, s.update, BytesIO(b'cheese'))
+    s.delete()
+
+    # Files written in parts are not compressed.
+    s = storage_class(testurl, compression=1)
+    assert s.initialize(size=100) == (testurl[:-3], 100, None)
+    assert s.compression is None
+
+
 def test_pyfs_delete_fail(pyfs, pyfs_testpath):
     """Test init of files."""
     pyfs.save(BytesIO(b'somedata'))
@@ -138,6 +252,77 @@ def test_pyfs_save_limits(pyfs):
         size_limit=FileSizeLimit(len(data) - 1, 'bla'))
 
 
+def test_pyfs_checksum_algorithm(app, pyfs_testpath):
+    """Test checksum algorithms from the registry."""
+    data = b'somedata'
+    s = PyFSFileStorage(pyfs_testpath, checksum_algorithm='sha256')
+    uri, size, checksum = s.save(BytesIO(data))
+    assert checksum == 'sha256:{0}'.format(hashlib.sha256(data).hexdigest())
+    assert s.checksum() == checksum
+
+    app.config['FILES_REST_CHECKSUM_ALGORITHMS'] = dict(
+        app.config['FILES_REST_CHECKSUM_ALGORITHMS'],
+        dummy=lambda: hashlib.new('sha1'),
+    )
+    s.checksum_algorithm = 'dummy'
+    assert s.checksum() == 'dummy:{0}'.format(hashlib.sha1(data).hexdigest())
+
+    s.checksum_algorithm = 'unknown'
+    pytest.raises(StorageError, s.checksum)
+    pytest.raises(ValueError, s.save, BytesIO(data))
+
+
+@pytest.mark.parametrize('checksum_workers', [1, 3])
+def test_pyfs_tree_checksum(pyfs_testpath, checksum_workers):
+    """Test tree checksums computed in parallel."""
+    data = b'somedata' * 100
+    segments = [
+        'md5:{0}'.format(hashlib.md5(data[i:i + 128]).hexdigest())
+        for i in range(0, len(data), 128)
+    ]
+    s = PyFSFileStorage(
+        pyfs_testpath, checksum_algorithm='md5-tree-128',
+        checksum_workers=checksum_workers)
+    uri, size, checksum = s.save(BytesIO(data), chunk_size=100)
+    assert checksum.startswith('md5-tree-128:')
+    assert s.segment_checksums == segments
+
+    counter = dict(size=0)
+
+    def callback(total, size):
+        counter['size'] = size
+
+    s = PyFSFileStorage(
+        pyfs_testpath, size=len(data), checksum_algorithm='md5-tree-128',
+        checksum_workers=checksum_workers)
+    assert s.checksum(chunk_size=100, progress_callback=callback) == checksum
+    assert s.segment_checksums == segments
+    assert counter['size'] == len(data)
+
+    # Missing data is detected.
+    s._size = len(data) + 1
+    pytest.raises(UnexpectedFileSizeError, s.checksum)
+
+
+@pytest.mark.parametrize('pipeline_depth', [0, 2])
+def test_pyfs_extra_checksums(pyfs_testpath, get_md5, pipeline_depth):
+    """Test additional checksums computed in the same pass."""
+    data = b'somedata' * 10
+    sha256 = 'sha256:{0}'.format(hashlib.sha256(data).hexdigest())
+    s = PyFSFileStorage(
+        pyfs_testpath, pipeline_depth=pipeline_depth,
+        extra_checksum_algorithms=['md5', 'sha256'])
+    assert s.extra_checksums == {}
+
+    uri, size, checksum = s.save(BytesIO(data), chunk_size=7)
+    assert checksum == get_md5(data)
+    assert s.extra_checksums == {'sha256': sha256}
+
+    s.extra_checksums = {}
+    assert s.checksum(chunk_size=7) == get_md5(data)
+    assert s.extra_checksums == {'sha256': sha256}
+
+
 def test_pyfs_update(pyfs, pyfs_testpath, get_md5):
     """Test update of file."""
     pyfs.initialize(size=100)
@@ -348,3 +533,560 @@ def test_non_unicode_filename(app, pyfs):
             'żółć.txt', mimetype='text/plain', checksum=checksum)
         assert res.status_code == 200
         assert res.headers['Content-Disposition'] == 'inline'
+
+
+def test_pyfs_send_file_wsgi_file_wrapper(app, pyfs):
+    """Test that local files are handed over to wsgi.file_wrapper."""
+    data = b'sendthis'
+    uri, size, checksum = pyfs.save(BytesIO(data))
+
+    wrapped = []
+
+    def file_wrapper(fp, buffer_size):
+        wrapped.append(fp)
+        return iter([fp.read()])
+
+    with app.test_request_context(
+            environ_overrides={'wsgi.file_wrapper': file_wrapper}):
+        res = pyfs.send_file(
+            'myfilename.txt', mimetype='text/plain', checksum=checksum)
+        assert res.status_code == 200
+        assert len(wrapped) == 1
+        assert wrapped[0].fileno() >= 0
+        assert b''.join(res.response) == data
+
+
+def test_pyfs_save_pipelined(dummy_location, pyfs_testpath, get_md5):
+    """Test save operation with pipelined reads, hashing and writes."""
+    s = PyFSFileStorage(pyfs_testpath, pipeline_depth=2)
+    data = b'somedata' * 100
+
+    counter = dict(size=0)
+
+    def callback(total, size):
+        counter['size'] = size
+
+    uri, size, checksum = s.save(
+        BytesIO(data), chunk_size=7, progress_callback=callback)
+    assert size == len(data)
+    assert checksum == get_md5(data)
+    assert counter['size'] == len(data)
+    assert open(pyfs_testpath, 'rb').read() == data
+
+    size, checksum = s.update(BytesIO(b'ab' * 10), seek=5, size=20,
+                              chunk_size=3)
+    assert size == 20
+    assert checksum == get_md5(b'ab' * 10)
+    assert open(pyfs_testpath, 'rb').read() == \
+        data[:5] + b'ab' * 10 + data[25:]
+
+
+def test_pyfs_save_pipelined_fail(dummy_location, pyfs_testpath):
+    """Test cleanup of pipelined save operations."""
+    s = PyFSFileStorage(pyfs_testpath, pipeline_depth=1)
+    data = b'somedata'
+
+    def fail_callback(total, size):
+        raise Exception('Something bad happened')
+
+    pytest.raises(
+        Exception, s.save, BytesIO(data), chunk_size=2,
+        progress_callback=fail_callback)
+    assert not exists(pyfs_testpath)
+
+    pytest.raises(
+        FileSizeError, s.save, BytesIO(data), chunk_size=2,
+        size_limit=FileSizeLimit(len(data) - 1, 'bla'))
+    assert not exists(pyfs_testpath)
+
+
+def test_pipe_chunks():
+    """Test feeding chunks to consumer threads."""
+    received = []
+    pipe_chunks(iter([b'a', b'b', b'c']), [received.append], 1)
+    assert received == [b'a', b'b', b'c']
+
+    def fail(chunk):
+        raise IOError('No space left on device')
+
+    # A failing consumer stops the producer and the error is re-raised.
+    chunks = iter([b'a'] * 100)
+    pytest.raises(IOError, pipe_chunks, chunks, [fail, received.append], 1)
+    assert len(list(chunks)) > 90
+
+    # Buffers are released once all consumers are done with them.
+    released = []
+    pipe_chunks(
+        iter([b'a', b'b']), [received.append, received.append], 1,
+        release=released.append)
+    assert released == [b'a', b'b']
+
+
+@pytest.mark.parametrize('pipeline_depth', [0, 2])
+def test_pyfs_save_buffer_pool(dummy_location, pyfs_testpath, get_md5,
+                               pipeline_depth):
+    """Test save and checksum operations using a buffer pool."""
+    pool = BufferPool(16, min_chunk_size=4)
+    s = PyFSFileStorage(
+        pyfs_testpath, pipeline_depth=pipeline_depth, buffer_pool=pool)
+    data = b'somedata' * 100
+
+    uri, size, checksum = s.save(BytesIO(data), chunk_size=7)
+    assert size == len(data)
+    assert checksum == get_md5(data)
+    assert open(pyfs_testpath, 'rb').read() == data
+    assert s.checksum(chunk_size=7) == get_md5(data)
+
+    # All buffers have been given back.
+    assert len(pool.acquire(16)) == 16
+
+    # Buffers are given back on errors too.
+    pool = BufferPool(16, min_chunk_size=4)
+    s = PyFSFileStorage(
+        pyfs_testpath, pipeline_depth=pipeline_depth, buffer_pool=pool)
+    pytest.raises(
+        FileSizeError, s.save, BytesIO(data), chunk_size=8,
+        size_limit=FileSizeLimit(len(data) - 1, 'bla'))
+    assert len(pool.acquire(16)) == 16
+
+
+@pytest.mark.parametrize('pipeline_depth', [0, 2])
+def test_local_storage(pyfs_testpath, get_md5, pipeline_depth):
+    """Test the local file system storage."""
+    s = LocalFileStorage(pyfs_testpath, pipeline_depth=pipeline_depth)
+    data = b'somedata' * 100
+
+    uri, size, checksum = s.save(BytesIO(data), chunk_size=7)
+    assert uri == pyfs_testpath
+    assert size == len(data)
+    assert checksum == get_md5(data)
+    assert open(pyfs_testpath, 'rb').read() == data
+
+    fp = s.open()
+    assert fp.read() == data
+    fp.close()
+
+    bytes_written, checksum = s.update(BytesIO(b'cheese'), seek=2, size=6)
+    data = data[:2] + b'cheese' + data[8:]
+    assert bytes_written == 6
+    assert checksum == get_md5(b'cheese')
+    assert open(pyfs_testpath, 'rb').read() == data
+    assert s.checksum() == get_md5(data)
+
+    # Failed writes remove the file.
+    pytest.raises(
+        FileSizeError, s.save, BytesIO(data),
+        size_limit=FileSizeLimit(len(data) - 1, 'bla'))
+    assert not exists(pyfs_testpath)
+
+    assert s.initialize(size=100) == (pyfs_testpath, 100, None)
+    assert getsize(pyfs_testpath) == 100
+
+    s.delete()
+    assert not exists(dirname(pyfs_testpath))
+    # Deleting a missing file is a no-op.
+    assert s.delete()
+
+
+def test_local_storage_initialize_preallocate(pyfs_testpath):
+    """Test preallocation of files with file descriptors."""
+    s = LocalFileStorage(pyfs_testpath, preallocate=True)
+    with patch('os.posix_fallocate', create=True,
+               side_effect=OSError(errno.EOPNOTSUPP, 'Not supported')):
+        s.initialize(size=100)
+        assert os.stat(pyfs_testpath).st_size == 100
+        pytest.raises(InsufficientStorageError, s.initialize, size=2 ** 62)
+    assert not exists(pyfs_testpath)
+
+    # Saved files of a known size are preallocated too.
+    with patch('invenio_files_rest.storage.local.preallocate') as alloc:
+        s.save(BytesIO(b'somedata'), size=8)
+        assert alloc.call_args[0][1] == 8
+        s.save(BytesIO(b'somedata'))
+        assert alloc.call_count == 1
+    assert open(pyfs_testpath, 'rb').read() == b'somedata'
+    with patch('os.posix_fallocate', create=True,
+               side_effect=OSError(errno.ENOSPC, 'No space left')):
+        pytest.raises(
+            InsufficientStorageError, s.save, BytesIO(b'somedata'), size=8)
+    assert not exists(pyfs_testpath)
+
+
+@pytest.mark.parametrize('checksum_workers', [1, 3])
+def test_local_storage_tree_checksum(pyfs_testpath, checksum_workers):
+    """Test tree checksums computed with positional reads."""
+    data = b'somedata' * 100
+    s = PyFSFileStorage(pyfs_testpath, checksum_algorithm='md5-tree-128')
+    uri, size, checksum = s.save(BytesIO(data))
+
+    s = LocalFileStorage(
+        pyfs_testpath, size=len(data), checksum_algorithm='md5-tree-128',
+        checksum_workers=checksum_workers)
+    assert s.checksum(chunk_size=100) == checksum
+
+    s._size = len(data) + 1
+    pytest.raises(UnexpectedFileSizeError, s.checksum)
+
+
+def test_local_storage_factory(app, db, dummy_location):
+    """Test the local file system storage factory."""
+    f = FileInstance.create()
+    s = local_storage_factory(
+        fileinstance=f, default_location=dummy_location.uri,
+        default_storage_class='S')
+    assert isinstance(s, LocalFileStorage)
+    assert s.fileurl.startswith(dummy_location.uri)
+
+    uri, size, checksum = s.save(BytesIO(b'somedata'))
+    assert open(uri, 'rb').read() == b'somedata'
+
+    pytest.raises(
+        ValueError, LocalFileStorage('root://eospublic/data').open)
+
+
+def test_storage_cache(app, db, dummy_location):
+    """Test the read-through cache of archived files."""
+    cachedir = tempfile.mkdtemp()
+    cache = StorageCache(cachedir, 250)
+    b = Bucket.create(storage_class='A')
+    data = [str(i).encode('ascii') * 100 for i in range(3)]
+    objs = [
+        ObjectVersion.create(b, 'file{0}'.format(i), stream=BytesIO(d))
+        for i, d in enumerate(data)
+    ]
+    db.session.commit()
+
+    for i, (obj, d) in enumerate(zip(objs, data)):
+        s = cache.get_storage(obj.file)
+        assert s.path == cache.get_path(obj.file)
+        fp = s.open()
+        assert fp.read() == d
+        fp.close()
+        os.utime(s.path, (i, i))
+
+    # The cache is only shrunk by evictions.
+    assert all(exists(cache.get_path(obj.file)) for obj in objs)
+    cache.evict()
+    # The least recently used file was removed.
+    assert not exists(cache.get_path(objs[0].file))
+    assert exists(cache.get_path(objs[1].file))
+    assert exists(cache.get_path(objs[2].file))
+
+    # Copies evicted once opened are still sent.
+    s = cache.get_storage(objs[1].file)
+    cache.max_size = 0
+    cache.evict()
+    assert not exists(s.path)
+    fp = s.open()
+    assert fp.read() == data[1]
+    fp.close()
+    cache.max_size = 250
+
+    # Copies not matching the checksum are not used.
+    f = objs[0].file
+    f.checksum = 'md5:invalid'
+    assert cache.get_storage(f) is None
+    assert not exists(dirname(cache.get_path(f))) or \
+        not os.listdir(dirname(cache.get_path(f)))
+
+    # Other storage classes are not cached.
+    obj = ObjectVersion.create(
+        Bucket.create(), 'standard', stream=BytesIO(b'test'))
+    assert cache.get_storage(obj.file) is None
+
+    shutil.rmtree(cachedir)
+
+
+def test_storage_cache_read_through(app, db, dummy_location):
+    """Test reading archived files through the storage interface."""
+    cachedir = tempfile.mkdtemp()
+    app.config['FILES_REST_STORAGE_CACHE_URI'] = cachedir
+    obj = ObjectVersion.create(
+        Bucket.create(storage_class='A'), 'test', stream=BytesIO(b'test'))
+    db.session.commit()
+    cache = StorageCache(cachedir, app.config['FILES_REST_STORAGE_CACHE_SIZE'])
+    path = cache.get_path(obj.file)
+
+    storage = obj.file.storage()
+    fp = storage.open()
+    assert fp.read() == b'test'
+    fp.close()
+    assert exists(path)
+
+    # Checksums are computed on the file itself.
+    with open(path, 'wb') as fp:
+        fp.write(b'evil')
+    assert storage.checksum() == obj.file.checksum
+    fp = storage.open()
+    assert fp.read() == b'evil'
+    fp.close()
+
+    # Writes go to the file itself.
+    os.remove(path)
+    fp = storage.open(mode='rb+')
+    fp.write(b'best')
+    fp.close()
+    assert not exists(path)
+    assert storage.checksum() != obj.file.checksum
+
+    shutil.rmtree(cachedir)
+
+
+@pytest.mark.parametrize('pipeline_depth', [0, 2])
+def test_segmented_storage(pyfs_testpath, get_md5, pipeline_depth):
+    """Test storing files as segment files."""
+    s = SegmentedFileStorage(
+        pyfs_testpath, segment_size=128, pipeline_depth=pipeline_depth)
+    data = b'somedata' * 100
+
+    uri, size, checksum = s.save(BytesIO(data), chunk_size=100)
+    assert size == len(data)
+    assert checksum == get_md5(data)
+    assert sorted(os.listdir(pyfs_testpath)) == \
+        ['{0:08d}'.format(i) for i in range(7)] + ['manifest.json']
+
+    fp = s.open()
+    assert fp.read() == data
+    fp.seek(300)
+    assert fp.read(50) == data[300:350]
+    fp.close()
+    pytest.raises(StorageError, s.open, mode='r+b')
+
+    # Segments are updated in place.
+    s = SegmentedFileStorage(pyfs_testpath, size=len(data))
+    s.update(BytesIO(b'cheese'), seek=125, size=6)
+    data = data[:125] + b'cheese' + data[131:]
+    fp = s.open()
+    assert fp.read() == data
+    fp.close()
+    assert s.checksum() == get_md5(data)
+
+    # Saving an empty file removes all the segments.
+    s = SegmentedFileStorage(pyfs_testpath, segment_size=128)
+    assert s.save(BytesIO(b''))[1] == 0
+    assert os.listdir(pyfs_testpath) == ['manifest.json']
+    fp = SegmentedFileStorage(pyfs_testpath, size=0).open()
+    assert fp.read() == b''
+    fp.close()
+
+    s.delete()
+    assert not exists(dirname(pyfs_testpath))
+
+    s = SegmentedFileStorage(pyfs_testpath, segment_size=128)
+    assert s.initialize(size=300) == (pyfs_testpath, 300, None)
+    assert [getsize(s.get_segment_path(i)) for i in range(3)] == \
+        [128, 128, 44]
+
+
+@pytest.mark.parametrize('copy_methods', [
+    ['link'], ['reflink', 'copy_file_range', 'link']])
+def test_storage_fast_copy(dummy_location, pyfs_testpath, copy_methods):
+    """Test copying local files without reading them."""
+    src = PyFSFileStorage(join(dummy_location.uri, 'anotherpath/data'))
+    src.save(BytesIO(b'otherdata'))
+
+    s = PyFSFileStorage(pyfs_testpath, copy_methods=copy_methods)
+    with patch.object(src, 'open') as src_open:
+        assert s.copy(src) == (pyfs_testpath, 9, None)
+        assert not src_open.called
+    assert open(pyfs_testpath, 'rb').read() == b'otherdata'
+
+    # Compressed files are streamed.
+    s = LocalFileStorage(
+        join(dummy_location.uri, 'compressed/data.gz'), compression=1,
+        copy_methods=copy_methods)
+    uri, size, checksum = s.copy(src)
+    assert checksum is not None
+    assert gzip.open(uri).read() == b'otherdata'
+
+
+def test_s3_storage(app, s3_location):
+    """Test the S3 storage."""
+    clients = S3ClientPool(
+        client_kwargs=app.config['FILES_REST_S3_CLIENT_KWARGS'])
+    client = clients.get('testbucket')
+    assert clients.get('testbucket') is client
+    part_size = 5 * 1024 * 1024
+    data = os.urandom(2 * part_size + 10)
+    s = S3FileStorage(
+        's3://testbucket/files/data', client_pool=clients,
+        part_size=part_size)
+
+    # Saved with a multipart upload.
+    assert s.save(BytesIO(data)) == (
+        's3://testbucket/files/data', len(data),
+        'md5:{0}'.format(hashlib.md5(data).hexdigest()))
+    assert client.head_object(
+        Bucket='testbucket', Key='files/data')['ETag'].endswith('-3"')
+    assert s.checksum() == 'md5:{0}'.format(hashlib.md5(data).hexdigest())
+
+    # Ranged reads.
+    fp = s.open()
+    assert fp.read(10) == data[:10]
+    fp.seek(part_size)
+    assert fp.read(10) == data[part_size:part_size + 10]
+    fp.seek(-5, os.SEEK_END)
+    assert fp.read() == data[-5:]
+    fp.close()
+    pytest.raises(StorageError, s.open, mode='wb')
+
+    # Small files are saved with a single request.
+    s.save(BytesIO(b'small'))
+    assert s.open().read() == b'small'
+    s.save(BytesIO(b''))
+    assert s.open().read() == b''
+
+    # Failed uploads are aborted.
+    pytest.raises(
+        UnexpectedFileSizeError, s.save, BytesIO(data), size=len(data) + 1)
+    assert not client.list_multipart_uploads(
+        Bucket='testbucket').get('Uploads')
+
+    # Moved on the server.
+    s.save(BytesIO(b'moved'))
+    assert s.move('s3://testbucket/files/other') == \
+        's3://testbucket/files/other'
+    assert s.open().read() == b'moved'
+    assert 'Contents' not in client.list_objects(
+        Bucket='testbucket', Prefix='files/data')
+
+    assert s.delete()
+    assert 'Contents' not in client.list_objects(Bucket='testbucket')
+
+
+def test_s3_storage_parts(app, s3_location):
+    """Test writing an S3 file in parts."""
+    part_size = 5 * 1024 * 1024
+    data = os.urandom(part_size + 3)
+    s = S3FileStorage(
+        's3://testbucket/files/data', upload_part_size=part_size)
+    assert s.initialize(size=len(data)) == \
+        ('s3://testbucket/files/data', len(data), None)
+
+    # Parts are written by other storage instances.
+    s = S3FileStorage(
+        's3://testbucket/files/data', upload_part_size=part_size)
+    assert s.update(BytesIO(data[part_size:]), seek=part_size, size=3) == \
+        (3, 'md5:{0}'.format(hashlib.md5(data[part_size:]).hexdigest()))
+    s.update(BytesIO(data[:part_size]), seek=0, size=part_size)
+    pytest.raises(StorageError, s.update, BytesIO(b'abc'), seek=3)
+    s.complete()
+    assert s.open().read() == data
+
+    # Unfinished uploads are aborted on deletion.
+    s.initialize(size=len(data))
+    s.delete()
+    assert not s.client.list_multipart_uploads(
+        Bucket='testbucket').get('Uploads')
+
+
+def test_s3_storage_factory(app, db, dummy_location, s3_location):
+    """Test the S3 storage factory."""
+    data = b'this is some data'
+    src = FileInstance.create()
+    src.set_contents(BytesIO(data), default_location=dummy_location.uri)
+    assert isinstance(src.storage(), PyFSFileStorage)
+
+    # Migrate a local file to S3.
+    dst = FileInstance.create()
+    dst.copy_contents(src, default_location=s3_location.uri)
+    db.session.commit()
+    assert dst.uri.startswith('s3://testbucket/files/')
+    assert dst.checksum == src.checksum
+    storage = dst.storage()
+    assert isinstance(storage, S3FileStorage)
+    assert storage.client_pool is dst.storage().client_pool
+    assert storage.open().read() == data
+    assert dst.verify_checksum()
+
+
+@pytest.mark.skipif(not hasattr(os, 'posix_fadvise'),
+                    reason='posix_fadvise() is not supported.')
+def test_storage_scan_advice(dummy_location, pyfs_testpath):
+    """Test page cache hints of checksums and copies."""
+    data = os.urandom(3 * 1024 * 1024 + 10)
+    s = LocalFileStorage(pyfs_testpath, scan_advice=True)
+    s.save(BytesIO(data))
+
+    assert isinstance(s._open_scan(), ScanFile)
+    with patch('os.posix_fadvise') as posix_fadvise, \
+            patch('invenio_files_rest.storage.base.page_residency',
+                  return_value=bytearray(256)):
+        fp = ScanFile(s.open(), window=1024 * 1024)
+        while fp.read(256 * 1024):
+            pass
+        fp.close()
+        advices = [(c[0][1], c[0][2], c[0][3])
+                   for c in posix_fadvise.call_args_list]
+        assert advices[0] == (0, 0, os.POSIX_FADV_SEQUENTIAL)
+        assert (1024 * 1024, 1024 * 1024, os.POSIX_FADV_WILLNEED) in advices
+        # Everything read is dropped, as nothing was cached before.
+        assert sum(a[1] for a in advices
+                   if a[2] == os.POSIX_FADV_DONTNEED) == len(data)
+
+        posix_fadvise.reset_mock()
+        assert s.checksum() == \
+            'md5:{0}'.format(hashlib.md5(data).hexdigest())
+        assert posix_fadvise.called
+        posix_fadvise.reset_mock()
+        t = LocalFileStorage(join(dummy_location.uri, 'copy/data'))
+        t.copy(s)
+        assert posix_fadvise.called
+
+    # Downloads are not affected.
+    assert not isinstance(s.open(), ScanFile)
+    assert not isinstance(
+        LocalFileStorage(pyfs_testpath)._open_scan(), ScanFile)
+
+
+def test_storage_scan_advice_cached(dummy_location, pyfs_testpath):
+    """Test that checksums do not drop the pages cached before."""
+    data = os.urandom(4 * 1024 * 1024)
+    s = LocalFileStorage(pyfs_testpath, scan_advice=True)
+    s.save(BytesIO(data))
+
+    fd = os.open(s.path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        fadvise(fd, 0, 0, 'DONTNEED')
+        # Cache the second MiB of the file, e.g. a file being downloaded.
+        os.lseek(fd, 1024 * 1024, os.SEEK_SET)
+        os.read(fd, 1024 * 1024)
+        before = page_residency(fd, 0, len(data))
+        if before is None or all(before) or not any(before):
+            pytest.skip('The page cache cannot be checked or controlled.')
+
+        fp = ScanFile(s.open(), window=1024 * 1024)
+        while fp.read(256 * 1024):
+            pass
+        fp.close()
+
+        # The pages cached before are kept, the other pages are dropped.
+        after = page_residency(fd, 0, len(data))
+        pages = len(after) // 4
+        assert all(after[pages:2 * pages])
+        assert not any(after[:pages]) and not any(after[3 * pages:])
+    finally:
+        os.close(fd)
+
+
+def test_storage_scan_direct_io(dummy_location, pyfs_testpath):
+    """Test reading files with direct I/O in checksums and copies."""
+    data = os.urandom(3 * 1024 * 1024 + 10)
+    s = LocalFileStorage(pyfs_testpath, scan_direct_io=True)
+    s.save(BytesIO(data))
+    assert s.checksum() == 'md5:{0}'.format(hashlib.md5(data).hexdigest())
+    t = LocalFileStorage(join(dummy_location.uri, 'copy/data'))
+    t.copy(s)
+    assert open(t.path, 'rb').read() == data
+
+    # Unaligned reads.
+    fd = os.open(s.path, os.O_RDONLY)
+    fp = DirectFile(fd)
+    fp.seek(4097)
+    buf = bytearray(10000)
+    assert fp.readinto(buf) == 10000
+    assert bytes(buf) == data[4097:14097]
+    fp.seek(-5, os.SEEK_END)
+    assert fp.read() == data[-5:]
+    fp.close()
@@ -11,6 +11,8 @@
 from __future__ import absolute_import, print_function
 
 import errno
+from datetime import datetime, timedelta
+from os import walk
 from os.path import exists, join
 
 import pytest
@@ -18,8 +20,11 @@ from fs.errors import FSError, ResourceNotFoundError
 from mock import MagicMock, patch
 from six import BytesIO
 
-from invenio_files_rest.models import Bucket, FileInstance, ObjectVersion
-from invenio_files_rest.tasks import migrate_file, remove_file_data, \
+from invenio_files_rest.errors import ChecksumMismatchError
+from invenio_files_rest.models import Bucket, BucketSizeDelta, FileInstance, \
+    ObjectVersion
+from invenio_files_rest.tasks import evict_storage_cache, \
+    fold_bucket_size_deltas, migrate_file, remove_file_data, \
     schedule_checksum_verification, verify_checksum
 
 
@@ -107,6 +112,36 @@ def test_schedule_checksum_verification(app, db, dummy_location):
     assert checked_files() == 21
 
 
+def test_schedule_checksum_verification_order(app, db, dummy_location):
+    """Test that the files never or least recently checked come first."""
+    b1 = Bucket.create()
+    now = datetime.utcnow()
+    last_checks = {
+        'old': now - timedelta(days=20),
+        'never': None,
+        'recent': now - timedelta(days=1),
+        'older': now - timedelta(days=30),
+    }
+    for key, last_check_at in last_checks.items():
+        obj = ObjectVersion.create(b1, key, stream=BytesIO(b'tests'))
+        obj.file.last_check_at = last_check_at
+    db.session.commit()
+
+    def checked_keys():
+        return sorted(o.key for o in ObjectVersion.get_by_bucket(b1)
+                      if o.file.last_check_at > now)
+
+    schedule_task = schedule_checksum_verification.s(
+        frequency={'minutes': 20},
+        batch_interval={'minutes': 1}
+    )
+    schedule_task.apply(kwargs={'max_count': 2})
+    assert checked_keys() == ['never', 'older']
+
+    schedule_task.apply(kwargs={'max_size': 10})
+    assert checked_keys() == ['never', 'old', 'older', 'recent']
+
+
 def test_migrate_file(app, db, dummy_location, extra_location, bucket,
                       objects):
     """Test file migration."""
@@ -124,7 +159,8 @@ def test_migrate_file(app, db, dummy_location, extra_location, bucket,
         migrate_file(
             obj.file_id, location_name=extra_location.name,
             post_fixity_check=True)
-        assert verify_checksum.delay.called
+        # The checksum is verified while copying the file.
+        assert not verify_checksum.delay.called
 
     # Get object again
     obj = ObjectVersion.get(bucket, obj.key)
@@ -133,6 +169,56 @@ def test_migrate_file(app, db, dummy_location, extra_location, bucket,
     assert exists(new_uri)
     assert new_uri != old_uri
     assert FileInstance.query.count() == 5
+    assert obj.file.last_check is True
+    assert obj.file.last_check_at is not None
+    assert FileInstance.query.filter_by(uri=old_uri).one().last_check is True
+
+
+def test_migrate_file_without_checksum(app, db, dummy_location,
+                                       extra_location, bucket, objects):
+    """Test migration with fixity check of a file without checksum."""
+    obj = objects[0]
+    src_id = obj.file_id
+    checksum = obj.file.checksum
+    obj.file.checksum = None
+    db.session.commit()
+
+    migrate_file(
+        src_id, location_name=extra_location.name, post_fixity_check=True)
+
+    # The checksum is recorded, but the files are not marked as checked.
+    src = FileInstance.get(src_id)
+    assert src.checksum == checksum
+    assert src.last_check_at is None
+    obj = ObjectVersion.get(bucket, obj.key)
+    assert obj.file_id != src_id
+    assert obj.file.checksum == checksum
+    assert obj.file.last_check_at is None
+
+
+def test_migrate_file_checksum_mismatch(app, db, dummy_location,
+                                        extra_location, bucket, objects):
+    """Test migration of a file not matching its checksum."""
+    obj = objects[0]
+    src = obj.file
+    with open(src.uri, 'ab') as fp:
+        fp.write(b'corrupted')
+
+    assert FileInstance.query.count() == 4
+    pytest.raises(
+        ChecksumMismatchError,
+        migrate_file,
+        obj.file_id,
+        location_name=extra_location.name,
+        post_fixity_check=True
+    )
+    assert FileInstance.query.count() == 4
+    assert not any(names for _, _, names in walk(extra_location.uri))
+
+    src = FileInstance.get(obj.file_id)
+    assert src.last_check is False
+    assert src.last_check_at is not None
+    assert ObjectVersion.get(bucket, obj.key).file_id == src.id
 
 
 def test_migrate_file_copyfail(app, db, dummy_location, extra_location,
@@ -154,6 +240,42 @@ def test_migrate_file_copyfail(app, db, dummy_location, extra_location,
     assert FileInstance.query.count() == 4
 
 
+def test_fold_bucket_size_deltas(app, db, bucket, objects):
+    """Test folding of the bucket size deltas."""
+    size = bucket.get_size()
+    assert BucketSizeDelta.query.count() > 0
+    fold_bucket_size_deltas.delay()
+    assert BucketSizeDelta.query.count() == 0
+    assert Bucket.get(bucket.id).size == size
+
+
+def test_evict_storage_cache(app, db, dummy_location, tmpdir):
+    """Test eviction of the read-through cache."""
+    evict_storage_cache.delay()
+
+    app.config.update(dict(
+        FILES_REST_STORAGE_CACHE_URI=str(tmpdir),
+        FILES_REST_STORAGE_CACHE_SIZE=6,
+    ))
+    b1 = Bucket.create(storage_class='A')
+    objs = [ObjectVersion.create(b1, key, stream=BytesIO(b'test'))
+            for key in ('a', 'b')]
+    db.session.commit()
+
+    def cached_files():
+        return [
+            name for dummy, dummy, names in walk(str(tmpdir))
+            for name in names
+        ]
+
+    for obj in objs:
+        obj.file.storage().open().close()
+    assert len(cached_files()) == 2
+
+    evict_storage_cache.delay()
+    assert len(cached_files()) == 1
+
+
 def test_remove_file_data(app, db, dummy_location, versions):
     """Test remove file data."""
     # Remove an object, so file instance have no references
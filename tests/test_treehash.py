@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2019 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Tree checksum tests."""
+
+from __future__ import absolute_import, print_function
+
+import hashlib
+
+from invenio_files_rest.treehash import TreeHash, parse_tree_algorithm
+
+
+def test_parse_tree_algorithm():
+    """Test parsing of tree algorithm names."""
+    assert parse_tree_algorithm('sha256-tree-64M') == \
+        ('sha256', 64 * 1024 * 1024)
+    assert parse_tree_algorithm('md5-tree-100') == ('md5', 100)
+    assert parse_tree_algorithm('md5') is None
+    assert parse_tree_algorithm('md5-tree-0') is None
+
+
+def test_tree_hash():
+    """Test tree hash of a stream."""
+    data = b'0123456789' * 10
+    m = TreeHash(hashlib.md5, 30)
+    for i in range(0, len(data), 7):
+        m.update(data[i:i + 7])
+
+    segments = [hashlib.md5(data[i:i + 30]) for i in range(0, 100, 30)]
+    assert m.segment_count(len(data)) == 4
+    assert m.segment_digests() == [s.hexdigest() for s in segments]
+    assert m.hexdigest() == hashlib.md5(
+        b''.join(s.digest() for s in segments)).hexdigest()
+
+    # Empty streams have no segments.
+    assert TreeHash(hashlib.md5, 30).hexdigest() == hashlib.md5().hexdigest()
@@ -10,10 +10,12 @@
 
 from __future__ import absolute_import, print_function
 
+from io import BytesIO
+
 from flask import url_for
-from testutils import login_user
+from testutils import count_queries, login_user
 
-from invenio_files_rest.models import ObjectVersion
+from invenio_files_rest.models import ObjectVersion, ObjectVersionTag
 
 
 def test_head(client, headers, bucket, permissions):
@@ -127,6 +129,81 @@ def test_get_versions(client, headers, permissions, bucket, objects, get_json):
             assert data['id'] == str(bucket.id)
 
 
+def test_get_paginated(client, db, headers, permissions, bucket, objects,
+                       get_json):
+    """Test listing objects by pages, prefix and delimiter."""
+    for key in ['docs/api.rst', 'docs/index.rst', 'docs/img/logo.png']:
+        ObjectVersion.create(bucket, key, stream=BytesIO(b'x'), size=1)
+    db.session.commit()
+    login_user(client, permissions['bucket'])
+    bucket_url = url_for('invenio_files_rest.bucket_api', bucket_id=bucket.id)
+
+    def list_keys(**params):
+        resp = client.get(bucket_url, query_string=params, headers=headers)
+        assert resp.status_code == 200
+        data = get_json(resp)
+        return [o['key'] for o in data['contents']], \
+            data.get('common_prefixes'), data.get('next_continuation_token')
+
+    assert list_keys(prefix='docs/') == (
+        ['docs/api.rst', 'docs/img/logo.png', 'docs/index.rst'], None, None)
+    assert list_keys(delimiter='/') == (
+        ['LICENSE', 'README.rst'], ['docs/'], None)
+    assert list_keys(prefix='docs/', delimiter='/') == (
+        ['docs/api.rst', 'docs/index.rst'], ['docs/img/'], None)
+
+    # Follow the continuation tokens and the next links.
+    keys, prefixes, token = list_keys(**{'max-keys': 2})
+    assert keys == ['LICENSE', 'README.rst']
+    keys, prefixes, token = list_keys(
+        **{'max-keys': 2, 'continuation-token': token})
+    assert keys == ['docs/api.rst', 'docs/img/logo.png']
+    resp = client.get(bucket_url, query_string={'max-keys': 2},
+                      headers=headers)
+    resp = client.get(get_json(resp)['links']['next'], headers=headers)
+    assert [o['key'] for o in get_json(resp)['contents']] == keys
+    keys, prefixes, token = list_keys(
+        **{'max-keys': 2, 'continuation-token': token})
+    assert keys == ['docs/index.rst'] and token is None
+
+    keys, prefixes, token = list_keys(delimiter='/', **{'max-keys': 2})
+    assert token
+    assert list_keys(delimiter='/', **{'continuation-token': token}) == (
+        [], ['docs/'], None)
+
+    # Invalid arguments
+    for params in [{'continuation-token': 'invalid'},
+                   {'continuation-token': 'W10='},
+                   {'max-keys': 0}, {'max-keys': 1001}]:
+        resp = client.get(bucket_url, query_string=params, headers=headers)
+        assert resp.status_code in (400, 422)
+
+
+def test_get_queries(client, db, headers, permissions, bucket, objects,
+                     get_json):
+    """Test that the number of queries does not grow with the listing."""
+    login_user(client, permissions['location'])
+    bucket_url = url_for('invenio_files_rest.bucket_api', bucket_id=bucket.id)
+
+    def count_listing_queries(**params):
+        with count_queries(db.engine) as statements:
+            resp = client.get(
+                bucket_url, query_string=params, headers=headers)
+        assert resp.status_code == 200
+        return len(get_json(resp)['contents']), len(statements)
+
+    before = [count_listing_queries(), count_listing_queries(versions='1')]
+    for i in range(10):
+        obj = ObjectVersion.create(
+            bucket, 'key{0}'.format(i), stream=BytesIO(b'x'), size=1)
+        ObjectVersionTag.create(obj, 'mykey', 'myvalue')
+    db.session.commit()
+    after = [count_listing_queries(), count_listing_queries(versions='1')]
+
+    assert [b[0] + 10 for b in before] == [a[0] for a in after]
+    assert [b[1] for b in before] == [a[1] for a in after]
+
+
 def test_get_empty_bucket(db, client, headers, bucket, objects, permissions,
                           get_json):
     """Test getting objects from an empty bucket."""
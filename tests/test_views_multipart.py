@@ -16,7 +16,7 @@ import pytest
 from flask import url_for
 from mock import MagicMock, patch
 from six import BytesIO
-from testutils import BadBytesIO, login_user
+from testutils import BadBytesIO, count_queries, login_user
 
 from invenio_files_rest.models import Bucket, MultipartObject, Part
 from invenio_files_rest.tasks import merge_multipartobject
@@ -484,7 +484,7 @@ def test_post_complete_timeout(app, client, headers, bucket, multipart,
 def test_delete(client, db, bucket, multipart, multipart_url, permissions,
                 parts, get_json):
     """Test complete when parts are missing."""
-    assert bucket.size == multipart.size
+    assert bucket.get_size() == multipart.size
 
     cases = [
         (None, 404),
@@ -503,7 +503,7 @@ def test_delete(client, db, bucket, multipart, multipart_url, permissions,
             assert client.get(multipart_url).status_code == 404
             assert MultipartObject.query.count() == 0
             assert Part.query.count() == 0
-            assert Bucket.get(bucket.id).size == 0
+            assert Bucket.get(bucket.id).get_size() == 0
 
 
 def test_delete_invalid(client, db, multipart, multipart_url,
@@ -545,6 +545,35 @@ def test_get_listuploads(client, db, bucket, multipart, multipart_url,
         assert res.status_code == expected
 
 
+def test_get_listing_queries(client, db, bucket, multipart, multipart_url,
+                             permissions, get_json):
+    """Test that the number of queries does not grow with the listings."""
+    login_user(client, permissions['location'])
+    uploads_url = url_for(
+        'invenio_files_rest.bucket_api', bucket_id=str(bucket.id)) + \
+        '?uploads'
+
+    def count_listing_queries(url, name):
+        with count_queries(db.engine) as statements:
+            res = client.get(url)
+        assert res.status_code == 200
+        data = get_json(res)
+        return len(data if name is None else data[name]), len(statements)
+
+    before = [count_listing_queries(uploads_url, None),
+              count_listing_queries(multipart_url, 'parts')]
+    for i in range(3):
+        MultipartObject.create(bucket, 'key{0}'.format(i), 110, 20)
+    for i in range(3):
+        Part.create(multipart, i, stream=BytesIO(b'x' * 20))
+    db.session.commit()
+    after = [count_listing_queries(uploads_url, None),
+             count_listing_queries(multipart_url, 'parts')]
+
+    assert [b[0] + 3 for b in before] == [a[0] for a in after]
+    assert [b[1] for b in before] == [a[1] for a in after]
+
+
 def test_already_exhausted_input_stream(app, client, db, bucket, admin_user):
     """Test server error when file stream is already read."""
     key = 'test.json'
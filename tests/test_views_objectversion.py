@@ -104,6 +104,143 @@ def test_get_download(client, headers, bucket, objects, permissions):
                 'attachment; filename={0}'.format(obj.key))
 
 
+def test_get_range(client, bucket, objects, permissions):
+    """Test getting byte ranges of an object."""
+    login_user(client, permissions['objects'])
+
+    obj = objects[0]
+    data = b'license file'
+    object_url = url_for(
+        'invenio_files_rest.object_api', bucket_id=bucket.id, key=obj.key)
+
+    resp = client.get(object_url)
+    assert resp.status_code == 200
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+
+    # Single range
+    resp = client.get(object_url, headers={'Range': 'bytes=2-5'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Range'] == 'bytes 2-5/12'
+    assert resp.headers['Content-Length'] == '4'
+    assert 'Content-MD5' not in resp.headers
+    assert resp.get_etag()[0] == obj.file.checksum
+    assert resp.get_data() == data[2:6]
+
+    # Suffix and open ended ranges
+    resp = client.get(object_url, headers={'Range': 'bytes=-4'})
+    assert resp.status_code == 206
+    assert resp.get_data() == b'file'
+    resp = client.get(object_url, headers={'Range': 'bytes=8-100'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Range'] == 'bytes 8-11/12'
+    assert resp.get_data() == b'file'
+
+    # Full range is served as a normal response
+    resp = client.get(object_url, headers={'Range': 'bytes=0-'})
+    assert resp.status_code == 200
+    assert resp.get_data() == data
+
+    # Unsatisfiable range
+    resp = client.get(object_url, headers={'Range': 'bytes=12-20'})
+    assert resp.status_code == 416
+    assert resp.headers['Content-Range'] == 'bytes */12'
+
+    # Malformed ranges are ignored
+    resp = client.get(object_url, headers={'Range': 'bytes=5-2'})
+    assert resp.status_code == 200
+    assert resp.get_data() == data
+
+
+def test_get_multiple_ranges(client, bucket, objects, permissions):
+    """Test getting multiple byte ranges of an object."""
+    login_user(client, permissions['objects'])
+
+    obj = objects[0]
+    object_url = url_for(
+        'invenio_files_rest.object_api', bucket_id=bucket.id, key=obj.key)
+
+    resp = client.get(object_url, headers={'Range': 'bytes=0-2,8-'})
+    assert resp.status_code == 206
+    content_type = resp.headers['Content-Type']
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    boundary = content_type.split('=')[1]
+    body = resp.get_data()
+    assert int(resp.headers['Content-Length']) == len(body)
+    parts = body.split(b'--' + boundary.encode('ascii'))
+    assert len(parts) == 4
+    assert parts[1].endswith(b'Content-Range: bytes 0-2/12\r\n\r\nlic\r\n')
+    assert parts[2].endswith(b'Content-Range: bytes 8-11/12\r\n\r\nfile\r\n')
+    assert parts[3] == b'--\r\n'
+
+
+def test_get_range_if_range(client, bucket, objects, permissions):
+    """Test If-Range precondition for byte ranges."""
+    login_user(client, permissions['objects'])
+
+    obj = objects[0]
+    object_url = url_for(
+        'invenio_files_rest.object_api', bucket_id=bucket.id, key=obj.key)
+    resp = client.get(object_url)
+    etag = resp.headers['ETag']
+    last_modified = resp.headers['Last-Modified']
+
+    for if_range, expected in [
+            (etag, 206),
+            (last_modified, 206),
+            ('"md5:invalid"', 200),
+            ('W/' + etag, 200),
+            ('Mon, 01 Jan 2001 00:00:00 GMT', 200)]:
+        resp = client.get(
+            object_url, headers={'Range': 'bytes=0-2', 'If-Range': if_range})
+        assert resp.status_code == expected
+
+    # Conditional requests take precedence over ranges.
+    resp = client.get(
+        object_url, headers={'Range': 'bytes=0-2', 'If-None-Match': etag})
+    assert resp.status_code == 304
+
+
+@pytest.mark.parametrize('header, prefix', [
+    ('X-Accel-Redirect', '/protected'),
+    ('X-Sendfile', '/srv/files'),
+])
+def test_get_offload(app, client, bucket, objects, permissions, header,
+                     prefix):
+    """Test offloading downloads to the front-end web server."""
+    login_user(client, permissions['objects'])
+
+    obj = objects[0]
+    location_uri = bucket.location.uri
+    object_url = url_for(
+        'invenio_files_rest.object_api', bucket_id=bucket.id, key=obj.key)
+
+    app.config.update(
+        FILES_REST_DOWNLOAD_OFFLOAD_HEADER=header,
+        FILES_REST_DOWNLOAD_OFFLOAD_PATHS={location_uri: prefix},
+    )
+    resp = client.get(object_url)
+    assert resp.status_code == 200
+    assert resp.headers[header] == \
+        prefix + obj.file.uri[len(location_uri):]
+    assert resp.get_data() == b''
+    assert resp.get_etag()[0] == obj.file.checksum
+    assert resp.headers['Content-Disposition'] == \
+        'attachment; filename=LICENSE'
+
+    # Conditional requests are still answered by the application.
+    resp = client.get(
+        object_url, headers={'If-None-Match': resp.headers['ETag']})
+    assert resp.status_code == 304
+    assert header not in resp.headers
+
+    # Files outside the configured paths are sent by the application.
+    app.config['FILES_REST_DOWNLOAD_OFFLOAD_PATHS'] = {'/other': prefix}
+    resp = client.get(object_url)
+    assert resp.status_code == 200
+    assert header not in resp.headers
+    assert resp.get_data() == b'license file'
+
+
 def test_last_modified_utc_conversion(client, headers, bucket, permissions):
     """Test date conversion of the DB object 'updated' timestamp (UTC) to a
     correct Last-Modified date (also UTC) in the response header.
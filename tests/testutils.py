@@ -11,8 +11,10 @@
 from __future__ import absolute_import, print_function
 
 import sys
+from contextlib import contextmanager
 
 from six import BytesIO
+from sqlalchemy import event
 
 if sys.version_info.major == 2:
     PY2 = True
@@ -20,6 +22,21 @@ else:
     PY2 = False
 
 
+@contextmanager
+def count_queries(engine):
+    """Collect the SQL statements executed within the block."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
 def login_user(client, user):
     """Log in a specified user."""
     with client.session_transaction() as sess: